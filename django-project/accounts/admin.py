@@ -2,6 +2,7 @@ import os
 
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from accounts.models import (
     ChefPermissionsRequest, RedFlag, Complaint,
@@ -243,11 +244,12 @@ class RemoveSuspensionRequestAdmin(admin.ModelAdmin):
         for request in queryset:
             user = request.user
             request.status = RemoveSuspensionRequest.APPROVED
+            request.decided = timezone.now()
             request.save()
-            user.suspensioninfo.suspended = False
-            user.suspensioninfo.save()
+            user.suspensioninfo.unsuspend()
 
     def deny_request(self, request, queryset):
         for request in queryset:
             request.status = RemoveSuspensionRequest.DENIED
+            request.decided = timezone.now()
             request.save()
@@ -0,0 +1,115 @@
+"""
+Posting engine for the NGS ledger.
+
+Money only ever moves by posting Transfers. A batch of Transfers is posted in
+a single transaction: Transfers whose idempotency key was already posted are
+dropped, the rest are inserted with one bulk INSERT, and every affected
+Balance is updated with the net of all its Transfers in the batch. The
+Balances are updated BATCH_SIZE at a time, each chunk by one UPDATE that
+adds a CASE over the Balance ids to the amount. The Balance amounts are
+therefore a snapshot of the ledger, which the reconcile_balances management
+command verifies.
+"""
+import uuid
+
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+
+from accounts.models import Balance, Transfer
+
+# The most Balances changed by one UPDATE. Each takes three query parameters,
+# which keeps the UPDATE under SQLite's parameter limit.
+BATCH_SIZE = 300
+
+
+class InsufficientFunds(Exception):
+    """
+    Raised when posting a batch would overdraw a user's Balance.
+
+    Attributes:
+
+    user_id:
+        The id of the user whose Balance would be overdrawn.
+    """
+    def __init__(self, user_id):
+        super(InsufficientFunds, self).__init__(
+            "User {} has insufficient funds.".format(user_id)
+        )
+        self.user_id = user_id
+
+
+def transfer(source, destination, amount, key=None):
+    """
+    Return an unsaved Transfer of amount from source to destination.
+
+    Either user may be None for money entering or leaving NGS. If no
+    idempotency key is given a random one is generated, in which case the
+    Transfer is never deduplicated.
+    """
+    return Transfer(key=key or uuid.uuid4().hex,
+                    source=source,
+                    destination=destination,
+                    amount=amount)
+
+
+def lock_balances(user_ids):
+    """
+    Lock the Balances of the given users and return them keyed by user id.
+
+    Rows are locked in primary key order so that two transactions locking
+    the same Balances cannot deadlock.
+    """
+    balances = (Balance.objects.select_for_update()
+                               .filter(user_id__in=user_ids)
+                               .order_by("pk"))
+    return dict((balance.user_id, balance) for balance in balances)
+
+
+def post(transfers, allow_overdraft=False):
+    """
+    Post a batch of Transfers and return those that were newly posted.
+
+    Raises InsufficientFunds, and posts nothing, if the batch would leave a
+    user's Balance negative unless allow_overdraft is set. If another
+    transaction posts one of the same keys concurrently, the unique key makes
+    one of the two fail with an IntegrityError, so money never moves twice.
+    """
+    with transaction.atomic():
+        batch = {}
+        for t in transfers:
+            batch.setdefault(t.key, t)
+        posted = set(Transfer.objects.filter(key__in=list(batch))
+                                     .values_list("key", flat=True))
+        new = [t for key, t in batch.items() if key not in posted]
+        if not new:
+            return []
+
+        deltas = {}
+        for t in new:
+            if t.source_id is not None:
+                deltas[t.source_id] = deltas.get(t.source_id, 0) - t.amount
+            if t.destination_id is not None:
+                deltas[t.destination_id] = deltas.get(t.destination_id, 0) + t.amount
+
+        balances = lock_balances(list(deltas))
+        if not allow_overdraft:
+            for user_id, delta in deltas.items():
+                if delta < 0 and not balances[user_id].has_funds(-delta):
+                    raise InsufficientFunds(user_id)
+
+        Transfer.objects.bulk_create(new)
+        changed = [(balances[user_id], delta)
+                   for user_id, delta in deltas.items() if delta]
+        for start in range(0, len(changed), BATCH_SIZE):
+            chunk = changed[start:start + BATCH_SIZE]
+            net = Case(*[When(pk=balance.pk, then=Value(delta))
+                         for balance, delta in chunk],
+                       output_field=models.DecimalField())
+            ids = [balance.pk for balance, delta in chunk]
+            Balance.objects.filter(pk__in=ids).update(
+                amount=F("amount") + net
+            )
+        for balance, delta in changed:
+            balance.amount += delta
+            balance.update_vip_status()
+    return new
@@ -0,0 +1,70 @@
+"""
+Management command that rebuilds the completed transaction counters of every
+Balance from history.
+
+The completed Orders and Dish Requests of each diner and the completed Dish
+Posts of each chef are counted with one grouped query per table. Balances are
+then updated in bulk, one UPDATE per distinct count, and the VIP status of
+every Balance whose counter changed is recomputed.
+"""
+import collections
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from accounts.models import Balance
+from dishes.models import DishPost, DishRequest, Order
+
+
+def completed_counts():
+    """
+    Return the number of completed transactions of every user who has any,
+    keyed by user id.
+    """
+    counts = collections.Counter()
+    sources = (
+        (Order.objects.filter(status=Order.COMPLETE, diner__isnull=False),
+         "diner__user"),
+        (DishRequest.objects.filter(status=DishRequest.COMPLETE,
+                                   diner__isnull=False),
+         "diner__user"),
+        (DishPost.objects.filter(status=DishPost.COMPLETE),
+         "chef__user"),
+    )
+    for queryset, user in sources:
+        rows = (queryset.values_list(user)
+                        .annotate(total=Count("pk"))
+                        .order_by())
+        for user_id, total in rows:
+            counts[user_id] += total
+    return counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the completed transaction counters used for VIP status."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            counts = completed_counts()
+            stale = collections.defaultdict(list)
+            balances = Balance.objects.values_list("user_id",
+                                                   "completed_transactions")
+            for user_id, current in balances.iterator():
+                expected = counts.get(user_id, 0)
+                if current != expected:
+                    stale[expected].append(user_id)
+
+            changed = []
+            for expected, user_ids in stale.items():
+                Balance.objects.filter(user_id__in=user_ids).update(
+                    completed_transactions=expected
+                )
+                changed.extend(user_ids)
+            for balance in (Balance.objects.select_related("user")
+                                           .filter(user_id__in=changed)):
+                balance.update_vip_status()
+
+        if options["verbosity"] > 0:
+            self.stdout.write("Rebuilt {} completed transaction counters."
+                              .format(len(changed)))
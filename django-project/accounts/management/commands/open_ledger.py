@@ -0,0 +1,56 @@
+"""
+Management command that opens the ledger of every Balance that predates it.
+
+Money held before the ledger was introduced was never posted as Transfers,
+so the Balances holding it disagree with the ledger. For every user with a
+non-zero Balance and no Transfers at all, one opening Transfer of the amount
+of the Balance is inserted, keyed "opening:<user id>", into the account (or
+out of it, for an overdrawn Balance). The Balances themselves are left as
+they are. Run it once, before reconcile_balances --fix can rewrite them.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import Balance, Transfer
+
+
+def users_with_history():
+    """
+    Return the ids of the users who are the source or destination of any
+    Transfer.
+    """
+    users = set()
+    for field in ("source", "destination"):
+        users.update(Transfer.objects.filter(**{field + "__isnull": False})
+                                     .values_list(field, flat=True)
+                                     .distinct()
+                                     .order_by())
+    return users
+
+
+class Command(BaseCommand):
+    help = "Post opening Transfers for the Balances that predate the ledger."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            history = users_with_history()
+            openings = []
+            balances = (Balance.objects.exclude(amount=0)
+                                       .values_list("user_id", "amount"))
+            for user_id, amount in balances.iterator():
+                if user_id in history:
+                    continue
+                key = "opening:{}".format(user_id)
+                if amount > 0:
+                    openings.append(Transfer(key=key, destination_id=user_id,
+                                             amount=amount))
+                else:
+                    openings.append(Transfer(key=key, source_id=user_id,
+                                             amount=-amount))
+            # The Transfers record money the Balances already hold, so they
+            # are inserted directly rather than posted.
+            Transfer.objects.bulk_create(openings)
+
+        if options["verbosity"] > 0:
+            self.stdout.write("Opened the ledger of {} Balances."
+                              .format(len(openings)))
@@ -0,0 +1,69 @@
+"""
+Management command that reconciles every Balance against the ledger.
+
+The amount of a Balance must equal the sum of the Transfers into the user's
+account minus the sum of the Transfers out of it. Every Balance that
+disagrees is reported and the command exits with an error. With --fix the
+Balances are instead rewritten from the ledger.
+
+A funded Balance whose user has no Transfers at all predates the ledger, and
+rewriting it would wipe the money it holds, so --fix refuses to run until
+the open_ledger command has posted the opening Transfers.
+"""
+import decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from accounts.models import Balance, Transfer
+
+
+class Command(BaseCommand):
+    help = "Reconcile Balance amounts against the Transfer ledger."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix",
+                            action="store_true",
+                            help="Rewrite mismatched Balances from the ledger.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            credits = dict(Transfer.objects.filter(destination__isnull=False)
+                                           .values_list("destination")
+                                           .annotate(total=Sum("amount"))
+                                           .order_by())
+            debits = dict(Transfer.objects.filter(source__isnull=False)
+                                          .values_list("source")
+                                          .annotate(total=Sum("amount"))
+                                          .order_by())
+            mismatched = []
+            unopened = 0
+            balances = Balance.objects.values_list("pk", "user_id", "amount")
+            for pk, user_id, amount in balances.iterator():
+                expected = (credits.get(user_id, decimal.Decimal(0)) -
+                            debits.get(user_id, decimal.Decimal(0)))
+                if amount != expected:
+                    mismatched.append((pk, user_id, amount, expected))
+                    if user_id not in credits and user_id not in debits:
+                        unopened += 1
+
+            for pk, user_id, amount, expected in mismatched:
+                self.stdout.write("User {}: balance is {}, ledger says {}"
+                                  .format(user_id, amount, expected))
+
+            if not options["fix"]:
+                if mismatched:
+                    raise CommandError("{} Balances disagree with the ledger."
+                                       .format(len(mismatched)))
+                self.stdout.write("All Balances agree with the ledger.")
+                return
+            if unopened:
+                raise CommandError("{} funded Balances have no Transfers. "
+                                   "Run open_ledger before --fix."
+                                   .format(unopened))
+
+            for pk, user_id, amount, expected in mismatched:
+                Balance.objects.filter(pk=pk).update(amount=expected)
+            self.stdout.write("Rewrote {} Balances from the ledger."
+                              .format(len(mismatched)))
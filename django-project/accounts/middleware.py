@@ -1,12 +1,19 @@
 from django.shortcuts import redirect
+from django.urls import reverse
+
+from accounts.models import SuspensionInfo
 
 class SuspensionMiddleware:
     """
     Middleware for redirecting suspended users to the suspended page.
+
+    The middleware keeps no state between requests, so one instance can
+    safely serve concurrent requests from many users. Suspension state is
+    read through SuspensionInfo.is_suspended, which is cached, so the
+    middleware makes no queries in the common case.
     """
     def __init__(self, get_response):
         self.get_response = get_response
-        self.redirected = False
 
     def __call__(self, request):
         """
@@ -17,7 +24,8 @@ class SuspensionMiddleware:
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         """
-        Redirect the user to the suspended page if she is suspended.
+        Redirect the user to the suspended page if she is suspended. A
+        suspended user may still view the suspended page and log out.
         """
         user = request.user
 
@@ -27,20 +35,10 @@ class SuspensionMiddleware:
         if user.is_superuser:
             return None
 
-        uri = request.build_absolute_uri()
-
-        if uri[-8:] == "/logout/":
-            return None
-
-        if uri[-20:] == "/accounts/suspended/" and not self.redirected:
+        if request.path in (reverse("logout"), reverse("suspended")):
             return None
 
-        if user.suspensioninfo.suspended:
-            if self.redirected:
-                self.redirected = False
-                return None
-            else:
-                self.redirected = True
-                return redirect("suspended")
+        if SuspensionInfo.is_suspended(user.pk):
+            return redirect("suspended")
         else:
             return None
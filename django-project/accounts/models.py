@@ -1,9 +1,16 @@
+import collections
 import decimal
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
-from dishes.models import Order, DishPost, DishRequest
+from dishes.models import (
+    Chef, Diner, DishPost, DishRequest, Order, dish_post_statuses_changed
+)
 
 class CreateAccountRequest(models.Model):
     """
@@ -140,6 +147,9 @@ class ChefPermissionsRequest(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
 
+    class Meta:
+        index_together = [("user", "status")]
+
 class Suggestion(models.Model):
     """
     Django class representing a suggestion made by a visitor or user to the
@@ -222,6 +232,9 @@ class Complaint(models.Model):
         Whether the complainant has been suspended as a result of making
         this complaint.
 
+    date:
+        The date and time when the complaint was made.
+
     status:
         The status of this complaint. Status descriptions are given below.
 
@@ -239,6 +252,7 @@ class Complaint(models.Model):
                                    related_name="complaint_receipts")
     description = models.TextField("Complaint Description")
     struck = models.BooleanField(default=False)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
     order = models.OneToOneField(Order, on_delete=models.CASCADE)
 
     PENDING, CLOSED = 0, 1
@@ -250,15 +264,26 @@ class Complaint(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
 
+    class Meta:
+        index_together = [("complainant", "struck")]
+
 class SuspensionInfo(models.Model):
     """
     Django class representing the number of times a user has been suspended.
 
+    Whether a user is suspended is cached under a per-user key so that the
+    SuspensionMiddleware does not have to query for it on every request.
+    Saving a SuspensionInfo refreshes the cached value, so suspend and
+    unsuspend take effect on the user's next request.
+
     Attributes:
 
     user:
         The user with which this SuspensionCount is associated.
 
+    suspended:
+        Whether the user is currently suspended.
+
     count:
         The number of times the user has been suspended.
     """
@@ -266,11 +291,48 @@ class SuspensionInfo(models.Model):
     suspended = models.BooleanField(default=False)
     count = models.IntegerField(default=0)
 
+    # How long in seconds a user's suspension state is cached. Saves update
+    # the cache immediately; the timeout only bounds how long a change made
+    # behind the model's back, such as a queryset update, can go unnoticed.
+    CACHE_TIMEOUT = 60 * 60
+
+    @staticmethod
+    def cache_key(user_id):
+        return "accounts:suspended:{}".format(user_id)
+
+    @staticmethod
+    def is_suspended(user_id):
+        """
+        Return whether the user is suspended, from the cache if possible.
+        """
+        key = SuspensionInfo.cache_key(user_id)
+        suspended = cache.get(key)
+        if suspended is None:
+            suspended = (SuspensionInfo.objects.filter(user_id=user_id)
+                                               .values_list("suspended", flat=True)
+                                               .first()) or False
+            cache.set(key, suspended, SuspensionInfo.CACHE_TIMEOUT)
+        return suspended
+
+    def save(self, *args, **kwargs):
+        super(SuspensionInfo, self).save(*args, **kwargs)
+        cache.set(SuspensionInfo.cache_key(self.user_id),
+                  self.suspended,
+                  SuspensionInfo.CACHE_TIMEOUT)
+
+    def delete(self, *args, **kwargs):
+        cache.delete(SuspensionInfo.cache_key(self.user_id))
+        return super(SuspensionInfo, self).delete(*args, **kwargs)
+
     def suspend(self):
         self.suspended = True
         self.count = self.count + 1
         self.save()
 
+    def unsuspend(self):
+        self.suspended = False
+        self.save()
+
 class Balance(models.Model):
     """
     Django class representing the balance a user has on their account.
@@ -281,42 +343,110 @@ class Balance(models.Model):
         The user with which this Balance is associated.
 
     amount:
-        The amount of the user's balance.
+        The amount of the user's balance. The amount is a snapshot of the
+        Transfers into and out of the user's account; it is only changed by
+        accounts.ledger.post and is checked against the ledger by the
+        reconcile_balances management command.
+
+    completed_transactions:
+        The number of completed Orders and Dish Requests the user placed as a
+        diner plus the number of completed Dish Posts they made as a chef.
+        It is kept current by the signal handlers at the end of this module
+        and by record_completed_transactions as transactions complete, so
+        VIP status never has to recount them, and can be rebuilt from
+        history with the backfill_vip_counters management command.
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=11,
                                  decimal_places=6,
                                  default=decimal.Decimal(0.0))
     is_vip = models.BooleanField(default=False)
-
-    def credit(self, amt):
-        self.amount = self.amount + amt
-        self.update_vip_status()
-
-    def debit(self, amt):
-        self.amount = self.amount - amt
-        self.update_vip_status()
+    completed_transactions = models.IntegerField(default=0, editable=False)
 
     VIP_THRESHOLD = decimal.Decimal(5000)
+    VIP_TRANSACTIONS = 5
+
+    @staticmethod
+    def add_completed_transactions(counts):
+        """
+        Add counts, a dict of numbers of transactions keyed by user id, to
+        the completed transactions of those users and update their VIP
+        status. A negative count undoes completed transactions.
+        """
+        by_count = collections.defaultdict(list)
+        for user_id, count in counts.items():
+            if count:
+                by_count[count].append(user_id)
+        for count, ids in by_count.items():
+            Balance.objects.filter(user_id__in=ids).update(
+                completed_transactions=F("completed_transactions") + count
+            )
+        changed = [user_id for ids in by_count.values() for user_id in ids]
+        balances = (Balance.objects.select_related("user")
+                                   .filter(user_id__in=changed))
+        for balance in balances:
+            balance.update_vip_status()
+
+    @staticmethod
+    def record_completed_transactions(user_ids):
+        """
+        Count one completed transaction for every occurrence of a user id in
+        user_ids and update the VIP status of those users.
+        """
+        Balance.add_completed_transactions(collections.Counter(user_ids))
 
     def update_vip_status(self):
-        self.is_vip = self.amount > Balance.VIP_THRESHOLD
-        ntransactions = 0
-        diner = self.user.diner
-        orders = diner.order_set.filter(status=Order.COMPLETE)
-        dishrequests = diner.dishrequest_set.filter(status=DishRequest.COMPLETE)
-        ntransactions += orders.count()
-        ntransactions += dishrequests.count()
-        if hasattr(self.user, "chef"):
-            dishposts = self.user.chef.dishpost_set.filter(status=DishPost.COMPLETE)
-            ntransactions += dishposts.count()
-        if ntransactions > 5:
-            self.is_vip = hasattr(self.user, "complaint_receipts")
-        self.save()
+        is_vip = self.amount > Balance.VIP_THRESHOLD
+        if self.completed_transactions > Balance.VIP_TRANSACTIONS:
+            is_vip = hasattr(self.user, "complaint_receipts")
+        if is_vip != self.is_vip:
+            self.is_vip = is_vip
+            self.save(update_fields=["is_vip"])
 
     def has_funds(self, amt):
         return self.amount >= amt
 
+class Transfer(models.Model):
+    """
+    Django class representing a movement of money from one account to
+    another. Transfers form an append-only, double-entry ledger: every
+    Transfer debits its source and credits its destination by the same
+    amount, so the Transfers of an account always add up to its Balance.
+
+    Attributes:
+
+    key:
+        The idempotency key of the Transfer. Posting a Transfer whose key
+        has already been posted has no effect, so a retried request cannot
+        move the same money twice.
+
+    source:
+        The user whose account is debited, or null for money entering NGS,
+        such as deposits and VIP discounts paid by the house. Transfers of
+        a deleted user are kept with the user set to null.
+
+    destination:
+        The user whose account is credited, or null for money leaving NGS,
+        such as withdrawals.
+
+    amount:
+        The amount transferred. Always positive.
+
+    date:
+        The date and time the Transfer was posted.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    source = models.ForeignKey(User,
+                               on_delete=models.SET_NULL,
+                               null=True,
+                               related_name="transfers_out")
+    destination = models.ForeignKey(User,
+                                    on_delete=models.SET_NULL,
+                                    null=True,
+                                    related_name="transfers_in")
+    amount = models.DecimalField(max_digits=11, decimal_places=6)
+    date = models.DateTimeField(auto_now_add=True)
+
 class RemoveSuspensionRequest(models.Model):
     """
     Django class representing a request to remove a suspension.
@@ -341,6 +471,9 @@ class RemoveSuspensionRequest(models.Model):
             A superuser has reviewed and approved the request.
         DENIED:
             A superuser has reviewed and denied the request.
+
+    decided:
+        The date and time when a superuser approved or denied the request.
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     justification = models.TextField()
@@ -354,3 +487,72 @@ class RemoveSuspensionRequest(models.Model):
     )
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    decided = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [("user", "status")]
+
+
+def completed(old, new, complete):
+    """
+    Return the change in completed transactions of a status change from old
+    to new, where either is None for a row created or deleted.
+    """
+    return (new == complete) - (old == complete)
+
+
+@receiver(dish_post_statuses_changed)
+def count_completed_dish_posts(sender, changes, **kwargs):
+    """
+    Count Dish Posts completing, or no longer complete, towards the VIP
+    status of their Chefs.
+    """
+    deltas = collections.Counter()
+    for (chef_id, old, new), n in changes.items():
+        delta = completed(old, new, DishPost.COMPLETE)
+        if chef_id is not None and delta:
+            deltas[chef_id] += n * delta
+    if deltas:
+        users = dict(Chef.objects.filter(pk__in=list(deltas))
+                                 .values_list("pk", "user_id"))
+        Balance.add_completed_transactions(
+            dict((users[chef_id], delta) for chef_id, delta in deltas.items()
+                 if chef_id in users)
+        )
+
+
+def count_diner_transaction(instance, delta):
+    if delta and instance.diner_id is not None:
+        user_id = (Diner.objects.filter(pk=instance.diner_id)
+                                .values_list("user_id", flat=True)
+                                .first())
+        if user_id is not None:
+            Balance.add_completed_transactions({user_id: delta})
+
+
+# Orders completed by a conditional UPDATE, which sends no post_save, are
+# counted by the code completing them.
+@receiver(post_init, sender=Order)
+@receiver(post_init, sender=DishRequest)
+def remember_diner_transaction_status(sender, instance, **kwargs):
+    # Read from __dict__ so that a deferred status is not loaded.
+    instance._saved_status = instance.__dict__.get("status")
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=DishRequest)
+def count_saved_diner_transaction(sender, instance, created, update_fields,
+                                  raw, **kwargs):
+    if raw or (update_fields is not None and "status" not in update_fields):
+        return
+    old = None if created else instance._saved_status
+    instance._saved_status = instance.status
+    count_diner_transaction(instance,
+                            completed(old, instance.status, sender.COMPLETE))
+
+
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=DishRequest)
+def count_deleted_diner_transaction(sender, instance, **kwargs):
+    count_diner_transaction(instance,
+                            completed(instance.status, None, sender.COMPLETE))
@@ -1,3 +1,163 @@
-from django.test import TestCase
+import datetime
+import decimal
+import io
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from accounts import ledger
+from accounts.middleware import SuspensionMiddleware
+from accounts.models import Balance, SuspensionInfo, Transfer
+from dishes.models import Chef, Diner, Dish, DishPost, DishRequest
+
+
+class LedgerTest(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        for user in (self.alice, self.bob):
+            Diner.objects.create(user=user)
+            Balance.objects.create(user=user)
+        ledger.post([ledger.transfer(None, self.alice, decimal.Decimal(50))])
+
+    def amount(self, user):
+        return Balance.objects.get(user=user).amount
+
+    def test_batch_applies_net_amounts(self):
+        ledger.post([
+            ledger.transfer(self.alice, self.bob, decimal.Decimal(30)),
+            ledger.transfer(self.bob, self.alice, decimal.Decimal(5)),
+        ])
+        self.assertEqual(self.amount(self.alice), 25)
+        self.assertEqual(self.amount(self.bob), 25)
+
+    def test_posting_a_key_twice_moves_money_once(self):
+        for _ in range(2):
+            ledger.post([ledger.transfer(self.alice, self.bob,
+                                         decimal.Decimal(10), key="tip:1")])
+        self.assertEqual(self.amount(self.bob), 10)
+        self.assertEqual(Transfer.objects.filter(key="tip:1").count(), 1)
+
+    def test_overdraft_posts_nothing(self):
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.post([
+                ledger.transfer(None, self.bob, decimal.Decimal(1)),
+                ledger.transfer(self.alice, self.bob, decimal.Decimal(51)),
+            ])
+        self.assertEqual(self.amount(self.alice), 50)
+        self.assertEqual(self.amount(self.bob), 0)
+        self.assertEqual(Transfer.objects.count(), 1)
+
+    def test_reconcile_balances(self):
+        call_command("reconcile_balances", stdout=io.StringIO())
+        Balance.objects.filter(user=self.alice).update(amount=7)
+        with self.assertRaises(CommandError):
+            call_command("reconcile_balances", stdout=io.StringIO())
+        call_command("reconcile_balances", "--fix", stdout=io.StringIO())
+        self.assertEqual(self.amount(self.alice), 50)
+
+    def test_balances_predating_the_ledger_are_opened_before_fixing(self):
+        # Bob's money was deposited before the ledger existed.
+        Balance.objects.filter(user=self.bob).update(amount=7)
+        with self.assertRaises(CommandError):
+            call_command("reconcile_balances", "--fix", stdout=io.StringIO())
+        self.assertEqual(self.amount(self.bob), 7)
+
+        call_command("open_ledger", verbosity=0)
+        call_command("open_ledger", verbosity=0)
+        opening = Transfer.objects.get(key="opening:{}".format(self.bob.pk))
+        self.assertEqual((opening.destination, opening.amount), (self.bob, 7))
+        self.assertEqual(Transfer.objects.count(), 2)
+        self.assertEqual(self.amount(self.bob), 7)
+        call_command("reconcile_balances", stdout=io.StringIO())
+
+
+class VipCounterTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="carol")
+        Diner.objects.create(user=self.user)
+        Balance.objects.create(user=self.user)
+
+    def balance(self):
+        return Balance.objects.get(user=self.user)
+
+    def test_vip_after_enough_completed_transactions(self):
+        Balance.record_completed_transactions([self.user.pk] * 5)
+        self.assertEqual(self.balance().completed_transactions, 5)
+        self.assertFalse(self.balance().is_vip)
+        Balance.record_completed_transactions([self.user.pk])
+        self.assertTrue(self.balance().is_vip)
+
+    def test_backfill_vip_counters(self):
+        Balance.objects.filter(user=self.user).update(completed_transactions=9)
+        call_command("backfill_vip_counters", stdout=io.StringIO())
+        self.assertEqual(self.balance().completed_transactions, 0)
+
+    def dish_post(self, chef):
+        now = timezone.now()
+        return DishPost.objects.create(
+            chef=chef,
+            dish=Dish.objects.create(name="Pizza", description="Cheese"),
+            max_servings=1,
+            min_price=decimal.Decimal(5),
+            serving_size=decimal.Decimal(1),
+            last_call=now + datetime.timedelta(days=1),
+            meal_time=now + datetime.timedelta(days=2)
+        )
+
+    def test_completed_requests_and_posts_count_live(self):
+        chef = Chef.objects.create(user=self.user)
+        posts = [self.dish_post(chef) for _ in range(2)]
+        for post in posts:
+            post.status = DishPost.COMPLETE
+            post.save()
+        posts[0].save()
+        request = DishRequest.objects.create(
+            diner=self.user.diner, dish=posts[0].dish,
+            portion_size=decimal.Decimal(1), min_price=decimal.Decimal(5),
+            meal_time=posts[0].meal_time, status=DishRequest.COMPLETE
+        )
+        self.assertEqual(self.balance().completed_transactions, 3)
+        posts[1].delete()
+        request.status = DishRequest.CANCELLED
+        request.save()
+        self.assertEqual(self.balance().completed_transactions, 1)
+        # The live counter agrees with the backfill.
+        stdout = io.StringIO()
+        call_command("backfill_vip_counters", stdout=stdout)
+        self.assertIn("Rebuilt 0", stdout.getvalue())
+
+
+class SuspensionMiddlewareTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="dave")
+        self.info = SuspensionInfo.objects.create(user=self.user)
+        self.middleware = SuspensionMiddleware(None)
+
+    def process(self, path):
+        request = RequestFactory().get(path)
+        request.user = self.user
+        return self.middleware.process_view(request, None, (), {})
+
+    def test_cached_state_costs_no_queries(self):
+        self.assertIsNone(self.process("/dishes/posts/"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.process("/dishes/posts/"))
+
+    def test_suspend_and_unsuspend_take_effect_immediately(self):
+        self.process("/dishes/posts/")
+        self.info.suspend()
+        for _ in range(2):
+            self.assertEqual(self.process("/dishes/posts/").status_code, 302)
+        self.assertIsNone(self.process("/accounts/suspended/"))
+        self.assertIsNone(self.process("/logout/"))
+        self.info.unsuspend()
+        self.assertIsNone(self.process("/dishes/posts/"))
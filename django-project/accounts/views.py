@@ -6,6 +6,7 @@ from accounts.forms import (
     WithdrawalForm, RemoveSuspensionRequestForm
 )
 
+from accounts import ledger
 from accounts.models import *
 from dishes.models import *
 
@@ -85,7 +86,7 @@ def deposit(request):
         form = DepositForm(request.POST)
         if form.is_valid():
             amount = form.cleaned_data["amount"]
-            request.user.balance.credit(amount)
+            ledger.post([ledger.transfer(None, request.user, amount)])
             return redirect("account")
     else:
         form = DepositForm()
@@ -100,10 +101,10 @@ def withdraw(request):
         form = WithdrawalForm(request.POST)
         if form.is_valid():
             amount = form.cleaned_data["amount"]
-            if amount <= user.balance.amount:
-                user.balance.debit(amount)
+            try:
+                ledger.post([ledger.transfer(user, None, amount)])
                 return redirect("account")
-            else:
+            except ledger.InsufficientFunds:
                 overdrawn = True
     else:
         form = WithdrawalForm()
@@ -0,0 +1,301 @@
+"""
+Background classification of Dishes into the Watson taxonomy.
+
+Creating a Dish only enqueues a ClassificationTask. The classify_dishes
+management command drains the queue: it claims a batch of due tasks, runs the
+classifier on their names in a thread pool and writes the labels back.
+Failed tasks are retried with exponential backoff until they run out of
+attempts.
+
+Labels are cached by normalized dish name, first in an in-process LRU and
+then in the CachedLabel table, so a dish that was classified before is
+labelled as soon as it is created, without a call to the classifier. Only
+the labels of the worker's classifier are cached: an inline classifier is
+cheap to run again, and caching its guesses would keep serving them after a
+better classifier is configured. Empty labels are never cached, so a name
+no label was found for is classified again.
+
+The classifier is one of the backends in dishes.classifiers, or any callable
+that takes a dish name and returns its label, or an empty string if it has
+none. It raises an exception if the name could not be classified, in which
+case the task is retried. Classifiers cheap enough to run inline label a Dish
+as it is created, without going through the queue.
+"""
+import collections
+import datetime
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from dishes.models import CachedLabel, ClassificationTask, Dish
+
+# The classifier used when the DISH_CLASSIFIER setting is not set.
+DEFAULT_CLASSIFIER = "dishes.classifiers.WatsonClassifier"
+
+# The number of tasks claimed at once and the number of names classified
+# concurrently.
+BATCH_SIZE = 50
+THREADS = 8
+
+# How long in seconds a worker holds the tasks it claimed. Tasks held longer,
+# because the worker died, are picked up again.
+LEASE = 300
+
+# The number of attempts before a task is given up on, and the delay in
+# seconds before the first retry. The delay doubles with every failure.
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 30
+
+# The number of labels kept in the in-process LRU.
+LRU_SIZE = 1024
+
+# Runs of anything but letters and digits, which normalization collapses
+# into a single space.
+SEPARATORS = re.compile(r"[\W_]+")
+
+
+def stem(word):
+    """
+    Reduce a plural English word to its singular form, for the regular
+    plurals dish names use.
+    """
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize(name):
+    """
+    Return the cache key of a dish name. Names differing only in case,
+    whitespace, punctuation or regular plurals share a key, so "Fried
+    Chicken!" and "fried  chickens" are classified once.
+    """
+    words = SEPARATORS.sub(" ", name.lower()).split()
+    return " ".join(stem(word) for word in words)[:128]
+
+
+class LabelCache(object):
+    """
+    Two-level cache of labels keyed by normalized dish name: an in-process
+    LRU in front of the CachedLabel table.
+
+    The cache is shared by the worker threads, so the LRU is guarded by a
+    lock. The counters record where lookups were answered:
+
+    memory_hits:
+        Lookups answered by the LRU.
+
+    table_hits:
+        Lookups answered by the CachedLabel table.
+
+    misses:
+        Lookups neither could answer.
+    """
+    def __init__(self, size=LRU_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.labels = collections.OrderedDict()
+            self.memory_hits = 0
+            self.table_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "table_hits": self.table_hits,
+            "misses": self.misses,
+        }
+
+    def remember(self, key, label):
+        with self.lock:
+            self.labels[key] = label
+            self.labels.move_to_end(key)
+            while len(self.labels) > self.size:
+                self.labels.popitem(last=False)
+
+    def get_many(self, names):
+        """
+        Return the cached labels of the names that have one, keyed by name.
+        """
+        found = {}
+        missing = {}
+        with self.lock:
+            for name in names:
+                key = normalize(name)
+                if key in self.labels:
+                    self.labels.move_to_end(key)
+                    found[name] = self.labels[key]
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(name)
+        if missing:
+            rows = (CachedLabel.objects.filter(key__in=list(missing))
+                                       .exclude(label=""))
+            for key, label in rows.values_list("key", "label"):
+                self.remember(key, label)
+                for name in missing.pop(key):
+                    found[name] = label
+                    self.table_hits += 1
+            self.misses += sum(len(names) for names in missing.values())
+        return found
+
+    def get(self, name):
+        """
+        Return the cached label of a name, or None if it has none.
+        """
+        return self.get_many([name]).get(name)
+
+    def set_many(self, labels):
+        """
+        Cache the non-empty labels of the given names, a dict keyed by name.
+        """
+        keyed = dict((normalize(name), label)
+                     for name, label in labels.items() if label)
+        existing = set(CachedLabel.objects.filter(key__in=list(keyed))
+                                          .values_list("key", flat=True))
+        CachedLabel.objects.bulk_create(
+            CachedLabel(key=key, label=label)
+            for key, label in keyed.items() if key not in existing
+        )
+        for key, label in keyed.items():
+            self.remember(key, label)
+
+
+cache = LabelCache()
+
+
+# Classifier instances by dotted path, so each is only built once per process.
+_classifiers = {}
+
+
+def get_classifier(path=None):
+    """
+    Return the classifier at the dotted path, or the one named by the
+    DISH_CLASSIFIER setting. Paths naming a class are instantiated with no
+    arguments; any other callable is used as it is.
+    """
+    path = path or getattr(settings, "DISH_CLASSIFIER", DEFAULT_CLASSIFIER)
+    if path not in _classifiers:
+        classifier = import_string(path)
+        if isinstance(classifier, type):
+            classifier = classifier()
+        _classifiers[path] = classifier
+    return _classifiers[path]
+
+
+def enqueue(dish):
+    """
+    Label a Dish from the cache, or with the configured classifier if it
+    runs inline, or else queue it for classification by the worker. Labels
+    of an inline classifier are not cached.
+    """
+    label = cache.get(dish.name)
+    if label is None:
+        classifier = get_classifier()
+        if not getattr(classifier, "inline", False):
+            ClassificationTask.objects.get_or_create(dish=dish)
+            return
+        label = classifier(dish.name)
+    dish.alchemy_label = label
+    Dish.objects.filter(pk=dish.pk).update(alchemy_label=label)
+
+
+def claim(batch_size):
+    """
+    Claim up to batch_size due tasks and return them with their Dishes.
+
+    A task is claimed by pushing its next attempt past the lease with a
+    conditional UPDATE, so concurrent workers never claim the same task.
+    """
+    now = timezone.now()
+    due = (ClassificationTask.objects
+           .filter(next_attempt__lte=now, attempts__lt=MAX_ATTEMPTS)
+           .order_by("next_attempt")
+           .values_list("pk", flat=True)[:batch_size])
+    lease = now + datetime.timedelta(seconds=LEASE)
+    ids = list(due)
+    (ClassificationTask.objects.filter(pk__in=ids, next_attempt__lte=now)
+                               .update(next_attempt=lease))
+    return list(ClassificationTask.objects.select_related("dish")
+                                          .filter(pk__in=ids, next_attempt=lease))
+
+
+def process_batch(classify, batch_size=BATCH_SIZE, threads=THREADS):
+    """
+    Classify one batch of due tasks and return the number of tasks that
+    succeeded and failed.
+
+    Only the classifier runs in the thread pool; every database write
+    happens in the calling thread.
+    """
+    tasks = claim(batch_size)
+    if not tasks:
+        return 0, 0
+
+    # Names that were cached since they were queued are not classified
+    # again, and each distinct name in the batch is classified only once.
+    cached = cache.get_many(set(task.dish.name for task in tasks))
+    labels = dict((normalize(name), label) for name, label in cached.items())
+    names = {}
+    for task in tasks:
+        key = normalize(task.dish.name)
+        if key not in labels:
+            names.setdefault(key, task.dish.name)
+
+    def attempt(name):
+        try:
+            return classify(name), None
+        except Exception as error:
+            return None, error
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = dict(zip(names, executor.map(attempt, names.values())))
+
+    classified = {}
+    errors = {}
+    for key, (label, error) in results.items():
+        if error is None:
+            classified[names[key]] = label
+            labels[key] = label
+        else:
+            errors[key] = error
+
+    labelled = {}
+    failed = []
+    for task in tasks:
+        key = normalize(task.dish.name)
+        if key in labels:
+            labelled.setdefault(labels[key], []).append(task)
+        else:
+            failed.append((task, errors[key]))
+
+    now = timezone.now()
+    with transaction.atomic():
+        if not getattr(classify, "inline", False):
+            cache.set_many(classified)
+        for label, done in labelled.items():
+            (Dish.objects.filter(pk__in=[task.dish_id for task in done])
+                         .update(alchemy_label=label))
+        ClassificationTask.objects.filter(
+            pk__in=[task.pk for done in labelled.values() for task in done]
+        ).delete()
+        for task, error in failed:
+            delay = RETRY_BACKOFF * 2 ** task.attempts
+            task.attempts += 1
+            task.next_attempt = now + datetime.timedelta(seconds=delay)
+            task.last_error = repr(error)
+            task.save(update_fields=["attempts", "next_attempt", "last_error"])
+    return len(tasks) - len(failed), len(failed)
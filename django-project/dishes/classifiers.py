@@ -0,0 +1,145 @@
+"""
+Classifier backends for labelling Dishes with the Watson taxonomy.
+
+A backend is a callable that takes a dish name and returns its taxonomy
+label, or an empty string if it has none, and raises an exception if the
+name could not be classified. Backends whose inline attribute is set are
+cheap enough to run while the Dish is being created; the others are only run
+by the classify_dishes worker.
+
+The backend used by NGS is named by the DISH_CLASSIFIER setting and loaded by
+dishes.classification.get_classifier.
+"""
+import collections
+import math
+import threading
+
+from django.conf import settings
+
+from dishes.classification import normalize
+from dishes.models import CachedLabel, Dish
+
+
+class WatsonClassifier(object):
+    """
+    Classifier backed by the Watson AlchemyLanguage taxonomy service.
+
+    Importing the Watson SDK is slow, so neither the SDK nor the client is
+    loaded until the first name is classified. Processes that never classify
+    with Watson, such as web workers that only enqueue, never pay for it.
+    """
+    inline = False
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from watson_developer_cloud import AlchemyLanguageV1
+                    self._client = AlchemyLanguageV1(
+                        api_key=self.api_key or getattr(settings, "APIKEY", None)
+                    )
+        return self._client
+
+    def __call__(self, name):
+        classification = self.client.taxonomy(text=name)
+        if classification["taxonomy"]:
+            return classification["taxonomy"][0]["label"]
+        return ""
+
+
+def features(name):
+    """
+    Return the features of a dish name: the words of its normalized form
+    and the character trigrams of each word, which let misspelt and unseen
+    variants of known words still count.
+    """
+    result = []
+    for word in normalize(name).split():
+        result.append(word)
+        padded = "^{}$".format(word)
+        result.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def training_examples():
+    """
+    Return (name, label) pairs for every labelled Dish and cached label.
+    """
+    examples = list(Dish.objects.exclude(alchemy_label="")
+                                .values_list("name", "alchemy_label"))
+    examples.extend(CachedLabel.objects.exclude(label="")
+                                       .values_list("key", "label"))
+    return examples
+
+
+class LocalClassifier(object):
+    """
+    Offline classifier: a multinomial naive Bayes model over the features of
+    labelled dish names.
+
+    The model is stored as a sparse index from feature to the labels it was
+    seen with. Every label starts from its score for a name made only of
+    unseen features, and each feature of the name adjusts the scores of just
+    the labels in its index entry, so classifying costs one dictionary
+    lookup per feature rather than one per feature and label.
+
+    Attributes:
+
+    labels:
+        The labels the model can predict.
+
+    index:
+        Maps each feature to a list of (label number, adjustment) pairs.
+    """
+    inline = True
+
+    # Laplace smoothing of the feature counts.
+    ALPHA = 1.0
+
+    def __init__(self, examples=None):
+        self.fit(training_examples() if examples is None else examples)
+
+    def fit(self, examples):
+        label_counts = collections.Counter()
+        feature_counts = collections.defaultdict(collections.Counter)
+        for name, label in examples:
+            label_counts[label] += 1
+            feature_counts[label].update(features(name))
+
+        self.labels = sorted(label_counts)
+        vocabulary = set()
+        for counts in feature_counts.values():
+            vocabulary.update(counts)
+        total = sum(label_counts.values())
+
+        self.priors = []
+        self.unseen = []
+        index = collections.defaultdict(list)
+        for i, label in enumerate(self.labels):
+            counts = feature_counts[label]
+            denominator = sum(counts.values()) + self.ALPHA * len(vocabulary)
+            unseen = math.log(self.ALPHA / denominator)
+            self.priors.append(math.log(label_counts[label] / total))
+            self.unseen.append(unseen)
+            for feature, count in counts.items():
+                seen = math.log((count + self.ALPHA) / denominator)
+                index[feature].append((i, seen - unseen))
+        self.index = dict(index)
+
+    def __call__(self, name):
+        known = [self.index[f] for f in features(name) if f in self.index]
+        if not known:
+            return ""
+        nfeatures = len(known)
+        scores = [prior + nfeatures * unseen
+                  for prior, unseen in zip(self.priors, self.unseen)]
+        for entries in known:
+            for i, adjustment in entries:
+                scores[i] += adjustment
+        return self.labels[max(range(len(scores)), key=scores.__getitem__)]
@@ -0,0 +1,163 @@
+"""
+Feeds of the new Dish Posts of the Chefs a Diner follows.
+
+Creating a Dish Post only enqueues a FanOutTask. The fanout_feeds management
+command drains the queue: for every claimed task it walks the followers of
+the Chef in order of Diner id, CHUNK_SIZE at a time, and bulk inserts a
+FeedItem for each, recording how far it got after every chunk. Posting
+costs one INSERT however many followers the Chef has, and a worker that dies
+mid-task resumes after the last chunk it wrote.
+
+Copying a post into every feed does not pay off for Chefs with many
+followers, so a Chef posting with more than FANOUT_CUTOFF followers is
+marked fan_out_on_read and their posts are not copied at all. A feed is
+read by merging the Diner's FeedItems with the Dish Posts of the followed
+Chefs so marked, newest first, each read through an index and limited to a
+page, so a page costs the same however large the feed and the Chefs are.
+"""
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from dishes import pagination
+from dishes.models import Chef, DishPost, FanOutTask, FeedItem
+
+# The most followers a Chef can post to with fan-out on write.
+FANOUT_CUTOFF = 5000
+
+# The number of tasks claimed at once, and the number of followers a task
+# reaches per transaction.
+BATCH_SIZE = 10
+CHUNK_SIZE = 1000
+
+# Keeps each INSERT of FeedItems under SQLite's parameter limit.
+INSERT_SIZE = 400
+
+# How long in seconds a worker holds the tasks it claimed. Tasks held longer,
+# because the worker died, are picked up again.
+LEASE = 300
+
+# The ordering of a feed, newest Dish Post first.
+ORDERING = ("-id",)
+
+
+def enqueue(dish_post, cutoff=FANOUT_CUTOFF):
+    """
+    Queue a new Dish Post for fan-out to the followers of its Chef, unless
+    the Chef is fan_out_on_read or is marked so for having more than cutoff
+    followers.
+    """
+    chef = dish_post.chef
+    if chef is None or chef.fan_out_on_read:
+        return
+    if chef.follower_count > cutoff:
+        Chef.objects.filter(pk=chef.pk).update(fan_out_on_read=True)
+        chef.fan_out_on_read = True
+    elif chef.follower_count:
+        FanOutTask.objects.get_or_create(dish_post=dish_post)
+
+
+def claim(batch_size):
+    """
+    Claim up to batch_size due tasks and return them with their Dish Posts.
+
+    A task is claimed by pushing its next attempt past the lease with a
+    conditional UPDATE, so concurrent workers never claim the same task.
+    """
+    now = timezone.now()
+    due = (FanOutTask.objects.filter(next_attempt__lte=now)
+                             .order_by("next_attempt")
+                             .values_list("pk", flat=True)[:batch_size])
+    lease = now + datetime.timedelta(seconds=LEASE)
+    ids = list(due)
+    FanOutTask.objects.filter(pk__in=ids, next_attempt__lte=now).update(
+        next_attempt=lease
+    )
+    return list(FanOutTask.objects.select_related("dish_post")
+                                  .filter(pk__in=ids, next_attempt=lease)
+                                  .order_by("pk"))
+
+
+def fan_out(task, chunk_size=CHUNK_SIZE):
+    """
+    Copy the Dish Post of a claimed task into the feeds of the followers it
+    has not reached, a chunk at a time, and delete the task. Return the
+    number of FeedItems inserted.
+
+    The lease is renewed before each chunk with a conditional UPDATE. A
+    worker that held the task past its lease, so that another worker claimed
+    it again, stops instead of inserting the chunk the other one resumes
+    from.
+    """
+    followers = Chef.followers.through.objects.filter(
+        chef_id=task.dish_post.chef_id
+    ).order_by("diner_id").values_list("diner_id", flat=True)
+    inserted = 0
+    while True:
+        with transaction.atomic():
+            lease = timezone.now() + datetime.timedelta(seconds=LEASE)
+            renewed = FanOutTask.objects.filter(
+                pk=task.pk, next_attempt=task.next_attempt
+            ).update(next_attempt=lease)
+            if not renewed:
+                return inserted
+            task.next_attempt = lease
+            diner_ids = list(followers.filter(diner_id__gt=task.next_follower)
+                             [:chunk_size])
+            FeedItem.objects.bulk_create(
+                [FeedItem(diner_id=diner_id, dish_post_id=task.dish_post_id)
+                 for diner_id in diner_ids],
+                batch_size=INSERT_SIZE
+            )
+            inserted += len(diner_ids)
+            if len(diner_ids) < chunk_size:
+                task.delete()
+                return inserted
+            task.next_follower = diner_ids[-1]
+            task.save(update_fields=["next_follower"])
+
+
+def process_batch(batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Fan out one batch of due tasks and return the number of tasks and of
+    FeedItems inserted.
+    """
+    tasks = claim(batch_size)
+    inserted = 0
+    for task in tasks:
+        inserted += fan_out(task, chunk_size)
+    return len(tasks), inserted
+
+
+def page(diner, cursor, per_page):
+    """
+    Return the KeysetPage of the Dish Posts in the Diner's feed, newest
+    first, that starts after cursor, or the first page if cursor is None or
+    malformed.
+    """
+    pushed = FeedItem.objects.filter(diner=diner).order_by("-dish_post")
+    # The followees are read from the followers table by Diner, through its
+    # (diner_id, chef_id) index, rather than by joining from Chef.
+    followees = Chef.followers.through.objects.filter(diner_id=diner.pk)
+    chef_ids = list(Chef.objects.filter(pk__in=followees.values("chef_id"),
+                                        fan_out_on_read=True)
+                                .values_list("pk", flat=True))
+    pulled = DishPost.objects.filter(chef__in=chef_ids).order_by(*ORDERING)
+    values = pagination.position(DishPost, ORDERING, cursor)
+    if values is not None:
+        pushed = pushed.filter(dish_post__lt=values[0])
+        pulled = pulled.filter(pagination.after(ORDERING, values))
+
+    # Each source holds at most the page and the first post of the next.
+    ids = set(pushed.values_list("dish_post", flat=True)[:per_page + 1])
+    if chef_ids:
+        ids.update(pulled.values_list("pk", flat=True)[:per_page + 1])
+    ids = sorted(ids, reverse=True)
+    next_cursor = None
+    if len(ids) > per_page:
+        ids = ids[:per_page]
+        next_cursor = pagination.encode_cursor(ids[-1:])
+    posts = DishPost.objects.select_related("dish", "chef").in_bulk(ids)
+    return pagination.KeysetPage([posts[pk] for pk in ids if pk in posts],
+                                 next_cursor)
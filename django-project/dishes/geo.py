@@ -0,0 +1,179 @@
+"""
+Geographic helpers for locating Dish Posts on the map.
+
+Locations are indexed with geohashes. A geohash interleaves the bits of the
+latitude and longitude and encodes them in base 32, so every prefix of a
+geohash names a rectangular cell that contains all of the longer hashes
+sharing that prefix. That lets us answer "what is inside this box" with a few
+range scans over an ordinary B-tree index instead of scanning the table.
+"""
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# 9 characters resolve a point to a cell of roughly 5m x 5m.
+PRECISION = 9
+
+# The mean radius of the Earth in kilometres.
+EARTH_RADIUS = 6371.0088
+
+# The length in kilometres of a degree of latitude.
+KM_PER_DEGREE = math.radians(EARTH_RADIUS)
+
+# Sorts after every character of the geohash alphabet. Appending it to a cell
+# prefix gives the exclusive upper bound of the range holding that cell.
+UPPER_BOUND = "~"
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """
+    Return the geohash of the point (latitude, longitude).
+    """
+    latitude = float(latitude)
+    longitude = float(longitude)
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    nbits = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lng_lo = mid
+            else:
+                bits = bits << 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_lo = mid
+            else:
+                bits = bits << 1
+                lat_hi = mid
+        even = not even
+        nbits += 1
+        if nbits == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            nbits = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """
+    Return the (height, width) in degrees of a geohash cell of the given
+    precision.
+    """
+    nbits = 5 * precision
+    lng_bits = (nbits + 1) // 2
+    lat_bits = nbits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def _cell_span(lo, hi, size, origin, ncells):
+    first = int((lo - origin) // size)
+    last = int((hi - origin) // size)
+    return max(first, 0), min(last, ncells - 1)
+
+
+def split_antimeridian(south, west, north, east):
+    """
+    Return the bounding box as a list of boxes that do not cross the
+    antimeridian.
+    """
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def covering_cells(south, west, north, east, max_cells=32):
+    """
+    Return a list of geohash prefixes whose cells together cover the bounding
+    box.
+
+    The longest prefixes are chosen such that no more than max_cells are
+    needed, which keeps the number of index range scans bounded no matter how
+    far the map is zoomed out.
+    """
+    south, north = max(south, -90.0), min(north, 90.0)
+    boxes = split_antimeridian(south, west, north, east)
+    for precision in range(PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        nrows = int(round(180.0 / height))
+        ncols = int(round(360.0 / width))
+        spans = []
+        count = 0
+        for s, w, n, e in boxes:
+            rows = _cell_span(s, n, height, -90.0, nrows)
+            cols = _cell_span(w, e, width, -180.0, ncols)
+            spans.append((rows, cols))
+            count += (rows[1] - rows[0] + 1) * (cols[1] - cols[0] + 1)
+        if count > max_cells:
+            continue
+        cells = set()
+        for (row_lo, row_hi), (col_lo, col_hi) in spans:
+            for row in range(row_lo, row_hi + 1):
+                lat = -90.0 + (row + 0.5) * height
+                for col in range(col_lo, col_hi + 1):
+                    lng = -180.0 + (col + 0.5) * width
+                    cells.add(encode(lat, lng, precision))
+        return sorted(cells)
+    # The box is larger than the coarsest cells allow; scan everything.
+    return [""]
+
+
+def cluster_precision(south, west, north, east, grid=8):
+    """
+    Return the geohash precision at which the bounding box is divided into
+    roughly grid x grid cells. Markers sharing a prefix of this length are
+    drawn as a single cluster.
+    """
+    boxes = split_antimeridian(south, west, north, east)
+    span = max(max(n - s, e - w) for s, w, n, e in boxes)
+    for precision in range(PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if max(height, width) * grid >= span:
+            return precision
+    return 1
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Return the great-circle distance in kilometres between two points, by
+    the haversine formula.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (float(lat1), float(lng1),
+                                                float(lat2), float(lng2)))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Return the (south, west, north, east) bounding box of the circle of
+    radius kilometres around the point. Every point within radius of the
+    point lies inside the box.
+
+    The box may cross the antimeridian, in which case west is greater than
+    east, and it spans every longitude when the circle reaches a pole.
+    """
+    latitude = float(latitude)
+    longitude = float(longitude)
+    delta_lat = math.degrees(radius / EARTH_RADIUS)
+    south = latitude - delta_lat
+    north = latitude + delta_lat
+    if south <= -90.0 or north >= 90.0:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    # The widest longitude span of the circle, reached at its tangent points.
+    delta_lng = math.degrees(math.asin(min(1.0, math.sin(radius / EARTH_RADIUS) /
+                                           math.cos(math.radians(latitude)))))
+    if delta_lng >= 180.0:
+        return south, -180.0, north, 180.0
+    west = (longitude - delta_lng + 180.0) % 360.0 - 180.0
+    east = (longitude + delta_lng + 180.0) % 360.0 - 180.0
+    return south, west, north, east
@@ -0,0 +1,123 @@
+"""
+Lifecycle transitions of Dish Posts, Dish Requests and Orders whose times
+have passed.
+
+Each transition selects a bounded batch of the rows it moves through the
+(status, time) index of their table and moves them with one conditional
+UPDATE, so a batch holds its locks briefly and a row changed by a user in
+the meantime is left alone. A tick runs batches until no row is due.
+
+The transitions are:
+
+Dish Posts past their last call:
+    Posts with reserved servings wait for feedback, posts nobody ordered are
+    cancelled, and the pending Bids of both are rejected. The posts are
+    locked first and dish_post_statuses_changed is sent for them, so the
+    post counters of their Chefs follow.
+
+Orders past their Dish Post's meal time:
+    Open Orders wait for feedback.
+
+Dish Requests past their meal time:
+    Open Requests nobody accepted are cancelled and their pending Offers
+    rejected.
+"""
+import collections
+
+from django.db import transaction
+from django.utils import timezone
+
+from dishes.models import (
+    Bid, DishPost, DishRequest, Offer, Order, dish_post_statuses_changed
+)
+
+# The most rows a single UPDATE moves. Keeps the pk lists under SQLite's
+# parameter limit.
+BATCH_SIZE = 500
+
+
+def expire_posts(now, batch_size=BATCH_SIZE):
+    """
+    Close one batch of open Dish Posts past their last call and reject their
+    pending Bids. Return the number of posts closed and Bids rejected.
+    """
+    due = DishPost.objects.filter(status=DishPost.OPEN, last_call__lte=now)
+    ids = list(due.values_list("pk", flat=True)[:batch_size])
+    if not ids:
+        return 0, 0
+    with transaction.atomic():
+        rows = list(due.filter(pk__in=ids)
+                       .select_for_update()
+                       .values_list("pk", "chef_id", "servings_reserved"))
+        changes = collections.Counter()
+        for pk, chef_id, servings_reserved in rows:
+            status = (DishPost.PENDING_FEEDBACK if servings_reserved > 0 else
+                      DishPost.CANCELLED)
+            changes[chef_id, DishPost.OPEN, status] += 1
+        batch = due.filter(pk__in=[row[0] for row in rows])
+        closed = batch.filter(servings_reserved__gt=0).update(
+            status=DishPost.PENDING_FEEDBACK,
+            modified=now
+        )
+        closed += batch.filter(servings_reserved__lte=0).update(
+            status=DishPost.CANCELLED,
+            modified=now
+        )
+        dish_post_statuses_changed.send(sender=DishPost, changes=changes)
+        rejected = (Bid.objects.filter(dish_post__in=ids, status=Bid.PENDING)
+                               .exclude(dish_post__status=DishPost.OPEN)
+                               .update(status=Bid.REJECTED))
+    return closed, rejected
+
+
+def serve_orders(now, batch_size=BATCH_SIZE):
+    """
+    Move one batch of open Orders past their Dish Post's meal time to pending
+    feedback. Return the number of Orders moved.
+    """
+    due = Order.objects.filter(status=Order.OPEN, dish_post__meal_time__lte=now)
+    ids = list(due.values_list("pk", flat=True)[:batch_size])
+    if not ids:
+        return 0
+    return (Order.objects.filter(pk__in=ids, status=Order.OPEN)
+                         .update(status=Order.PENDING_FEEDBACK))
+
+
+def expire_requests(now, batch_size=BATCH_SIZE):
+    """
+    Cancel one batch of open Dish Requests past their meal time and reject
+    their pending Offers. Return the number of Requests cancelled and Offers
+    rejected.
+    """
+    due = DishRequest.objects.filter(status=DishRequest.OPEN,
+                                     meal_time__lte=now)
+    ids = list(due.values_list("pk", flat=True)[:batch_size])
+    if not ids:
+        return 0, 0
+    with transaction.atomic():
+        cancelled = due.filter(pk__in=ids).update(
+            status=DishRequest.CANCELLED,
+            modified=now
+        )
+        rejected = (Offer.objects.filter(dish_request__in=ids,
+                                         status=Offer.PENDING)
+                                 .exclude(dish_request__status=DishRequest.OPEN)
+                                 .update(status=Offer.REJECTED))
+    return cancelled, rejected
+
+
+def tick(now=None, batch_size=BATCH_SIZE):
+    """
+    Run every transition until no row is due at now, which defaults to the
+    current time. Return a Counter of the rows moved by each transition.
+    """
+    now = now or timezone.now()
+    moved = collections.Counter()
+    while True:
+        posts, bids = expire_posts(now, batch_size)
+        orders = serve_orders(now, batch_size)
+        requests, offers = expire_requests(now, batch_size)
+        moved.update({"posts": posts, "bids": bids, "orders": orders,
+                      "requests": requests, "offers": offers})
+        if not posts + orders + requests:
+            return moved
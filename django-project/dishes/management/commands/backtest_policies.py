@@ -0,0 +1,141 @@
+"""
+Management command that backtests the suspension and red flag rules.
+
+The whole history of Ratings, Complaints and approved Remove Suspension
+Requests is read in date order, a chunk at a time, and applied to a
+dishes.policies.Simulator with the thresholds given on the command line.
+Every user the rules would have suspended, forced out or flagged is
+reported with when it would have happened, next to the number of times the
+user has actually been suspended. Nothing is written.
+
+Remove Suspension Requests decided before their decision dates were
+recorded cannot be placed in the history, so users unsuspended by them stay
+suspended in the replay.
+"""
+import collections
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import Complaint, RemoveSuspensionRequest, SuspensionInfo
+from dishes import pagination, policies, redflags
+from dishes.models import Rating, RatingSummary
+
+CHUNK_SIZE = 10000
+
+# Keeps the user id list of each query under SQLite's parameter limit.
+BATCH_SIZE = 500
+
+# The thresholds of the Simulator, with their defaults and help.
+THRESHOLDS = [
+    ("low_rating", int, RatingSummary.LOW_RATING,
+     "The highest score of a low Rating."),
+    ("suspension_low_ratings", int, policies.SUSPENSION_LOW_RATINGS,
+     "The unstruck low Ratings that suspend a user."),
+    ("suspension_min_ratings", int, policies.SUSPENSION_MIN_RATINGS,
+     "The Ratings a user needs before their average can suspend them."),
+    ("min_average", float, policies.MIN_AVERAGE,
+     "The lowest average Rating that does not suspend a user."),
+    ("max_average", float, policies.MAX_AVERAGE,
+     "The highest average Rating that does not suspend a user."),
+    ("force_quit_suspensions", int, policies.FORCE_QUIT_SUSPENSIONS,
+     "The suspensions that force a user out."),
+    ("window", int, redflags.WINDOW,
+     "The latest Ratings the generous rule looks at."),
+    ("critical_ratings", int, redflags.CRITICAL_RATINGS,
+     "The lowest Ratings that trip the critical rule."),
+    ("critical_complaints", int, redflags.CRITICAL_COMPLAINTS,
+     "The Complaints that trip the critical rule."),
+]
+
+
+def counted(rows, counter, key):
+    for row in rows:
+        counter[key] += 1
+        yield row
+
+
+def describe(dates):
+    """
+    Describe the outcomes of a user, given the dates of each kind.
+    """
+    parts = []
+    for kind in (policies.SUSPENDED, policies.FORCED_OUT, policies.CRITICAL,
+                 policies.GENEROUS):
+        if dates[kind]:
+            parts.append("{} {} times, first on {:%Y-%m-%d %H:%M}"
+                         .format(kind, len(dates[kind]), dates[kind][0]))
+    return ", ".join(parts)
+
+
+class Command(BaseCommand):
+    help = "Replay the history through the suspension and red flag rules."
+
+    def add_arguments(self, parser):
+        for name, type_, default, help_ in THRESHOLDS:
+            parser.add_argument("--" + name.replace("_", "-"),
+                                type=type_,
+                                default=default,
+                                help=help_)
+        parser.add_argument("--chunk-size",
+                            type=int,
+                            default=CHUNK_SIZE,
+                            help="The most rows read by one query.")
+
+    def handle(self, *args, **options):
+        simulator = policies.Simulator(**dict((name, options[name])
+                                              for name, _, _, _ in THRESHOLDS))
+        chunk_size = options["chunk_size"]
+        ratings = pagination.iterate(Rating.objects.all(), ("date", "pk"),
+                                     ("date", "rater_id", "ratee_id", "pk",
+                                      "rating"),
+                                     chunk_size)
+        complaints = pagination.iterate(Complaint.objects.all(), ("date", "pk"),
+                                        ("date", "complainant_id"),
+                                        chunk_size)
+        approved = RemoveSuspensionRequest.objects.filter(
+            status=RemoveSuspensionRequest.APPROVED,
+            decided__isnull=False
+        )
+        unsuspensions = pagination.iterate(approved, ("decided", "pk"),
+                                           ("decided", "user_id"), chunk_size)
+
+        replayed = collections.Counter()
+        start = time.monotonic()
+        outcomes = collections.defaultdict(list)
+        for outcome in simulator.replay(counted(ratings, replayed, "ratings"),
+                                        counted(complaints, replayed,
+                                                "complaints"),
+                                        unsuspensions):
+            outcomes[outcome.user_id].append(outcome)
+            if options["verbosity"] > 1:
+                self.stdout.write("{:%Y-%m-%d %H:%M} user {}: {}"
+                                  .format(outcome.date, outcome.user_id,
+                                          outcome.kind))
+        elapsed = time.monotonic() - start
+
+        if options["verbosity"] > 0:
+            user_ids = list(outcomes)
+            live = {}
+            for i in range(0, len(user_ids), BATCH_SIZE):
+                live.update(SuspensionInfo.objects
+                                          .filter(user__in=user_ids[i:i + BATCH_SIZE])
+                                          .values_list("user", "count"))
+            totals = collections.Counter()
+            for user_id in sorted(outcomes):
+                dates = collections.defaultdict(list)
+                for outcome in outcomes[user_id]:
+                    dates[outcome.kind].append(outcome.date)
+                    totals[outcome.kind] += 1
+                self.stdout.write("User {}: {}; suspended {} times live."
+                                  .format(user_id, describe(dates),
+                                          live.get(user_id, 0)))
+            self.stdout.write(
+                "Replayed {} Ratings and {} Complaints in {:.1f} s: {} "
+                "suspensions, {} forced out, {} critical and {} generous "
+                "flags on {} users."
+                .format(replayed["ratings"], replayed["complaints"], elapsed,
+                        totals[policies.SUSPENDED], totals[policies.FORCED_OUT],
+                        totals[policies.CRITICAL], totals[policies.GENEROUS],
+                        len(outcomes))
+            )
@@ -0,0 +1,91 @@
+"""
+Management command that checks the counters of every Chef against the rows
+they count.
+
+The followers, open and complete Dish Posts and received Ratings of the
+Chefs are counted with one grouped query each and compared with the
+counters on Chef. Every Chef that disagrees is reported and the command
+exits with an error. With --fix the counters are instead rewritten from the
+counts.
+"""
+import collections
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from dishes.models import Chef, DishPost, Rating
+
+# Keeps the pk list of each UPDATE under SQLite's parameter limit.
+BATCH_SIZE = 500
+
+
+def count_posts(status):
+    return dict(DishPost.objects.filter(status=status, chef__isnull=False)
+                                .values_list("chef")
+                                .annotate(count=Count("pk"))
+                                .order_by())
+
+
+class Command(BaseCommand):
+    help = "Check the follower, post and rating counters of every Chef."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix",
+                            action="store_true",
+                            help="Rewrite mismatched counters from the counts.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            followers = dict(Chef.followers.through.objects
+                                 .values_list("chef")
+                                 .annotate(count=Count("pk"))
+                                 .order_by())
+            open_posts = count_posts(DishPost.OPEN)
+            completed_posts = count_posts(DishPost.COMPLETE)
+            ratings = dict((chef_id, (count, total)) for chef_id, count, total in
+                           Rating.objects.filter(ratee__chef__isnull=False)
+                                         .values_list("ratee__chef")
+                                         .annotate(count=Count("pk"),
+                                                   total=Sum("rating"))
+                                         .order_by())
+
+            mismatched = []
+            for row in Chef.objects.values_list("pk", *Chef.COUNTERS).iterator():
+                chef_id, actual = row[0], row[1:]
+                expected = ((followers.get(chef_id, 0),
+                             open_posts.get(chef_id, 0),
+                             completed_posts.get(chef_id, 0)) +
+                            ratings.get(chef_id, (0, 0)))
+                if actual != expected:
+                    mismatched.append((chef_id, actual, expected))
+
+            if options["verbosity"] > 0:
+                for chef_id, actual, expected in mismatched:
+                    wrong = ["{} is {}, should be {}".format(name, a, e)
+                             for name, a, e in zip(Chef.COUNTERS, actual,
+                                                   expected)
+                             if a != e]
+                    self.stdout.write("Chef {}: {}".format(chef_id,
+                                                           ", ".join(wrong)))
+
+            if not options["fix"]:
+                if mismatched:
+                    raise CommandError("{} Chefs have wrong counters."
+                                       .format(len(mismatched)))
+                if options["verbosity"] > 0:
+                    self.stdout.write("All Chef counters are correct.")
+                return
+
+            # Chefs that need the same counters are rewritten together.
+            chefs = collections.defaultdict(list)
+            for chef_id, actual, expected in mismatched:
+                chefs[expected].append(chef_id)
+            for expected, chef_ids in chefs.items():
+                for i in range(0, len(chef_ids), BATCH_SIZE):
+                    Chef.objects.filter(pk__in=chef_ids[i:i + BATCH_SIZE]).update(
+                        **dict(zip(Chef.COUNTERS, expected))
+                    )
+            if options["verbosity"] > 0:
+                self.stdout.write("Rewrote the counters of {} Chefs."
+                                  .format(len(mismatched)))
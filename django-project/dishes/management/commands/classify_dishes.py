@@ -0,0 +1,59 @@
+"""
+Management command that runs the background Dish classification worker.
+
+The worker drains the ClassificationTask queue in batches, classifying the
+names of each batch concurrently in a thread pool. It polls for new tasks
+until it is interrupted, or with --once stops as soon as no task is due.
+
+The classifier defaults to the DISH_CLASSIFIER setting, but any callable can
+be given by its dotted path, so the worker can be run against a local stub
+instead of the Watson service.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from dishes import classification
+
+
+class Command(BaseCommand):
+    help = "Classify queued Dishes in the background."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--classifier",
+                            help="Dotted path of the classifier; defaults to "
+                                 "the DISH_CLASSIFIER setting.")
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=classification.BATCH_SIZE,
+                            help="The number of tasks claimed at once.")
+        parser.add_argument("--threads",
+                            type=int,
+                            default=classification.THREADS,
+                            help="The number of names classified concurrently.")
+        parser.add_argument("--poll",
+                            type=float,
+                            default=5.0,
+                            help="Seconds to wait when no task is due.")
+        parser.add_argument("--once",
+                            action="store_true",
+                            help="Stop once no task is due.")
+
+    def handle(self, *args, **options):
+        classify = classification.get_classifier(options["classifier"])
+        while True:
+            succeeded, failed = classification.process_batch(
+                classify,
+                batch_size=options["batch_size"],
+                threads=options["threads"]
+            )
+            if options["verbosity"] > 1 and succeeded + failed:
+                self.stdout.write("Classified {} Dishes, {} failed. "
+                                  "Cache: {memory_hits} memory hits, "
+                                  "{table_hits} table hits, {misses} misses."
+                                  .format(succeeded, failed,
+                                          **classification.cache.stats()))
+            if not succeeded + failed:
+                if options["once"]:
+                    return
+                time.sleep(options["poll"])
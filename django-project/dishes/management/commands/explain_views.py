@@ -0,0 +1,213 @@
+"""
+Management command that flags full table scans in the queries of the list
+views.
+
+Each list page is rendered for a user with the queries it runs captured, and
+every SELECT is run again through EXPLAIN QUERY PLAN. Two kinds of plan step
+are reported, along with the view and the query:
+
+full scans:
+    The step walks a whole table, or a whole index, instead of searching an
+    index for the rows it needs.
+
+partial searches:
+    The step searches an index that covers only some of the columns the
+    query compares to a constant, such as the index of an owner foreign key
+    for a query that also filters on status. Every row of the owner is read
+    and the rest of the filter is applied to each, so the step slows down as
+    the owner's rows pile up. A composite index fixes it.
+
+The command exits with an error when any step is reported, so it can guard
+the indexes of the tables that grow with use. The plans are made with
+seeded statistics that describe every table as large (see seed_statistics),
+so the verdict is the same on a database of a few rows as on a grown one.
+
+The pages are rendered for --username, or else for the first user who is
+both a Chef and a Diner. Only SQLite plans can be read.
+"""
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+# A plan step that reads a table, with the columns of the index it searches.
+PLAN_STEP = re.compile(r"^(SCAN|SEARCH) (?:TABLE )?(\w+)(?: AS (\w+))?"
+                       r"(?: USING (?:COVERING )?INDEX \w+ \((.*)\))?")
+
+# A column of a table compared to a constant (not to another column).
+EQUALITY = r'"{}"\."(\w+)" (?:= |IN \()(?!")'
+
+# Tables with a fixed handful of rows, where a scan is as cheap as a search.
+SMALL_TABLES = {"django_content_type", "dishes_cuisinetag"}
+
+# The statistics the plans are made with: every table holds ROWS rows, and
+# each column of an index narrows the rows matching its prefix NARROWING-fold.
+ROWS = 1000000
+NARROWING = 100
+
+
+def pages(user):
+    """
+    Return the paths of the list pages to render for the user.
+    """
+    chef = user.chef
+    diner = user.diner
+    dish_post = chef.dishpost_set.order_by("pk").first()
+    dish_request = diner.dishrequest_set.order_by("pk").first()
+    paths = [
+        "/dishes/posts/",
+        "/dishes/posts/feed/",
+        "/dishes/posts/following/",
+        "/dishes/posts/manage/",
+        "/dishes/requests/",
+        "/dishes/requests/feed/",
+        "/dishes/requests/manage/",
+        "/dishes/orders-requests/",
+        "/dishes/orders-requests/history/",
+        "/dishes/chefs/{}/".format(chef.pk),
+        "/dishes/chefs/{}/history/".format(chef.pk),
+        "/dishes/dish_suggestions/",
+        "/accounts/",
+    ]
+    if dish_post is not None:
+        paths.append("/dishes/posts/manage/{}/".format(dish_post.pk))
+    if dish_request is not None:
+        paths.append("/dishes/requests/{}/offers/".format(dish_request.pk))
+    return paths
+
+
+def seed_statistics():
+    """
+    Replace the planner's statistics with ones describing large tables.
+
+    Without them the plans depend on whether and when the database was
+    ANALYZEd, and a database of a few rows can be read as cheaply by a scan
+    as by a search. Each index is described as narrowing the rows with
+    every column it has, down to a single row at the end of a unique index,
+    so the planner picks the index matching the most filtered columns.
+    """
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        # Only ANALYZE creates the statistics table, so a small table is
+        # analyzed in case the database never was.
+        cursor.execute("ANALYZE django_content_type")
+        cursor.execute("DELETE FROM sqlite_stat1")
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                       "AND name NOT LIKE 'sqlite_%'")
+        for table in [row[0] for row in cursor.fetchall()]:
+            cursor.execute("INSERT INTO sqlite_stat1 VALUES (%s, NULL, %s)",
+                           [table, str(ROWS)])
+            cursor.execute("PRAGMA index_list({})".format(quote(table)))
+            for index in cursor.fetchall():
+                name, unique = index[1], index[2]
+                cursor.execute("PRAGMA index_info({})".format(quote(name)))
+                columns = len(cursor.fetchall())
+                per_key = [max(1, ROWS // NARROWING ** (i + 1))
+                           for i in range(columns)]
+                if unique:
+                    per_key[-1] = 1
+                cursor.execute(
+                    "INSERT INTO sqlite_stat1 VALUES (%s, %s, %s)",
+                    [table, name, " ".join(map(str, [ROWS] + per_key))]
+                )
+        # Loads the statistics into the planner.
+        cursor.execute("ANALYZE sqlite_master")
+
+
+def explain(sql):
+    """
+    Return the detail column of each step of the plan of the query.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def problems(sql):
+    """
+    Return a description of each plan step of the query that is a full scan
+    or a partial search.
+    """
+    found = []
+    for step in explain(sql):
+        match = PLAN_STEP.match(step)
+        if not match or " PRIMARY KEY " in step:
+            continue
+        kind, table, alias, constraint = match.groups()
+        if table in SMALL_TABLES:
+            continue
+        if kind == "SCAN":
+            found.append("full scan: " + step)
+            continue
+        searched = set(re.findall(r"(\w+)[=<>]", constraint or ""))
+        filtered = set(re.findall(EQUALITY.format(alias or table), sql))
+        if filtered - searched:
+            found.append("partial search, also filtering on {}: {}"
+                         .format(", ".join(sorted(filtered - searched)), step))
+    return found
+
+
+class Command(BaseCommand):
+    help = "Flag list view queries that scan more rows than they need."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--username",
+                            help="The user to render the pages for.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Only SQLite query plans are supported.")
+        users = User.objects.filter(chef__isnull=False, diner__isnull=False)
+        if options["username"]:
+            users = users.filter(username=options["username"])
+        user = users.order_by("pk").first()
+        if user is None:
+            raise CommandError("No user who is both a Chef and a Diner found.")
+
+        try:
+            # The seeded statistics, and any rows the views write, are
+            # rolled back once the plans are read.
+            with transaction.atomic():
+                seed_statistics()
+                flagged = self.check_pages(user, options["verbosity"])
+                transaction.set_rollback(True)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE sqlite_master")
+
+        if flagged:
+            raise CommandError("{} queries scan more rows than they need."
+                               .format(flagged))
+
+    def check_pages(self, user, verbosity):
+        """
+        Render the list pages for the user, report the plan steps of their
+        queries that read more rows than needed and return the number of
+        queries reported.
+        """
+        factory = RequestFactory()
+        flagged = 0
+        for path in pages(user):
+            request = factory.get(path)
+            request.user = user
+            match = resolve(path)
+            with CaptureQueriesContext(connection) as queries:
+                match.func(request, *match.args, **match.kwargs)
+            selects = [query["sql"] for query in queries
+                       if query["sql"].startswith("SELECT")]
+            reported = [(sql, problems(sql)) for sql in selects]
+            reported = [(sql, steps) for sql, steps in reported if steps]
+            flagged += len(reported)
+            if verbosity > 0:
+                self.stdout.write("{}: {} queries, {} flagged."
+                                  .format(path, len(selects), len(reported)))
+                for sql, steps in reported:
+                    for step in steps:
+                        self.stdout.write("  " + step)
+                    if verbosity > 1:
+                        self.stdout.write("    " + sql)
+        return flagged
@@ -0,0 +1,48 @@
+"""
+Management command that runs the background feed fan-out worker.
+
+The worker drains the FanOutTask queue in batches, copying each new Dish
+Post into the feeds of its Chef's followers a chunk at a time (see
+dishes.feeds). It polls for new tasks until it is interrupted, or with
+--once stops as soon as no task is due.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from dishes import feeds
+
+
+class Command(BaseCommand):
+    help = "Copy new Dish Posts into the feeds of their Chefs' followers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=feeds.BATCH_SIZE,
+                            help="The number of tasks claimed at once.")
+        parser.add_argument("--chunk-size",
+                            type=int,
+                            default=feeds.CHUNK_SIZE,
+                            help="The followers reached per transaction.")
+        parser.add_argument("--poll",
+                            type=float,
+                            default=5.0,
+                            help="Seconds to wait when no task is due.")
+        parser.add_argument("--once",
+                            action="store_true",
+                            help="Stop once no task is due.")
+
+    def handle(self, *args, **options):
+        while True:
+            tasks, inserted = feeds.process_batch(
+                batch_size=options["batch_size"],
+                chunk_size=options["chunk_size"]
+            )
+            if options["verbosity"] > 1 and tasks:
+                self.stdout.write("Fanned out {} Dish Posts into {} feeds."
+                                  .format(tasks, inserted))
+            if not tasks:
+                if options["once"]:
+                    return
+                time.sleep(options["poll"])
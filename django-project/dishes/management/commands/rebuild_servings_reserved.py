@@ -0,0 +1,65 @@
+"""
+Management command that rebuilds the servings_reserved counter of every Dish
+Post from its Orders.
+
+With --check the counters are only verified: every Dish Post whose counter
+disagrees with its Orders is reported and the command exits with an error,
+but nothing is written.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from dishes.models import DishPost, Order
+
+# Keeps the number of parameters of each UPDATE under SQLite's limit.
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or with --check, verify) DishPost.servings_reserved."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check",
+                            action="store_true",
+                            help="Report mismatched counters without fixing them.")
+
+    def handle(self, *args, **options):
+        reserved = dict(
+            Order.objects.exclude(status=Order.CANCELLED)
+                         .values_list("dish_post")
+                         .annotate(total=Sum("num_servings"))
+                         .order_by()
+        )
+        mismatched = {}
+        counters = DishPost.objects.values_list("pk", "servings_reserved")
+        for pk, servings_reserved in counters.iterator():
+            expected = reserved.get(pk, 0)
+            if servings_reserved != expected:
+                mismatched[pk] = (servings_reserved, expected)
+
+        if options["verbosity"] > 0:
+            for pk, (actual, expected) in sorted(mismatched.items()):
+                self.stdout.write("DishPost {}: servings_reserved is {}, "
+                                  "orders total {}".format(pk, actual, expected))
+
+        if options["check"]:
+            if mismatched:
+                raise CommandError("{} DishPost counters are out of date."
+                                   .format(len(mismatched)))
+            self.stdout.write("All DishPost counters are up to date.")
+            return
+
+        # Posts that need the same value are fixed with a single UPDATE.
+        by_value = {}
+        for pk, (actual, expected) in mismatched.items():
+            by_value.setdefault(expected, []).append(pk)
+        with transaction.atomic():
+            for value, pks in by_value.items():
+                for i in range(0, len(pks), BATCH_SIZE):
+                    batch = pks[i:i + BATCH_SIZE]
+                    DishPost.objects.filter(pk__in=batch).update(
+                        servings_reserved=value
+                    )
+        if options["verbosity"] > 0:
+            self.stdout.write("Rebuilt {} DishPost counters.".format(len(mismatched)))
@@ -0,0 +1,36 @@
+"""
+Management command that rebuilds every Diner's taste profile from their
+completed Orders.
+
+The completed Orders are counted by Diner and dish label with one grouped
+query, and the TasteProfile table is replaced with the result in a single
+transaction.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from dishes.models import Order, TasteProfile
+
+# Keeps the number of rows of each INSERT under SQLite's parameter limit.
+BATCH_SIZE = 300
+
+
+class Command(BaseCommand):
+    help = "Rebuild the TasteProfile table from completed Orders."
+
+    def handle(self, *args, **options):
+        counts = (Order.objects.filter(status=Order.COMPLETE,
+                                       diner__isnull=False)
+                               .exclude(dish_post__dish__alchemy_label="")
+                               .values_list("diner", "dish_post__dish__alchemy_label")
+                               .annotate(count=Count("pk"))
+                               .order_by())
+        profiles = [TasteProfile(diner_id=diner_id, label=label, count=count)
+                    for diner_id, label, count in counts]
+        with transaction.atomic():
+            TasteProfile.objects.all().delete()
+            TasteProfile.objects.bulk_create(profiles, batch_size=BATCH_SIZE)
+
+        if options["verbosity"] > 0:
+            self.stdout.write("Rebuilt {} taste profile rows.".format(len(profiles)))
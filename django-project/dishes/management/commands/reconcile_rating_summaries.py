@@ -0,0 +1,97 @@
+"""
+Management command that reconciles every RatingSummary against the Ratings.
+
+The Ratings are totalled by ratee with one grouped query and compared with
+the RatingSummary rows, including users who have Ratings but no summary and
+summaries of users who have no Ratings. Every summary that disagrees is
+reported and the command exits with an error. With --fix the summaries are
+instead rewritten from the Ratings.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Q, Sum, Value, When
+
+from dishes.models import Rating, RatingSummary
+
+FIELDS = ("count", "total", "low", "struck", "struck_total")
+
+# Keeps the number of rows of each INSERT under SQLite's parameter limit.
+BATCH_SIZE = 150
+
+
+def _sum_if(condition, value):
+    return Sum(Case(When(condition, then=value),
+                    default=Value(0),
+                    output_field=IntegerField()))
+
+
+class Command(BaseCommand):
+    help = "Reconcile RatingSummary rows against the Ratings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix",
+                            action="store_true",
+                            help="Rewrite mismatched summaries from the Ratings.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            low = Q(rating__lte=RatingSummary.LOW_RATING, struck=False)
+            struck = Q(struck=True)
+            totals = (Rating.objects.filter(ratee__isnull=False)
+                                    .values("ratee")
+                                    .annotate(ratings=Count("pk"),
+                                              ratings_total=Sum("rating"),
+                                              low_ratings=_sum_if(low, Value(1)),
+                                              struck_ratings=_sum_if(struck,
+                                                                     Value(1)),
+                                              struck_ratings_total=_sum_if(
+                                                  struck, "rating"))
+                                    .order_by())
+            expected = dict((row["ratee"], (row["ratings"],
+                                            row["ratings_total"],
+                                            row["low_ratings"],
+                                            row["struck_ratings"],
+                                            row["struck_ratings_total"]))
+                            for row in totals)
+            summaries = dict((row[0], row[1:]) for row in
+                             RatingSummary.objects.values_list("user_id",
+                                                               *FIELDS))
+            zero = (0,) * len(FIELDS)
+            mismatched = []
+            for user_id in sorted(set(expected) | set(summaries)):
+                actual = summaries.get(user_id)
+                wanted = expected.get(user_id, zero)
+                if actual is None and wanted == zero:
+                    continue
+                if actual != wanted:
+                    mismatched.append((user_id, actual, wanted))
+
+            if options["verbosity"] > 0:
+                for user_id, actual, wanted in mismatched:
+                    self.stdout.write("User {}: summary is {}, Ratings say {}"
+                                      .format(user_id,
+                                              "missing" if actual is None else
+                                              dict(zip(FIELDS, actual)),
+                                              dict(zip(FIELDS, wanted))))
+
+            if not options["fix"]:
+                if mismatched:
+                    raise CommandError("{} rating summaries disagree with the "
+                                       "Ratings.".format(len(mismatched)))
+                if options["verbosity"] > 0:
+                    self.stdout.write("All rating summaries agree with the "
+                                      "Ratings.")
+                return
+
+            missing = []
+            for user_id, actual, wanted in mismatched:
+                if actual is None:
+                    missing.append(RatingSummary(user_id=user_id,
+                                                 **dict(zip(FIELDS, wanted))))
+                else:
+                    (RatingSummary.objects.filter(user_id=user_id)
+                                          .update(**dict(zip(FIELDS, wanted))))
+            RatingSummary.objects.bulk_create(missing, batch_size=BATCH_SIZE)
+            if options["verbosity"] > 0:
+                self.stdout.write("Rewrote {} rating summaries from the "
+                                  "Ratings.".format(len(mismatched)))
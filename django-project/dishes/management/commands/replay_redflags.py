@@ -0,0 +1,75 @@
+"""
+Management command that replays the whole Rating and Complaint history
+through the red flag rules (see dishes.redflags), with the thresholds given
+on the command line, and reports the flags they raise.
+
+Nothing is written, so a change to the rules can be tried on the live
+history before it is made. Only the red flag rules are replayed: Ratings
+struck by suspensions are not, so a critical flag may be raised earlier
+than the live rules would raise it.
+"""
+import collections
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import Complaint, RedFlag
+from dishes import pagination, redflags
+from dishes.models import Rating
+
+CHUNK_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = "Replay the Rating and Complaint history through the red flag rules."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--window",
+                            type=int,
+                            default=redflags.WINDOW,
+                            help="The latest Ratings the generous rule looks at.")
+        parser.add_argument("--critical-ratings",
+                            type=int,
+                            default=redflags.CRITICAL_RATINGS,
+                            help="The lowest Ratings that trip the critical rule.")
+        parser.add_argument("--critical-complaints",
+                            type=int,
+                            default=redflags.CRITICAL_COMPLAINTS,
+                            help="The Complaints that trip the critical rule.")
+        parser.add_argument("--chunk-size",
+                            type=int,
+                            default=CHUNK_SIZE,
+                            help="The most rows read by one query.")
+
+    def handle(self, *args, **options):
+        detector = redflags.Detector(
+            window=options["window"],
+            critical_ratings=options["critical_ratings"],
+            critical_complaints=options["critical_complaints"]
+        )
+        ratings = pagination.iterate(Rating.objects.all(), ("date", "pk"),
+                                     ("date", "rater_id", "pk", "rating"),
+                                     options["chunk_size"])
+        complaints = pagination.iterate(Complaint.objects.all(), ("date", "pk"),
+                                        ("date", "complainant_id"),
+                                        options["chunk_size"])
+
+        start = time.monotonic()
+        reasons = dict(RedFlag.REASON_CHOICES)
+        raised = collections.Counter()
+        users = set()
+        for flag in redflags.replay(ratings, complaints, detector):
+            raised[flag.reason] += 1
+            users.add(flag.user_id)
+            if options["verbosity"] > 1:
+                self.stdout.write("{:%Y-%m-%d %H:%M} user {}: {}"
+                                  .format(flag.date, flag.user_id,
+                                          reasons[flag.reason]))
+        elapsed = time.monotonic() - start
+
+        if options["verbosity"] > 0:
+            self.stdout.write("Raised {} critical and {} generous flags on {} "
+                              "users ({:.1f} s)."
+                              .format(raised[RedFlag.CRITICAL],
+                                      raised[RedFlag.GENEROUS],
+                                      len(users), elapsed))
@@ -0,0 +1,46 @@
+"""
+Management command that runs the lifecycle scheduler.
+
+Every tick closes the Dish Posts past their last call, moves the Orders past
+their meal time to pending feedback and cancels the Dish Requests past their
+meal time, in bounded batches (see dishes.lifecycle). It ticks until it is
+interrupted, or with --once runs a single tick.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from dishes import lifecycle
+
+
+class Command(BaseCommand):
+    help = "Expire Dish Posts, Orders and Dish Requests whose time has passed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=lifecycle.BATCH_SIZE,
+                            help="The most rows moved by one UPDATE.")
+        parser.add_argument("--interval",
+                            type=float,
+                            default=60.0,
+                            help="Seconds between ticks.")
+        parser.add_argument("--once",
+                            action="store_true",
+                            help="Run a single tick.")
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.monotonic()
+            moved = lifecycle.tick(batch_size=options["batch_size"])
+            elapsed = time.monotonic() - start
+            if options["verbosity"] > 1 or (options["verbosity"] > 0 and
+                                            sum(moved.values())):
+                self.stdout.write("Closed {posts} Dish Posts, rejecting {bids} "
+                                  "Bids; moved {orders} Orders to feedback; "
+                                  "cancelled {requests} Dish Requests, "
+                                  "rejecting {offers} Offers ({elapsed:.0f} ms)."
+                                  .format(elapsed=elapsed * 1000, **moved))
+            if options["once"]:
+                return
+            time.sleep(max(options["interval"] - elapsed, 0))
@@ -0,0 +1,39 @@
+"""
+Management command that seeds the classification cache from the labels of
+existing Dishes.
+
+Every labelled Dish contributes its label to the normalized form of its
+name; where Dishes sharing a normalized name disagree, the most common label
+wins. Names that are already cached are left alone, so the command is safe to
+run repeatedly.
+"""
+import collections
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dishes.classification import normalize
+from dishes.models import CachedLabel, Dish
+
+# Keeps the number of rows of each INSERT under SQLite's parameter limit.
+BATCH_SIZE = 400
+
+
+class Command(BaseCommand):
+    help = "Seed the classification cache from existing Dish labels."
+
+    def handle(self, *args, **options):
+        votes = collections.defaultdict(collections.Counter)
+        labelled = (Dish.objects.exclude(alchemy_label="")
+                                .values_list("name", "alchemy_label"))
+        for name, label in labelled.iterator():
+            votes[normalize(name)][label] += 1
+
+        with transaction.atomic():
+            cached = set(CachedLabel.objects.values_list("key", flat=True))
+            entries = [CachedLabel(key=key, label=counts.most_common(1)[0][0])
+                       for key, counts in votes.items() if key not in cached]
+            CachedLabel.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+
+        if options["verbosity"] > 0:
+            self.stdout.write("Cached {} new labels.".format(len(entries)))
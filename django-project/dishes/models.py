@@ -1,8 +1,97 @@
+import collections
 import decimal
-
-from django.db import models
+import math
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (
+    Avg, Case, Count, ExpressionWrapper, F, Q, Value, When
+)
+from django.db.models.functions import Cast, Substr
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_migrate, post_save
+)
+from django.dispatch import Signal, receiver
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
+
+from dishes import geo
+
+
+class GeoQuerySet(models.QuerySet):
+    """
+    QuerySet for models with latitude, longitude and geohash fields.
+    """
+
+    def within(self, south, west, north, east):
+        """
+        Limit the queryset to rows inside the bounding box.
+
+        The geohash cells covering the box are turned into range scans on the
+        indexed geohash column, after which the exact coordinates trim the
+        rows that fall in a covering cell but outside the box.
+        """
+        cells = Q()
+        for cell in geo.covering_cells(south, west, north, east):
+            cells |= Q(geohash__gte=cell, geohash__lt=cell + geo.UPPER_BOUND)
+        box = Q()
+        for s, w, n, e in geo.split_antimeridian(south, west, north, east):
+            box |= Q(latitude__gte=s, latitude__lte=n,
+                     longitude__gte=w, longitude__lte=e)
+        return self.filter(cells).filter(box)
+
+    def clusters(self, precision):
+        """
+        Group the queryset by geohash prefix of the given precision.
+
+        Returns a values queryset with the prefix as "cell", the number of
+        rows in the cell as "count" and the mean position of those rows as
+        "latitude" and "longitude".
+        """
+        return (self.annotate(cell=Substr("geohash", 1, precision))
+                    .values("cell")
+                    .annotate(count=Count("id"),
+                              lat=Avg("latitude"),
+                              lng=Avg("longitude"))
+                    .order_by())
+
+    def around(self, latitude, longitude, radius, bucket):
+        """
+        Limit the queryset to rows within radius kilometres of the point and
+        annotate each with its distance_bucket, the whole part of the
+        square of its distance in units of bucket kilometres. Ordering by
+        (distance_bucket, id) lists the rows nearest first, one ring of
+        buckets at a time, with a total order keyset pagination can seek
+        through.
+
+        The rows are found through the geohash index of the bounding box of
+        the circle, and their distances are approximated in SQL by the
+        equirectangular projection around the point, which is within a
+        fraction of a percent of the great-circle distance at these radii.
+        Longitude differences are wrapped into [-180, 180], so rows across
+        the antimeridian from the point are measured the short way round.
+        """
+        box = geo.bounding_box(latitude, longitude, radius)
+        latitude = float(latitude)
+        longitude = float(longitude)
+        ky = (geo.KM_PER_DEGREE / bucket) ** 2
+        kx = ky * math.cos(math.radians(latitude)) ** 2
+        dy = F("latitude") - Value(latitude)
+        dx = Case(
+            When(longitude__gt=longitude + 180.0,
+                 then=F("longitude") - Value(longitude + 360.0)),
+            When(longitude__lt=longitude - 180.0,
+                 then=F("longitude") - Value(longitude - 360.0)),
+            default=F("longitude") - Value(longitude),
+            output_field=models.FloatField()
+        )
+        squared = ExpressionWrapper(dy * dy * Value(ky) + dx * dx * Value(kx),
+                                    output_field=models.FloatField())
+        return (self.within(*box)
+                    .annotate(distance_squared=squared)
+                    .filter(distance_squared__lte=(radius / bucket) ** 2)
+                    .annotate(distance_bucket=Cast("distance_squared",
+                                                   models.IntegerField())))
 
 
 class Diner(models.Model):
@@ -33,19 +122,78 @@ class Chef(models.Model):
     """
     Django model class representing a Chef.
 
+    The counters below are kept current by the signal handlers at the end
+    of this module, so the chef's profile renders from this row. Saving a
+    Chef never writes them, and the check_chef_stats management command
+    compares them with the rows they count.
+
     Attributes:
 
     user:
         The User account associated with this Chef instance.
+
+    follower_count:
+        The number of Diners following the Chef.
+
+    open_posts:
+        The number of the Chef's Dish Posts that are open.
+
+    completed_posts:
+        The number of the Chef's Dish Posts that are complete.
+
+    rating_count:
+        The number of Ratings the Chef's user has received.
+
+    rating_total:
+        The sum of the scores of the Ratings the Chef's user has received.
+
+    fan_out_on_read:
+        Whether the Chef has posted with more followers than
+        dishes.feeds.FANOUT_CUTOFF. The followers of such a Chef read the
+        Chef's Dish Posts into their feeds instead of having them copied in.
+        It is never unset, so no post drops out of the feeds when the Chef
+        loses followers.
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=128)
     blurb = models.TextField("Blurb")
     experience = models.TextField("Experience")
+    # The table is also indexed on (diner_id, chef_id), by
+    # index_followees_by_diner below.
     followers = models.ManyToManyField(Diner, related_name="followees")
+    follower_count = models.IntegerField(default=0, editable=False)
+    open_posts = models.IntegerField(default=0, editable=False)
+    completed_posts = models.IntegerField(default=0, editable=False)
+    rating_count = models.IntegerField(default=0, editable=False)
+    rating_total = models.IntegerField(default=0, editable=False)
+    fan_out_on_read = models.BooleanField(default=False, editable=False)
+
+    COUNTERS = ("follower_count", "open_posts", "completed_posts",
+                "rating_count", "rating_total")
+
+    # The fields that are only changed by UPDATEs.
+    MAINTAINED = COUNTERS + ("fan_out_on_read",)
+
+    def save(self, *args, **kwargs):
+        # The maintained fields of an existing Chef are only changed by
+        # UPDATEs, so that saving a stale instance cannot overwrite them.
+        if (self.pk is not None and kwargs.get("update_fields") is None and
+                not kwargs.get("force_insert")):
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in Chef.MAINTAINED
+            ]
+        super(Chef, self).save(*args, **kwargs)
 
     def count_followers(self):
-        return self.followers.all().count()
+        return self.follower_count
+
+    def average_rating(self):
+        """
+        Return the average score of the Ratings the Chef has received, or
+        None if there are none.
+        """
+        return self.rating_total / self.rating_count if self.rating_count else None
 
 class CuisineTag(models.Model):
     """
@@ -83,6 +231,53 @@ class Dish(models.Model):
     longitude= models.DecimalField(max_digits=9, decimal_places=6, default=decimal.Decimal(0.0))
 
 
+class ClassificationTask(models.Model):
+    """
+    Django model class representing a Dish waiting for its taxonomy label.
+
+    Dishes are classified in the background by the classify_dishes
+    management command, which drains these tasks in batches. A task is
+    deleted once its Dish has been labelled.
+
+    Attributes:
+
+    dish:
+        The Dish to classify.
+
+    attempts:
+        The number of times classifying the Dish has failed.
+
+    next_attempt:
+        The earliest time the task may be attempted. It is pushed back while
+        a worker holds the task and, with exponential backoff, after every
+        failed attempt.
+
+    last_error:
+        The error of the last failed attempt.
+    """
+    dish = models.OneToOneField(Dish, on_delete=models.CASCADE)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+
+
+class CachedLabel(models.Model):
+    """
+    Django model class representing the taxonomy label of a dish name,
+    cached so that the same dish is only ever classified once.
+
+    Attributes:
+
+    key:
+        The normalized dish name (see dishes.classification.normalize).
+
+    label:
+        The taxonomy label of the name. Names the classifier found no label
+        for are not cached.
+    """
+    key = models.CharField(max_length=128, unique=True)
+    label = models.TextField(blank=True)
+
 
 class DishPost(models.Model):
     """
@@ -120,6 +315,22 @@ class DishPost(models.Model):
         served. The Chef and Diner should coordinate the exchange of food at or
         around this time.
 
+    geohash:
+        Geohash of the latitude and longitude, maintained on save. It is used
+        to index the location of the Dish Post for map queries.
+
+    modified:
+        Date time field that records when the Dish Post was last changed. It
+        is the cursor of the map marker feed, so bulk updates must set it
+        explicitly.
+
+    servings_reserved:
+        Integer field that counts the servings of all Orders on this Dish Post
+        that have not been cancelled. It is only changed through
+        reserve_servings and release_servings, never by saving the Dish Post,
+        and can be rebuilt with the rebuild_servings_reserved management
+        command.
+
     status:
         Integer field that indicates the status of the order. The status
         descriptions are below.
@@ -127,8 +338,17 @@ class DishPost(models.Model):
         Open:
             At least 1 serving of the Dish Post is still available so a Diner
             may still order the Dish.
+        Pending Feedback:
+            Last call has passed and the Dish is being served to the Diners
+            who ordered it.
+        Cancelled:
+            The Chef cancelled the Dish Post, or last call passed without any
+            Orders.
         Complete:
             The Dish has been served and the Chef has been paid.
+
+        Open Dish Posts are closed at last call by the run_lifecycle
+        management command.
     """
     chef = models.ForeignKey(Chef, on_delete=models.SET_NULL, null=True)
     max_servings = models.IntegerField(default=1)
@@ -139,6 +359,9 @@ class DishPost(models.Model):
     meal_time = models.DateTimeField("Meal Time")
     latitude = models.DecimalField(max_digits = 9, decimal_places = 6, default=decimal.Decimal(0.0))
     longitude= models.DecimalField(max_digits = 9, decimal_places = 6, default=decimal.Decimal(0.0))
+    geohash = models.CharField(max_length=geo.PRECISION, db_index=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    servings_reserved = models.IntegerField(default=0, editable=False)
 
     OPEN, PENDING_FEEDBACK, CANCELLED, COMPLETE = range(4)
 
@@ -151,11 +374,47 @@ class DishPost(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=OPEN)
 
+    objects = GeoQuerySet.as_manager()
+
+    class Meta:
+        index_together = [
+            ("status", "last_call"),
+            ("chef", "status", "meal_time"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.geohash = geo.encode(self.latitude, self.longitude)
+        # servings_reserved is only changed by UPDATEs, so that saving a
+        # stale instance cannot overwrite reservations made since it was
+        # loaded.
+        if (self.pk is not None and kwargs.get("update_fields") is None and
+                not kwargs.get("force_insert")):
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "servings_reserved"
+            ]
+        super(DishPost, self).save(*args, **kwargs)
+
     def servings_ordered(self):
-        acc = 0
-        for order in self.order_set.all():
-            acc += order.num_servings
-        return acc
+        return self.servings_reserved
+
+    def reserve_servings(self, num_servings):
+        """
+        Atomically add num_servings to the reserved servings counter.
+        """
+        DishPost.objects.filter(pk=self.pk).update(
+            servings_reserved=F("servings_reserved") + num_servings
+        )
+        self.servings_reserved += num_servings
+
+    def release_servings(self, num_servings):
+        """
+        Atomically subtract num_servings from the reserved servings counter.
+        """
+        DishPost.objects.filter(pk=self.pk).update(
+            servings_reserved=F("servings_reserved") - num_servings
+        )
+        self.servings_reserved -= num_servings
 
     def available_servings(self):
         if self.status == DishPost.COMPLETE:
@@ -193,6 +452,15 @@ class DishRequest(models.Model):
         served. The Chef and Diner should coordinate the exchange of food at or
         around this time.
 
+    geohash:
+        Geohash of the latitude and longitude, maintained on save. It is used
+        to index the location of the Dish Request for nearby queries.
+
+    modified:
+        Date time field that records when the Dish Request was last changed.
+        It is the cursor of the map marker feed, so bulk updates must set it
+        explicitly.
+
     status:
         Integer field that indicates the status of the order. The status
         descriptions are below.
@@ -207,6 +475,9 @@ class DishRequest(models.Model):
             The Diner has cancelled this Dish Request.
         Complete:
             The Dish has been served and the Chef has been paid.
+
+        Open Dish Requests are cancelled at their meal time by the
+        run_lifecycle management command.
     """
     diner = models.ForeignKey(Diner, on_delete=models.SET_NULL, null=True)
     dish = models.ForeignKey(Dish, on_delete=models.PROTECT)
@@ -217,6 +488,8 @@ class DishRequest(models.Model):
 
     latitude = models.DecimalField(max_digits = 9, decimal_places = 6,default=decimal.Decimal(0.0))
     longitude= models.DecimalField(max_digits = 9, decimal_places = 6,default=decimal.Decimal(0.0))
+    geohash = models.CharField(max_length=geo.PRECISION, db_index=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
 
     OPEN, ACCEPTED, CANCELLED, COMPLETE = range(4)
 
@@ -229,6 +502,18 @@ class DishRequest(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=OPEN)
 
+    objects = GeoQuerySet.as_manager()
+
+    class Meta:
+        index_together = [
+            ("status", "meal_time"),
+            ("diner", "status", "meal_time"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.geohash = geo.encode(self.latitude, self.longitude)
+        super(DishRequest, self).save(*args, **kwargs)
+
     def total(self):
         return self.min_price * self.num_servings
 
@@ -253,6 +538,9 @@ class Offer(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
 
+    class Meta:
+        index_together = [("dish_request", "status")]
+
     def total(self):
         return self.dish_request.num_servings * self.price
 
@@ -277,6 +565,9 @@ class Bid(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
 
+    class Meta:
+        index_together = [("dish_post", "status")]
+
     def total(self):
         return self.num_servings * self.price
 
@@ -313,6 +604,11 @@ class Order(models.Model):
         Open:
             This order is currently open and waiting to be filled.
 
+        Pending Feedback:
+            The meal time of the Dish Post has passed and the order is waiting
+            for the diner's feedback. Open orders are moved here by the
+            run_lifecycle management command.
+
         Cancelled:
             This order has been cancelled.
 
@@ -337,9 +633,68 @@ class Order(models.Model):
 
     status = models.IntegerField(choices=STATUS_CHOICES, default=OPEN)
 
+    class Meta:
+        index_together = [
+            ("diner", "status"),
+            ("status", "dish_post"),
+        ]
+
     def total(self):
         return self.bid.total()
 
+class TasteProfile(models.Model):
+    """
+    Django model class representing how often a Diner has completed an
+    Order of a dish with a given taxonomy label. Together, the rows of a
+    Diner form their taste profile, which is kept up to date as Orders
+    complete so that suggestions never have to scan the Diner's history.
+
+    Attributes:
+
+    diner:
+        The Diner the profile belongs to.
+
+    label:
+        The taxonomy label of the dishes.
+
+    count:
+        The number of completed Orders of dishes with the label.
+    """
+    diner = models.ForeignKey(Diner, on_delete=models.CASCADE)
+    label = models.CharField(max_length=256)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("diner", "label")
+
+    @staticmethod
+    def record(diner_id, label):
+        """
+        Count one more completed Order of a dish with the label.
+        """
+        if not label:
+            return
+        profile = TasteProfile.objects.filter(diner_id=diner_id, label=label)
+        if profile.update(count=F("count") + 1):
+            return
+        try:
+            with transaction.atomic():
+                TasteProfile.objects.create(diner_id=diner_id,
+                                            label=label,
+                                            count=1)
+        except IntegrityError:
+            # Another request created the row first.
+            profile.update(count=F("count") + 1)
+
+    @staticmethod
+    def top_labels(diner, n):
+        """
+        Return the diner's n most frequent labels, most frequent first.
+        """
+        profiles = (TasteProfile.objects.filter(diner=diner)
+                                        .order_by("-count", "label"))
+        return list(profiles.values_list("label", flat=True)[:n])
+
 class OrderFeedback(models.Model):
     """
     Django model class representing feedback from a diner about an
@@ -448,8 +803,366 @@ class Rating(models.Model):
     rating = models.IntegerField(validators=[MinValueValidator(1),
                                              MaxValueValidator(5)])
     struck = models.BooleanField(default=False)
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        index_together = [
+            ("ratee", "struck", "rating"),
+            ("rater", "struck", "rating"),
+            ("rater", "date"),
+        ]
+
+    @staticmethod
+    def rate(rater, ratee, rating):
+        """
+        Create a Rating and add it to the ratee's RatingSummary in the same
+        transaction.
+        """
+        with transaction.atomic():
+            created = Rating.objects.create(rater=rater, ratee=ratee,
+                                            rating=rating)
+            RatingSummary.add(ratee.pk, rating)
+        return created
+
+    @staticmethod
+    def strike(ratings):
+        """
+        Strike those of the Ratings that are not struck yet and move them to
+        the struck totals of their ratees' RatingSummaries, with one UPDATE
+        for the Ratings and one per ratee. Return the number of Ratings
+        struck.
+        """
+        ids = [rating.pk for rating in ratings]
+        with transaction.atomic():
+            unstruck = list(Rating.objects.select_for_update()
+                                          .filter(pk__in=ids, struck=False)
+                                          .values_list("pk", "ratee_id",
+                                                       "rating"))
+            if not unstruck:
+                return 0
+            Rating.objects.filter(pk__in=[row[0] for row in unstruck],
+                                  struck=False).update(struck=True)
+            totals = {}
+            for pk, ratee_id, rating in unstruck:
+                if ratee_id is None:
+                    continue
+                low, struck, struck_total = totals.get(ratee_id, (0, 0, 0))
+                totals[ratee_id] = (low + (rating <= RatingSummary.LOW_RATING),
+                                    struck + 1, struck_total + rating)
+            for ratee_id, (low, struck, struck_total) in totals.items():
+                (RatingSummary.objects.filter(user_id=ratee_id)
+                                      .update(low=F("low") - low,
+                                              struck=F("struck") + struck,
+                                              struck_total=F("struck_total") +
+                                                           struck_total))
+        return len(unstruck)
+
+
+class RatingSummary(models.Model):
+    """
+    Django model class representing running totals of the Ratings a user has
+    received. It is updated in the same transaction as every Rating created
+    with Rating.rate or struck with Rating.strike, so suspension checks read
+    one row instead of aggregating the user's Ratings. The
+    reconcile_rating_summaries management command recomputes it from the
+    Ratings.
+
+    Attributes:
+
+    user:
+        The user the Ratings were given to.
+
+    count:
+        The number of Ratings received.
+
+    total:
+        The sum of the scores of the Ratings received.
+
+    low:
+        The number of Ratings of LOW_RATING or less that have not been
+        struck.
+
+    struck:
+        The number of Ratings that have been struck.
+
+    struck_total:
+        The sum of the scores of the Ratings that have been struck.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    low = models.IntegerField(default=0)
+    struck = models.IntegerField(default=0)
+    struck_total = models.IntegerField(default=0)
+
+    LOW_RATING = 2
+
+    @staticmethod
+    def add(user_id, rating):
+        """
+        Add a new, unstruck Rating with the given score.
+        """
+        low = int(rating <= RatingSummary.LOW_RATING)
+        summary = RatingSummary.objects.filter(user_id=user_id)
+        changes = {
+            "count": F("count") + 1,
+            "total": F("total") + rating,
+            "low": F("low") + low,
+        }
+        if summary.update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                RatingSummary.objects.create(user_id=user_id, count=1,
+                                             total=rating, low=low)
+        except IntegrityError:
+            # Another request created the row first.
+            summary.update(**changes)
+
+    @staticmethod
+    def of(user_id):
+        """
+        Return the RatingSummary of a user, or an empty one if the user has
+        not been rated.
+        """
+        summary = RatingSummary.objects.filter(user_id=user_id).first()
+        return summary or RatingSummary(user_id=user_id)
+
+    def average(self):
+        """
+        Return the average score of all the Ratings, or None if there are
+        none.
+        """
+        return self.total / self.count if self.count else None
+
+    def unstruck_average(self):
+        """
+        Return the average score of the Ratings that have not been struck,
+        or None if there are none.
+        """
+        unstruck = self.count - self.struck
+        return (self.total - self.struck_total) / unstruck if unstruck else None
+
+
+
+
+
+
+class RaterWindow(models.Model):
+    """
+    Django model class representing what the red flag detector remembers of
+    a rater between requests (see dishes.redflags).
+
+    Attributes:
+
+    user:
+        The rater.
+
+    recent:
+        The rater's latest Ratings, oldest first, as space separated
+        "id:score" pairs. Ratings struck by the detector have a score of 0.
+
+    lowest:
+        The number of the rater's lowest Ratings that have not been struck.
+        Ratings struck by suspensions are not subtracted, so it is an upper
+        bound that is checked against the Ratings before a flag is raised.
+
+    complaints:
+        The number of the rater's Complaints that have not been struck.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    recent = models.CharField(max_length=200, blank=True)
+    lowest = models.IntegerField(default=0)
+    complaints = models.IntegerField(default=0)
+
+
+class FanOutTask(models.Model):
+    """
+    Django model class representing a Dish Post waiting to be copied into
+    the feeds of its Chef's followers.
+
+    The fanout_feeds management command drains these tasks, inserting the
+    FeedItems of a task's followers a chunk at a time in order of Diner id.
+    A task is deleted once every follower has been reached.
 
+    Attributes:
+
+    dish_post:
+        The Dish Post to copy into the feeds.
+
+    next_follower:
+        The Diner id the fan-out resumes after. Followers with this id or a
+        lower one have the Dish Post in their feeds.
 
+    next_attempt:
+        The earliest time the task may be attempted. It is pushed back while
+        a worker holds the task.
+    """
+    dish_post = models.OneToOneField(DishPost, on_delete=models.CASCADE)
+    next_follower = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+class FeedItem(models.Model):
+    """
+    Django model class representing a Dish Post in the feed of a Diner
+    following its Chef.
+
+    Attributes:
+
+    diner:
+        The Diner whose feed holds the Dish Post.
+
+    dish_post:
+        The Dish Post.
+    """
+    diner = models.ForeignKey(Diner, on_delete=models.CASCADE)
+    dish_post = models.ForeignKey(DishPost, on_delete=models.CASCADE)
 
+    class Meta:
+        # Also the index a feed is read through, newest Dish Post first.
+        unique_together = ("diner", "dish_post")
 
+
+# Sent with changes, a Counter of Dish Posts by (chef id, old status, new
+# status), by code that changes the status of Dish Posts with a bulk UPDATE,
+# which sends no post_save. The old status of a new Dish Post and the new
+# status of a deleted one are None.
+dish_post_statuses_changed = Signal(providing_args=["changes"])
+
+
+@receiver(dish_post_statuses_changed)
+def count_chef_posts(sender, changes, **kwargs):
+    """
+    Apply changes of Dish Post statuses to the open_posts and
+    completed_posts of their Chefs, with one UPDATE per distinct change.
+    """
+    deltas = collections.defaultdict(lambda: [0, 0])
+    for (chef_id, old, new), n in changes.items():
+        if chef_id is None or old == new:
+            continue
+        for status, delta in ((old, -n), (new, n)):
+            if status == DishPost.OPEN:
+                deltas[chef_id][0] += delta
+            elif status == DishPost.COMPLETE:
+                deltas[chef_id][1] += delta
+    chefs = collections.defaultdict(list)
+    for chef_id, (open_posts, completed_posts) in deltas.items():
+        if open_posts or completed_posts:
+            chefs[open_posts, completed_posts].append(chef_id)
+    for (open_posts, completed_posts), chef_ids in chefs.items():
+        Chef.objects.filter(pk__in=chef_ids).update(
+            open_posts=F("open_posts") + open_posts,
+            completed_posts=F("completed_posts") + completed_posts
+        )
+
+
+@receiver(post_init, sender=DishPost)
+def remember_dish_post_status(sender, instance, **kwargs):
+    # Read from __dict__ so that a deferred status is not loaded.
+    instance._saved_status = instance.__dict__.get("status")
+
+
+@receiver(post_save, sender=DishPost)
+def count_saved_dish_post(sender, instance, created, update_fields, raw,
+                          **kwargs):
+    if raw or (update_fields is not None and "status" not in update_fields):
+        return
+    old = None if created else instance._saved_status
+    if old != instance.status:
+        changes = collections.Counter({(instance.chef_id, old,
+                                        instance.status): 1})
+        dish_post_statuses_changed.send(sender=DishPost, changes=changes)
+    instance._saved_status = instance.status
+
+
+@receiver(post_delete, sender=DishPost)
+def count_deleted_dish_post(sender, instance, **kwargs):
+    changes = collections.Counter({(instance.chef_id, instance.status, None): 1})
+    dish_post_statuses_changed.send(sender=DishPost, changes=changes)
+
+
+@receiver(post_save, sender=Rating)
+def count_saved_rating(sender, instance, created, raw, **kwargs):
+    if created and not raw and instance.ratee_id is not None:
+        Chef.objects.filter(user_id=instance.ratee_id).update(
+            rating_count=F("rating_count") + 1,
+            rating_total=F("rating_total") + instance.rating
+        )
+
+
+@receiver(post_delete, sender=Rating)
+def count_deleted_rating(sender, instance, **kwargs):
+    if instance.ratee_id is not None:
+        Chef.objects.filter(user_id=instance.ratee_id).update(
+            rating_count=F("rating_count") - 1,
+            rating_total=F("rating_total") - instance.rating
+        )
+
+
+def recount_followers(chef_ids):
+    """
+    Set the follower_count of the Chefs to the number of their followers.
+    """
+    counts = dict(Chef.followers.through.objects.filter(chef_id__in=chef_ids)
+                                                .values_list("chef")
+                                                .annotate(count=Count("pk"))
+                                                .order_by())
+    chefs = collections.defaultdict(list)
+    for chef_id in chef_ids:
+        chefs[counts.get(chef_id, 0)].append(chef_id)
+    for count, ids in chefs.items():
+        Chef.objects.filter(pk__in=ids).update(follower_count=count)
+
+
+@receiver(m2m_changed, sender=Chef.followers.through)
+def count_chef_followers(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep follower_count current when Diners follow or unfollow Chefs, from
+    either side of the relation.
+    """
+    if action == "pre_clear" and reverse:
+        # The Chefs a Diner unfollows are not sent with post_clear.
+        instance._unfollowed = list(instance.followees.values_list("pk",
+                                                                   flat=True))
+    elif action == "post_add" and reverse:
+        Chef.objects.filter(pk__in=pk_set).update(
+            follower_count=F("follower_count") + 1
+        )
+    elif action == "post_add" and pk_set:
+        Chef.objects.filter(pk=instance.pk).update(
+            follower_count=F("follower_count") + len(pk_set)
+        )
+    elif action in ("post_remove", "post_clear"):
+        # pk_set of a removal may hold pks that were never related, so the
+        # Chefs are counted again.
+        if not reverse:
+            recount_followers([instance.pk])
+        elif action == "post_remove":
+            recount_followers(list(pk_set))
+        else:
+            recount_followers(instance._unfollowed)
+
+
+@receiver(post_migrate)
+def index_followees_by_diner(sender, using, **kwargs):
+    """
+    Index the followers table on (diner_id, chef_id), so the Chefs a Diner
+    follows are read from one index, as the Diners following a Chef are read
+    from the unique (chef_id, diner_id) one. Django gives the table of a
+    ManyToManyField no other composite index, and the table has no model to
+    declare one on.
+    """
+    if sender.name != "dishes":
+        return
+    connection = connections[using]
+    table = Chef.followers.through._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS {} ON {} ({}, {})".format(
+                connection.ops.quote_name(table + "_diner_chef"),
+                connection.ops.quote_name(table),
+                connection.ops.quote_name("diner_id"),
+                connection.ops.quote_name("chef_id")
+            )
+        )
@@ -0,0 +1,165 @@
+"""
+Keyset (seek) pagination for list pages.
+
+A page is fetched by filtering on the position of the last row of the
+previous page rather than with an OFFSET, so the database seeks straight to
+the start of the page through the ordering's index and every page costs the
+same as the first. The position is carried between requests as an opaque
+cursor string in the query string.
+
+The ordering must end in the id, so that rows sharing the leading values are
+still totally ordered and no row is skipped or repeated between
+pages, and all its fields must sort in the same direction.
+"""
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class KeysetPage(object):
+    """
+    A page of rows.
+
+    Attributes:
+
+    rows:
+        The rows on the page.
+
+    next_cursor:
+        The cursor of the page after this one, or None if this is the last
+        page.
+    """
+    def __init__(self, rows, next_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        delta = value - EPOCH
+        return str((delta.days * 86400 + delta.seconds) * 10**6 +
+                   delta.microseconds)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _integer(s):
+    value = int(s)
+    # Larger values cannot be bound as query parameters.
+    if not -2**63 <= value < 2**63:
+        raise ValueError("Cursor value out of range: {!r}".format(s))
+    return value
+
+
+def _decoder(field):
+    if field.get_internal_type() == "DateTimeField":
+        return lambda s: EPOCH + datetime.timedelta(microseconds=_integer(s))
+    if field.get_internal_type() == "FloatField":
+        return float
+    return _integer
+
+
+def encode_cursor(values):
+    """
+    Encode the ordering values of a row as a cursor string.
+    """
+    return "_".join(_encode(value) for value in values)
+
+
+def decode_cursor(cursor, decoders):
+    """
+    Decode a cursor string with one decoder callable per ordering field.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    parts = cursor.split("_")
+    if len(parts) != len(decoders):
+        raise ValueError("Malformed cursor: {!r}".format(cursor))
+    return [decode(part) for decode, part in zip(decoders, parts)]
+
+
+def after(ordering, values):
+    """
+    Return the Q object selecting the rows that come after the row with the
+    given ordering values.
+    """
+    descending = ordering[0].startswith("-")
+    names = [name.lstrip("-") for name in ordering]
+    lookup = "lt" if descending else "gt"
+    condition = Q()
+    for i, name in enumerate(names):
+        equal = dict(zip(names[:i], values[:i]))
+        equal["{}__{}".format(name, lookup)] = values[i]
+        condition |= Q(**equal)
+    # Implied by the condition, but lets the database seek to the first row
+    # through the index instead of scanning up to it.
+    bound = {"{}__{}e".format(names[0], lookup): values[0]}
+    return Q(**bound) & condition
+
+
+def position(model, ordering, cursor):
+    """
+    Return the ordering values of the row a cursor for rows of the model
+    points at, or None if cursor is None or malformed.
+    """
+    if not cursor:
+        return None
+    decoders = [_decoder(model._meta.get_field(name.lstrip("-")))
+                for name in ordering]
+    try:
+        return decode_cursor(cursor, decoders)
+    except (ValueError, OverflowError):
+        return None
+
+
+def paginate(queryset, ordering, cursor, per_page):
+    """
+    Return the KeysetPage of the queryset, ordered by ordering, that starts
+    after cursor, or the first page if cursor is None or malformed.
+    """
+    names = [name.lstrip("-") for name in ordering]
+    values = position(queryset.model, ordering, cursor)
+    queryset = queryset.order_by(*ordering)
+    if values is not None:
+        queryset = queryset.filter(after(ordering, values))
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, name) for name in names)
+    return KeysetPage(rows, next_cursor)
+
+
+def iterate(queryset, ordering, fields, chunk_size):
+    """
+    Yield the values of fields of every row of the queryset, ordered by
+    ordering, as tuples. The rows are fetched chunk_size at a time, each
+    chunk seeking past the last row of the one before, so no query reads
+    more than a chunk however large the table is.
+    """
+    names = [name.lstrip("-") for name in ordering]
+    fields = list(fields)
+    selected = fields + [name for name in names if name not in fields]
+    positions = [selected.index(name) for name in names]
+    queryset = queryset.order_by(*ordering).values_list(*selected)
+    rows = list(queryset[:chunk_size])
+    while rows:
+        for row in rows:
+            yield row[:len(fields)]
+        if len(rows) < chunk_size:
+            return
+        last = [rows[-1][i] for i in positions]
+        rows = list(queryset.filter(after(ordering, last))[:chunk_size])
@@ -0,0 +1,214 @@
+"""
+The suspension policy, and a Simulator that backtests it together with the
+red flag rules.
+
+A user who is not suspended is suspended on receiving a Rating that leaves
+them with:
+
+low ratings:
+    SUSPENSION_LOW_RATINGS unstruck Ratings of RatingSummary.LOW_RATING or
+    less. That many of them are struck.
+
+an extreme average:
+    At least SUSPENSION_MIN_RATINGS Ratings, averaging less than MIN_AVERAGE
+    or more than MAX_AVERAGE.
+
+A user suspended FORCE_QUIT_SUSPENSIONS times is forced out of the system.
+The raters are checked by the red flag rules of dishes.redflags.
+
+The Simulator applies all of these rules, with thresholds of its own, to a
+history of Ratings, Complaints and unsuspensions held in memory. Each user
+is reduced to a UserState of a few counters and short queues, and nothing
+is written to the database, so a change to the thresholds can be tried on
+years of history before it is made.
+"""
+import collections
+import heapq
+
+from accounts.models import RedFlag
+from dishes import redflags
+from dishes.models import RatingSummary
+
+SUSPENSION_LOW_RATINGS = 3
+SUSPENSION_MIN_RATINGS = 3
+MIN_AVERAGE = 2.0
+MAX_AVERAGE = 4.0
+FORCE_QUIT_SUSPENSIONS = 3
+
+# The outcomes of the rules.
+SUSPENDED = "suspended"
+FORCED_OUT = "forced out"
+CRITICAL = "flagged critical"
+GENEROUS = "flagged generous"
+
+# An outcome for a user, at the date of the event that caused it.
+Outcome = collections.namedtuple("Outcome", ["date", "user_id", "kind"])
+
+# The indexes of the fields of a low Rating, which is kept as a list
+# shared by the queues of its rater and ratee.
+RATER, RATEE, SCORE, STRUCK = range(4)
+
+
+class UserState(redflags.RaterState):
+    """
+    What the Simulator remembers of a user, as a rater and as a ratee.
+
+    Attributes:
+
+    given:
+        The lowest Ratings the user has given, oldest first. Struck Ratings
+        are dropped when they reach the front.
+
+    received:
+        The low Ratings the user has received, oldest first. Struck Ratings
+        are dropped when they reach the front.
+
+    count, total:
+        The number and sum of the scores of the Ratings received.
+
+    low:
+        The number of unstruck low Ratings received.
+
+    suspended:
+        Whether the user is suspended.
+
+    suspensions:
+        The number of times the user has been suspended.
+    """
+    __slots__ = ("given", "received", "count", "total", "low", "suspended",
+                 "suspensions")
+
+    def __init__(self, window):
+        super(UserState, self).__init__(window)
+        self.given = collections.deque()
+        self.received = collections.deque()
+        self.count = 0
+        self.total = 0
+        self.low = 0
+        self.suspended = False
+        self.suspensions = 0
+
+
+class Simulator(redflags.Detector):
+    """
+    The suspension and red flag rules, with their thresholds, and the
+    UserState of every user seen so far.
+    """
+    def __init__(self, low_rating=RatingSummary.LOW_RATING,
+                 suspension_low_ratings=SUSPENSION_LOW_RATINGS,
+                 suspension_min_ratings=SUSPENSION_MIN_RATINGS,
+                 min_average=MIN_AVERAGE, max_average=MAX_AVERAGE,
+                 force_quit_suspensions=FORCE_QUIT_SUSPENSIONS, **kwargs):
+        super(Simulator, self).__init__(**kwargs)
+        self.low_rating = low_rating
+        self.suspension_low_ratings = suspension_low_ratings
+        self.suspension_min_ratings = suspension_min_ratings
+        self.min_average = min_average
+        self.max_average = max_average
+        self.force_quit_suspensions = force_quit_suspensions
+        self.users = {}
+
+    def user(self, user_id):
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = UserState(self.window)
+        return state
+
+    def strike(self, rating):
+        """
+        Strike a low Rating unless it is struck already. Return whether it
+        was struck.
+        """
+        if rating[STRUCK]:
+            return False
+        rating[STRUCK] = True
+        if rating[RATEE] is not None and rating[SCORE] <= self.low_rating:
+            self.users[rating[RATEE]].low -= 1
+        if rating[RATER] is not None and rating[SCORE] <= redflags.LOWEST_RATING:
+            self.users[rating[RATER]].lowest -= 1
+        return True
+
+    def strike_oldest(self, ratings, n):
+        while n and ratings:
+            if self.strike(ratings.popleft()):
+                n -= 1
+
+    def strike_critical(self, state):
+        self.strike_oldest(state.given, self.critical_ratings)
+        state.complaints -= self.critical_complaints
+
+    def suspend(self, date, user_id, state):
+        state.suspended = True
+        state.suspensions += 1
+        yield Outcome(date, user_id, SUSPENDED)
+        if state.suspensions == self.force_quit_suspensions:
+            yield Outcome(date, user_id, FORCED_OUT)
+
+    def check_suspension(self, date, user_id, state):
+        if state.low >= self.suspension_low_ratings:
+            self.strike_oldest(state.received, self.suspension_low_ratings)
+            yield from self.suspend(date, user_id, state)
+        elif state.count >= self.suspension_min_ratings:
+            average = state.total / state.count
+            if average < self.min_average or average > self.max_average:
+                yield from self.suspend(date, user_id, state)
+
+    def rate(self, date, rater_id, ratee_id, rating_id, score):
+        """
+        Apply the rules to a Rating and yield their Outcomes.
+        """
+        rating = [rater_id, ratee_id, score, False]
+        if rater_id is not None:
+            rater = self.user(rater_id)
+            self.add_rating(rater, rating_id, score)
+            if score <= redflags.LOWEST_RATING:
+                rater.given.append(rating)
+        if ratee_id is not None:
+            ratee = self.user(ratee_id)
+            ratee.count += 1
+            ratee.total += score
+            if score <= self.low_rating:
+                ratee.low += 1
+                ratee.received.append(rating)
+            if not ratee.suspended:
+                yield from self.check_suspension(date, ratee_id, ratee)
+        if rater_id is not None:
+            reason = self.check(rater, True)
+            if reason is not None:
+                yield Outcome(date, rater_id,
+                              GENEROUS if reason == RedFlag.GENEROUS else
+                              CRITICAL)
+
+    def complain(self, date, complainant_id):
+        """
+        Apply the rules to a Complaint and yield their Outcomes.
+        """
+        complainant = self.user(complainant_id)
+        self.add_complaint(complainant)
+        if self.check(complainant, False) is not None:
+            yield Outcome(date, complainant_id, CRITICAL)
+
+    def unsuspend(self, user_id):
+        self.user(user_id).suspended = False
+
+    def replay(self, ratings, complaints, unsuspensions):
+        """
+        Apply the rules to a history and yield their Outcomes.
+
+        ratings is an iterable of (date, rater id, ratee id, Rating id,
+        score), complaints one of (date, complainant id) and unsuspensions
+        one of (date, user id), each in date order.
+        """
+        events = heapq.merge(ratings,
+                             ((date, user_id, None, None, None)
+                              for date, user_id in complaints),
+                             ((date, None, user_id, None, None)
+                              for date, user_id in unsuspensions),
+                             key=lambda event: event[0])
+        for date, user_id, other_id, pk, score in events:
+            if pk is not None:
+                yield from self.rate(date, user_id, other_id, pk, score)
+            elif user_id is not None:
+                yield from self.complain(date, user_id)
+            elif other_id is not None:
+                self.unsuspend(other_id)
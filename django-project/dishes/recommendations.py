@@ -0,0 +1,252 @@
+"""
+Ranking of open Dish Posts for a Diner.
+
+Every open Dish Post is a candidate. The features of the candidates that do
+not depend on the Diner (location, taxonomy label, chef, chef rating and last
+call) are loaded once into NumPy arrays, a CandidateSet, which is rebuilt in
+a background thread once it is CANDIDATE_TTL seconds old. Ranking a page for
+a Diner is then a handful of vectorized operations over those arrays
+followed by a partial sort, with no per-candidate Python code, so it stays
+fast with hundreds of thousands of open posts.
+
+A candidate's score is the weighted sum of:
+
+taste:
+    The share of the Diner's completed Orders that had the candidate's
+    label, from their TasteProfile.
+
+proximity:
+    exp(-distance / DISTANCE_SCALE), where distance is the haversine
+    distance in kilometres between the Diner and the Dish Post.
+
+rating:
+    The chef's average Rating scaled to [0, 1]. Chefs without ratings are
+    given UNRATED_CHEF.
+
+following:
+    1 if the Diner follows the chef, otherwise 0.
+
+urgency:
+    exp(-hours / URGENCY_SCALE), where hours is the time left until last
+    call, so posts about to close are shown before they are gone. Posts past
+    their last call are never ranked.
+"""
+import threading
+import time
+
+import numpy
+from django.db import connection
+from django.utils import timezone
+
+from dishes import geo
+from dishes.models import Chef, DishPost, TasteProfile
+
+WEIGHTS = {
+    "taste": 3.0,
+    "proximity": 2.0,
+    "rating": 1.0,
+    "following": 1.5,
+    "urgency": 0.5,
+}
+
+# Kilometres at which proximity has fallen to 1/e.
+DISTANCE_SCALE = 5.0
+
+# Hours before last call at which urgency has fallen to 1/e.
+URGENCY_SCALE = 6.0
+
+# The average rating assumed for chefs nobody has rated yet.
+UNRATED_CHEF = 3.0
+
+# How long in seconds a CandidateSet is used before it is rebuilt.
+CANDIDATE_TTL = 30
+
+# The chef id of Dish Posts whose Chef has been deleted.
+NO_CHEF = -1
+
+
+class CandidateSet(object):
+    """
+    The Diner-independent features of the open Dish Posts, as parallel
+    arrays with one element per post.
+
+    Attributes:
+
+    ids:
+        The ids of the Dish Posts.
+
+    latitudes, longitudes:
+        The locations of the Dish Posts, in radians.
+
+    label_codes:
+        The index in labels of each Dish Post's taxonomy label.
+
+    labels:
+        The distinct taxonomy labels of the Dish Posts.
+
+    chef_ids:
+        The ids of the Chefs of the Dish Posts.
+
+    ratings:
+        The average Rating of each Dish Post's chef, scaled to [0, 1].
+
+    last_calls:
+        The last call of each Dish Post, in seconds since the epoch.
+    """
+    def __init__(self, ids, latitudes, longitudes, label_codes, labels,
+                 chef_ids, ratings, last_calls):
+        self.ids = ids
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.cos_latitudes = numpy.cos(latitudes)
+        self.label_codes = label_codes
+        self.labels = labels
+        self.label_index = dict((label, i) for i, label in enumerate(labels))
+        self.chef_ids = chef_ids
+        self.ratings = ratings
+        self.last_calls = last_calls
+        self.built = time.monotonic()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls):
+        """
+        Load the features of every open Dish Post with one query.
+        """
+        rows = list(DishPost.objects.filter(status=DishPost.OPEN)
+                                    .values_list("pk", "latitude", "longitude",
+                                                 "dish__alchemy_label",
+                                                 "chef_id",
+                                                 "chef__rating_count",
+                                                 "chef__rating_total",
+                                                 "last_call"))
+        labels = sorted(set(row[3] for row in rows))
+        label_index = dict((label, i) for i, label in enumerate(labels))
+        n = len(rows)
+        return cls(
+            ids=numpy.fromiter((row[0] for row in rows), numpy.int64, n),
+            latitudes=numpy.radians(
+                numpy.fromiter((row[1] for row in rows), numpy.float64, n)),
+            longitudes=numpy.radians(
+                numpy.fromiter((row[2] for row in rows), numpy.float64, n)),
+            label_codes=numpy.fromiter((label_index[row[3]] for row in rows),
+                                       numpy.int32, n),
+            labels=labels,
+            chef_ids=numpy.fromiter((NO_CHEF if row[4] is None else row[4]
+                                     for row in rows),
+                                    numpy.int64, n),
+            ratings=numpy.fromiter(
+                (((row[6] / row[5] if row[5] else UNRATED_CHEF) - 1) / 4
+                 for row in rows),
+                numpy.float64, n),
+            last_calls=numpy.fromiter((row[7].timestamp() for row in rows),
+                                      numpy.float64, n),
+        )
+
+    def distances(self, latitude, longitude):
+        """
+        Return the haversine distance in kilometres from the point to every
+        candidate.
+        """
+        latitude = numpy.radians(float(latitude))
+        longitude = numpy.radians(float(longitude))
+        a = (numpy.sin((self.latitudes - latitude) / 2) ** 2 +
+             numpy.cos(latitude) * self.cos_latitudes *
+             numpy.sin((self.longitudes - longitude) / 2) ** 2)
+        return 2 * geo.EARTH_RADIUS * numpy.arcsin(numpy.sqrt(a))
+
+    def rank(self, latitude, longitude, tastes, followed, now, offset, limit):
+        """
+        Return the ids and scores of the candidates ranked offset to
+        offset + limit.
+
+        tastes maps labels to the share of the Diner's Orders they had,
+        followed is the ids of the Chefs the Diner follows, and now is the
+        current time in seconds since the epoch.
+        """
+        affinity = numpy.zeros(len(self.labels))
+        for label, share in tastes.items():
+            if label in self.label_index:
+                affinity[self.label_index[label]] = share
+        hours = (self.last_calls - now) / 3600
+
+        scores = WEIGHTS["taste"] * affinity[self.label_codes]
+        scores += WEIGHTS["proximity"] * numpy.exp(
+            -self.distances(latitude, longitude) / DISTANCE_SCALE)
+        scores += WEIGHTS["rating"] * self.ratings
+        if followed:
+            scores += WEIGHTS["following"] * numpy.isin(self.chef_ids,
+                                                        list(followed))
+        scores += WEIGHTS["urgency"] * numpy.exp(
+            -numpy.maximum(hours, 0) / URGENCY_SCALE)
+        scores[hours <= 0] = -numpy.inf
+
+        # Only the top offset + limit candidates are sorted.
+        end = min(offset + limit, len(scores))
+        if end <= offset:
+            return [], []
+        top = numpy.argpartition(-scores, end - 1)[:end]
+        top = top[numpy.argsort(-scores[top], kind="stable")][offset:end]
+        top = top[numpy.isfinite(scores[top])]
+        return self.ids[top].tolist(), scores[top].tolist()
+
+
+_candidates = None
+_rebuilding = False
+_candidates_lock = threading.Lock()
+
+
+def _rebuild():
+    global _candidates, _rebuilding
+    try:
+        rebuilt = CandidateSet.build()
+        with _candidates_lock:
+            _candidates = rebuilt
+    finally:
+        with _candidates_lock:
+            _rebuilding = False
+        connection.close()
+
+
+def candidates():
+    """
+    Return the current CandidateSet.
+
+    Only the first call waits for the set to be built. A set that is too old
+    is still returned while a background thread builds its replacement, so
+    no request pays for loading every open Dish Post.
+    """
+    global _candidates, _rebuilding
+    with _candidates_lock:
+        if _candidates is None:
+            _candidates = CandidateSet.build()
+        elif (not _rebuilding and
+                time.monotonic() - _candidates.built > CANDIDATE_TTL):
+            _rebuilding = True
+            threading.Thread(target=_rebuild, daemon=True).start()
+        return _candidates
+
+
+def recommend(diner, offset=0, limit=20):
+    """
+    Return the open Dish Posts ranked offset to offset + limit for the
+    Diner, as (Dish Post, score) pairs, best first.
+    """
+    profile = dict(TasteProfile.objects.filter(diner=diner)
+                                       .values_list("label", "count"))
+    total = sum(profile.values())
+    tastes = dict((label, count / total) for label, count in profile.items())
+    followed = set(Chef.objects.filter(followers=diner)
+                               .values_list("pk", flat=True))
+    ids, scores = candidates().rank(diner.latitude, diner.longitude,
+                                    tastes, followed,
+                                    timezone.now().timestamp(),
+                                    offset, limit)
+    # Posts closed since the CandidateSet was built are left out.
+    posts = (DishPost.objects.filter(status=DishPost.OPEN)
+                             .select_related("dish", "chef")
+                             .in_bulk(ids))
+    return [(posts[pk], score)
+            for pk, score in zip(ids, scores) if pk in posts]
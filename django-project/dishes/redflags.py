@@ -0,0 +1,259 @@
+"""
+Red flags for raters who are too critical or too generous.
+
+Each rater's Ratings and Complaints are streamed through a small state, a
+RaterState, instead of their history being queried on every event. The
+rules are:
+
+critical:
+    A rater with CRITICAL_RATINGS unstruck lowest Ratings and
+    CRITICAL_COMPLAINTS unstruck Complaints is flagged, and that many of each
+    are struck. Checked on every Rating and Complaint.
+
+generous:
+    A rater whose last WINDOW Ratings are all unstruck highest Ratings is
+    flagged, and those Ratings are struck. Checked on every Rating that does
+    not trip the critical rule.
+
+The Detector applying the rules is pure Python and keeps no state of its
+own, so the same rules run online, where record_rating and record_complaint
+keep each rater's state in a RaterWindow row, and offline, where replay
+streams the whole history through states held in memory.
+"""
+import collections
+import heapq
+
+from django.db import IntegrityError, transaction
+
+from accounts.models import Complaint, RedFlag
+from dishes.models import Rating, RaterWindow
+
+# The number of latest Ratings the generous rule looks at.
+WINDOW = 5
+
+HIGHEST_RATING = 5
+LOWEST_RATING = 1
+
+# The unstruck lowest Ratings and Complaints that trip the critical rule.
+CRITICAL_RATINGS = 3
+CRITICAL_COMPLAINTS = 3
+
+# A flag raised by replay, at the date of the event that tripped the rule.
+Flag = collections.namedtuple("Flag", ["user_id", "reason", "date"])
+
+
+class RaterState(object):
+    """
+    What the Detector remembers of a rater.
+
+    Attributes:
+
+    recent:
+        (id, score) pairs of the rater's latest Ratings, oldest first. Struck
+        Ratings have a score of 0.
+
+    lowest:
+        The number of the rater's lowest Ratings that have not been struck.
+
+    complaints:
+        The number of the rater's Complaints that have not been struck.
+    """
+    __slots__ = ("recent", "lowest", "complaints")
+
+    def __init__(self, window, recent=(), lowest=0, complaints=0):
+        self.recent = collections.deque(recent, maxlen=window)
+        self.lowest = lowest
+        self.complaints = complaints
+
+
+class Detector(object):
+    """
+    The red flag rules, with their thresholds.
+    """
+    def __init__(self, window=WINDOW, critical_ratings=CRITICAL_RATINGS,
+                 critical_complaints=CRITICAL_COMPLAINTS):
+        self.window = window
+        self.critical_ratings = critical_ratings
+        self.critical_complaints = critical_complaints
+
+    def state(self, recent=(), lowest=0, complaints=0):
+        """
+        Return a new RaterState.
+        """
+        return RaterState(self.window, recent, lowest, complaints)
+
+    def add_rating(self, state, rating_id, score):
+        state.recent.append((rating_id, score))
+        if score <= LOWEST_RATING:
+            state.lowest += 1
+
+    def add_complaint(self, state):
+        state.complaints += 1
+
+    def is_critical(self, state):
+        return (state.lowest >= self.critical_ratings and
+                state.complaints >= self.critical_complaints)
+
+    def strike_critical(self, state):
+        """
+        Strike the lowest Ratings and Complaints the critical rule strikes
+        from the state.
+        """
+        state.lowest -= self.critical_ratings
+        state.complaints -= self.critical_complaints
+
+    def check(self, state, rated):
+        """
+        Apply the rules to the state after a Rating, if rated is set, or
+        else after a Complaint. Strike what the rule that tripped strikes
+        from the state and return the reason the rater is flagged, or None.
+        """
+        if self.is_critical(state):
+            self.strike_critical(state)
+            return RedFlag.CRITICAL
+        if (rated and len(state.recent) == self.window and
+                all(score == HIGHEST_RATING for _, score in state.recent)):
+            struck = [(pk, 0) for pk, _ in state.recent]
+            state.recent.clear()
+            state.recent.extend(struck)
+            return RedFlag.GENEROUS
+        return None
+
+    def rate(self, state, rating_id, score):
+        self.add_rating(state, rating_id, score)
+        return self.check(state, True)
+
+    def complain(self, state):
+        self.add_complaint(state)
+        return self.check(state, False)
+
+
+def replay(ratings, complaints, detector=None):
+    """
+    Stream a history through the rules and yield a Flag for every flag they
+    raise, without touching the database.
+
+    ratings is an iterable of (date, rater id, Rating id, score) and
+    complaints one of (date, complainant id), each in date order.
+    """
+    detector = detector or Detector()
+    states = {}
+    events = heapq.merge(((date, user_id, pk, score)
+                          for date, user_id, pk, score in ratings),
+                         ((date, user_id, None, None)
+                          for date, user_id in complaints),
+                         key=lambda event: event[0])
+    for date, user_id, pk, score in events:
+        if user_id is None:
+            continue
+        state = states.get(user_id)
+        if state is None:
+            state = states[user_id] = detector.state()
+        if pk is None:
+            reason = detector.complain(state)
+        else:
+            reason = detector.rate(state, pk, score)
+        if reason is not None:
+            yield Flag(user_id, reason, date)
+
+
+def _window(user_id, detector):
+    """
+    Lock and return the RaterWindow of the user, and whether it was just
+    built from the user's Ratings and Complaints.
+    """
+    window = (RaterWindow.objects.select_for_update()
+                                 .filter(user_id=user_id)
+                                 .first())
+    if window is not None:
+        return window, False
+    latest = (Rating.objects.filter(rater_id=user_id)
+                            .order_by("-date", "-pk")
+                            .values_list("pk", "rating", "struck")
+                            [:detector.window])
+    recent = " ".join("{}:{}".format(pk, 0 if struck else score)
+                      for pk, score, struck in reversed(latest))
+    lowest = Rating.objects.filter(rater_id=user_id,
+                                   rating__lte=LOWEST_RATING,
+                                   struck=False).count()
+    complaints = Complaint.objects.filter(complainant_id=user_id,
+                                          struck=False).count()
+    try:
+        with transaction.atomic():
+            window = RaterWindow.objects.create(user_id=user_id, recent=recent,
+                                                lowest=lowest,
+                                                complaints=complaints)
+    except IntegrityError:
+        # Another request built it first.
+        return _window(user_id, detector)
+    return window, True
+
+
+def _record(user_id, rating=None):
+    """
+    Run the rules for a new Rating of the user, or a new Complaint if rating
+    is None, and act on the flag they raise. Return its reason, or None.
+    """
+    detector = Detector()
+    with transaction.atomic():
+        window, built = _window(user_id, detector)
+        recent = [pair.split(":") for pair in window.recent.split()]
+        state = detector.state([(int(pk), int(score)) for pk, score in recent],
+                               window.lowest, window.complaints)
+        # A window just built already holds the new Rating or Complaint.
+        if not built and rating is not None:
+            detector.add_rating(state, rating.pk, rating.rating)
+        elif not built:
+            detector.add_complaint(state)
+        if detector.is_critical(state):
+            # Suspensions strike lowest Ratings behind the window's back.
+            state.lowest = Rating.objects.filter(rater_id=user_id,
+                                                 rating__lte=LOWEST_RATING,
+                                                 struck=False).count()
+        reason = detector.check(state, rating is not None)
+
+        if reason == RedFlag.CRITICAL:
+            Rating.strike(Rating.objects.filter(rater_id=user_id,
+                                                rating__lte=LOWEST_RATING,
+                                                struck=False)
+                                        .order_by("pk")
+                                        [:detector.critical_ratings])
+            complaints = (Complaint.objects.filter(complainant_id=user_id,
+                                                   struck=False)
+                                           .order_by("pk")
+                                           .values_list("pk", flat=True)
+                                           [:detector.critical_complaints])
+            Complaint.objects.filter(pk__in=list(complaints)).update(struck=True)
+        elif reason == RedFlag.GENEROUS:
+            Rating.strike(Rating.objects.filter(
+                pk__in=[pk for pk, _ in state.recent]
+            ))
+        if reason is not None:
+            RedFlag.objects.create(user_id=user_id, reason=reason)
+
+        window.recent = " ".join("{}:{}".format(pk, score)
+                                 for pk, score in state.recent)
+        window.lowest = state.lowest
+        window.complaints = state.complaints
+        window.save()
+    return reason
+
+
+def record_rating(rating):
+    """
+    Run the rules for a new Rating, striking Ratings and Complaints and
+    raising a RedFlag on its rater if one trips. Return the reason of the
+    RedFlag, or None.
+    """
+    if rating.rater_id is None:
+        return None
+    return _record(rating.rater_id, rating)
+
+
+def record_complaint(complaint):
+    """
+    Run the rules for a new Complaint, striking Ratings and Complaints and
+    raising a RedFlag on its complainant if the critical rule trips. Return
+    the reason of the RedFlag, or None.
+    """
+    return _record(complaint.complainant_id)
@@ -0,0 +1,285 @@
+"""
+Transactional operations that move servings and money between users.
+
+Each operation runs in a single database transaction. The rows it reads to
+make a decision are locked with select_for_update, and the decision that
+matters most (whether there are servings left) is made again by a
+conditional UPDATE. On backends without row locks, such as SQLite, that
+UPDATE is what keeps concurrent requests from overselling a Dish Post.
+"""
+import decimal
+import functools
+import random
+import time
+
+from django.db import OperationalError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from accounts import ledger
+from dishes.models import Bid, DishPost, DishRequest, Offer, Order
+
+# The fraction of the price a VIP diner pays.
+VIP_RATE = decimal.Decimal("0.90")
+
+# The most rows written by one bulk INSERT or UPDATE. Keeps the statements
+# under SQLite's parameter limit.
+BATCH_SIZE = 500
+
+# How often an operation is attempted when the database reports that it is
+# locked, and the delay in seconds before the first retry. The delay doubles
+# with every retry and is jittered so competing requests spread out.
+LOCK_ATTEMPTS = 6
+LOCK_BACKOFF = 0.02
+
+
+class BidAcceptanceError(Exception):
+    """
+    Raised when a Bid cannot be accepted.
+    """
+
+
+class OfferAcceptanceError(Exception):
+    """
+    Raised when an Offer cannot be accepted.
+    """
+
+
+def retry_on_lock(func):
+    """
+    Decorator that retries func with exponential backoff while the database
+    reports that it is locked.
+
+    SQLite reports "database is locked" when a writer cannot obtain the
+    database lock within its timeout, and "database table is locked" when
+    connections sharing a cache conflict. Both leave the failed transaction
+    rolled back, so the whole operation is safe to run again. Nothing is
+    retried inside an enclosing atomic block, since the enclosing transaction
+    is no longer usable after the error.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = LOCK_BACKOFF
+        for attempt in range(1, LOCK_ATTEMPTS + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                if ("locked" not in str(error) or
+                        attempt == LOCK_ATTEMPTS or
+                        transaction.get_connection().in_atomic_block):
+                    raise
+            time.sleep(random.uniform(0.5, 1.5) * delay)
+            delay *= 2
+    return wrapper
+
+
+def bid_price(bid, diner_balance):
+    """
+    Return what the diner pays for a Bid, taking the VIP discount into
+    account.
+    """
+    if diner_balance.is_vip:
+        return VIP_RATE * bid.total()
+    return bid.total()
+
+
+def payment_transfers(diner_user, chef_user, paid, price, key):
+    """
+    Return the Transfers paying a chef the full price of a dish the diner
+    paid for.
+
+    The diner pays the chef what they paid. When a VIP discount makes that
+    less than the price, the house pays the chef the difference.
+    """
+    transfers = [ledger.transfer(diner_user, chef_user, paid, key=key)]
+    if paid < price:
+        transfers.append(ledger.transfer(None, chef_user, price - paid,
+                                         key=key + ":discount"))
+    return transfers
+
+
+@retry_on_lock
+def accept_bid(bid_id):
+    """
+    Accept a pending Bid: create its Order, reserve its servings on the Dish
+    Post and transfer the payment from the diner to the chef.
+
+    Raises BidAcceptanceError if the bid is no longer pending, the Dish Post
+    is not open or has too few servings left, or the diner cannot pay. In
+    that case nothing is written.
+    """
+    with transaction.atomic():
+        bid = (Bid.objects.select_for_update()
+                          .select_related("diner__user")
+                          .get(pk=bid_id))
+        if bid.status != Bid.PENDING:
+            raise BidAcceptanceError("This bid is no longer pending.")
+        dish_post = (DishPost.objects.select_for_update()
+                                     .select_related("chef__user")
+                                     .get(pk=bid.dish_post_id))
+        if dish_post.status != DishPost.OPEN:
+            raise BidAcceptanceError("This dish post is no longer open.")
+
+        # Re-check the capacity in the UPDATE itself, against the committed
+        # counter rather than the value read above.
+        reserved = (DishPost.objects
+                    .filter(pk=dish_post.pk,
+                            servings_reserved__lte=F("max_servings") - bid.num_servings)
+                    .update(servings_reserved=F("servings_reserved") + bid.num_servings))
+        if not reserved:
+            raise BidAcceptanceError("There are not enough servings left "
+                                     "to accept this bid.")
+
+        diner_user = bid.diner.user
+        chef_user = dish_post.chef.user
+        balances = ledger.lock_balances([diner_user.pk, chef_user.pk])
+        total = bid_price(bid, balances[diner_user.pk])
+        try:
+            ledger.post(payment_transfers(diner_user, chef_user,
+                                          total, bid.total(),
+                                          key="bid:{}".format(bid.pk)))
+        except ledger.InsufficientFunds:
+            raise BidAcceptanceError("The diner has insufficient funds "
+                                     "to pay for this bid.")
+
+        order = Order.objects.create(
+            diner=bid.diner,
+            dish_post=dish_post,
+            bid=bid,
+            num_servings=bid.num_servings
+        )
+        bid.status = Bid.ACCEPTED
+        bid.save(update_fields=["status"])
+    return order
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@retry_on_lock
+def clear_book(dish_post_id):
+    """
+    Settle every pending Bid on an open Dish Post at once: fill the bids
+    greedily, highest serving price first and earliest first among equal
+    prices, while servings are left and the diner can pay, and reject the
+    rest.
+
+    The Orders of the filled bids are bulk inserted, their payments posted
+    as one ledger batch and the statuses of the bids set with bulk UPDATEs,
+    all in one transaction. Returns the Orders and the number of Bids
+    rejected.
+
+    Raises BidAcceptanceError if the Dish Post is not open. In that case
+    nothing is written.
+    """
+    with transaction.atomic():
+        dish_post = (DishPost.objects.select_for_update()
+                                     .select_related("chef__user")
+                                     .get(pk=dish_post_id))
+        if dish_post.status != DishPost.OPEN:
+            raise BidAcceptanceError("This dish post is no longer open.")
+        bids = list(Bid.objects.select_for_update()
+                               .filter(dish_post=dish_post, status=Bid.PENDING)
+                               .select_related("diner__user")
+                               .order_by("-price", "pk"))
+        chef_user = dish_post.chef.user
+        balances = ledger.lock_balances(
+            set(bid.diner.user_id for bid in bids if bid.diner) | {chef_user.pk}
+        )
+
+        left = dish_post.max_servings - dish_post.servings_reserved
+        spent = dict((user_id, 0) for user_id in balances)
+        filled, rejected, transfers = [], [], []
+        for bid in bids:
+            if bid.diner is None or bid.num_servings > left:
+                rejected.append(bid.pk)
+                continue
+            diner_user = bid.diner.user
+            total = bid_price(bid, balances[diner_user.pk])
+            if not balances[diner_user.pk].has_funds(spent[diner_user.pk] + total):
+                rejected.append(bid.pk)
+                continue
+            left -= bid.num_servings
+            spent[diner_user.pk] += total
+            filled.append(bid)
+            transfers.extend(payment_transfers(diner_user, chef_user,
+                                               total, bid.total(),
+                                               key="bid:{}".format(bid.pk)))
+
+        servings = sum(bid.num_servings for bid in filled)
+        if servings:
+            # As in accept_bid, the capacity is re-checked by the UPDATE.
+            reserved = (DishPost.objects
+                        .filter(pk=dish_post.pk,
+                                servings_reserved__lte=F("max_servings") - servings)
+                        .update(servings_reserved=F("servings_reserved") + servings))
+            if not reserved:
+                raise BidAcceptanceError("There are not enough servings left "
+                                         "to accept these bids.")
+        try:
+            ledger.post(transfers)
+        except ledger.InsufficientFunds:
+            raise BidAcceptanceError("A diner has insufficient funds "
+                                     "to pay for their bid.")
+        orders = [Order(diner=bid.diner,
+                        dish_post=dish_post,
+                        bid=bid,
+                        num_servings=bid.num_servings)
+                  for bid in filled]
+        Order.objects.bulk_create(orders, batch_size=BATCH_SIZE)
+        for chunk in _chunks([bid.pk for bid in filled]):
+            Bid.objects.filter(pk__in=chunk).update(status=Bid.ACCEPTED)
+        for chunk in _chunks(rejected):
+            Bid.objects.filter(pk__in=chunk).update(status=Bid.REJECTED)
+    return orders, len(rejected)
+
+
+@retry_on_lock
+def accept_offer(offer_id, diner_user):
+    """
+    Accept a pending Offer on one of diner_user's Dish Requests: mark the
+    Dish Request accepted, accept the Offer, reject every other pending Offer
+    on the request and transfer the payment from the diner to the chef.
+
+    Each step is a single UPDATE or ledger post, so the cost does not depend
+    on how many Offers the request has.
+
+    Raises OfferAcceptanceError if the Dish Request is not diner_user's or
+    is no longer open, the Offer is no longer pending, or the diner cannot
+    pay. In that case nothing is written.
+    """
+    with transaction.atomic():
+        offer = (Offer.objects.select_related("chef__user", "dish_request__diner")
+                              .get(pk=offer_id))
+        dish_request = offer.dish_request
+        owner = dish_request.diner if dish_request is not None else None
+        if owner is None or owner.user_id != diner_user.pk:
+            raise OfferAcceptanceError("Only the diner who made the request "
+                                       "can accept its offers.")
+
+        # The conditional UPDATEs decide: only one Offer of a request is ever
+        # accepted, even if the diner accepts two at once.
+        accepted = (DishRequest.objects
+                    .filter(pk=dish_request.pk, status=DishRequest.OPEN)
+                    .update(status=DishRequest.ACCEPTED, modified=timezone.now()))
+        if not accepted:
+            raise OfferAcceptanceError("This request is no longer open.")
+        if not (Offer.objects.filter(pk=offer.pk, status=Offer.PENDING)
+                             .update(status=Offer.ACCEPTED)):
+            raise OfferAcceptanceError("This offer is no longer pending.")
+        (Offer.objects.filter(dish_request=dish_request, status=Offer.PENDING)
+                      .update(status=Offer.REJECTED))
+
+        chef_user = offer.chef.user
+        balances = ledger.lock_balances([diner_user.pk, chef_user.pk])
+        price = offer.total()
+        total = VIP_RATE * price if balances[diner_user.pk].is_vip else price
+        try:
+            ledger.post(payment_transfers(diner_user, chef_user, total, price,
+                                          key="offer:{}".format(offer.pk)))
+        except ledger.InsufficientFunds:
+            raise OfferAcceptanceError("You must have sufficient funds to "
+                                       "accept an offer.")
+    return offer
@@ -1,3 +1,1261 @@
-from django.test import TestCase
+import decimal
+import datetime
+import io
+import sys
+import threading
+import types
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts import ledger
+from accounts.models import Balance, Complaint, RedFlag, SuspensionInfo
+from dishes import (
+    classification, classifiers, feeds, geo, lifecycle, pagination, policies,
+    recommendations, redflags, services, views
+)
+from dishes.models import (
+    Bid, CachedLabel, Chef, ClassificationTask, Diner, Dish, DishPost,
+    DishRequest, FanOutTask, FeedItem, Offer, Order, Rating, RatingSummary,
+    TasteProfile
+)
+
+
+def create_user(username, amount=0, chef=False):
+    """
+    Create a User with the Diner, Balance and SuspensionInfo rows every NGS
+    account has, and a Chef if chef is set.
+    """
+    user = User.objects.create(username=username)
+    Diner.objects.create(user=user)
+    Balance.objects.create(user=user)
+    if amount:
+        ledger.post([ledger.transfer(None, user, decimal.Decimal(amount))])
+    SuspensionInfo.objects.create(user=user)
+    if chef:
+        Chef.objects.create(user=user)
+    return user
+
+
+def create_dish_post(chef, max_servings=1, **kwargs):
+    dish = Dish.objects.create(name="Pizza", description="Cheese")
+    now = timezone.now()
+    data = {
+        "chef": chef,
+        "dish": dish,
+        "max_servings": max_servings,
+        "min_price": decimal.Decimal(5),
+        "serving_size": decimal.Decimal(1),
+        "last_call": now + datetime.timedelta(days=1),
+        "meal_time": now + datetime.timedelta(days=2),
+    }
+    data.update(kwargs)
+    return DishPost.objects.create(**data)
+
+
+class AcceptBidTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.diner = create_user("diner", amount=100).diner
+        self.dish_post = create_dish_post(self.chef, max_servings=3)
+
+    def bid(self, num_servings, price=5):
+        return Bid.objects.create(diner=self.diner,
+                                  dish_post=self.dish_post,
+                                  num_servings=num_servings,
+                                  price=decimal.Decimal(price))
+
+    def test_accept_bid_transfers_payment(self):
+        order = services.accept_bid(self.bid(2).pk)
+        self.dish_post.refresh_from_db()
+        self.assertEqual(order.num_servings, 2)
+        self.assertEqual(self.dish_post.servings_reserved, 2)
+        self.assertEqual(Balance.objects.get(user=self.diner.user).amount, 90)
+        self.assertEqual(Balance.objects.get(user=self.chef.user).amount, 10)
+
+    def test_oversold_bid_is_rejected_without_side_effects(self):
+        services.accept_bid(self.bid(2).pk)
+        bid = self.bid(2)
+        with self.assertRaises(services.BidAcceptanceError):
+            services.accept_bid(bid.pk)
+        bid.refresh_from_db()
+        self.dish_post.refresh_from_db()
+        self.assertEqual(bid.status, Bid.PENDING)
+        self.assertEqual(self.dish_post.servings_reserved, 2)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_bid_is_accepted_once(self):
+        bid = self.bid(1)
+        services.accept_bid(bid.pk)
+        with self.assertRaises(services.BidAcceptanceError):
+            services.accept_bid(bid.pk)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_tip_over_the_balance_is_reported(self):
+        order = services.accept_bid(self.bid(2).pk)
+        self.client.force_login(self.diner.user)
+        url = "/dishes/orders/{}/feedback/".format(order.pk)
+        response = self.client.post(url, {"rating": 4, "feedback": "Good",
+                                          "tip": "95"})
+        self.assertContains(response, "Your balance does not cover this tip.")
+        order.refresh_from_db()
+        self.assertNotEqual(order.status, Order.COMPLETE)
+        self.assertFalse(Rating.objects.exists())
+
+        self.client.post(url, {"rating": 4, "feedback": "Good", "tip": "5"})
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.COMPLETE)
+        self.assertEqual(Balance.objects.get(user=self.diner.user).amount, 85)
+
+    def test_saving_a_stale_post_keeps_the_reservations(self):
+        stale = DishPost.objects.get(pk=self.dish_post.pk)
+        services.accept_bid(self.bid(2).pk)
+        stale.max_servings = 4
+        stale.save()
+        self.dish_post.refresh_from_db()
+        self.assertEqual((self.dish_post.max_servings,
+                          self.dish_post.servings_reserved), (4, 2))
+
+    def test_cancelling_an_order_releases_its_servings_once(self):
+        order = services.accept_bid(self.bid(2).pk)
+        self.client.force_login(self.diner.user)
+        for _ in range(2):
+            self.client.post("/dishes/orders/{}/cancel/".format(order.pk))
+        self.dish_post.refresh_from_db()
+        self.assertEqual(self.dish_post.servings_reserved, 0)
+
+    def test_rebuild_servings_reserved(self):
+        services.accept_bid(self.bid(2).pk)
+        call_command("rebuild_servings_reserved", check=True, verbosity=0,
+                     stdout=io.StringIO())
+        DishPost.objects.filter(pk=self.dish_post.pk).update(servings_reserved=0)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_servings_reserved", check=True, verbosity=0)
+        call_command("rebuild_servings_reserved", verbosity=0)
+        self.dish_post.refresh_from_db()
+        self.assertEqual(self.dish_post.servings_reserved, 2)
+
+
+class ClearBookTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.dish_post = create_dish_post(self.chef, max_servings=5)
+
+    def bid(self, diner, num_servings, price, dish_post=None):
+        return Bid.objects.create(diner=diner,
+                                  dish_post=dish_post or self.dish_post,
+                                  num_servings=num_servings,
+                                  price=decimal.Decimal(price))
+
+    def test_bids_are_filled_by_price_then_arrival(self):
+        rich = create_user("rich", amount=100).diner
+        poor = create_user("poor", amount=5).diner
+        first = self.bid(rich, 3, 7)
+        unaffordable = self.bid(poor, 1, 8)
+        too_big = self.bid(rich, 3, 6)
+        fits = self.bid(rich, 2, 6)
+        late = self.bid(rich, 1, 6)
+
+        orders, rejected = services.clear_book(self.dish_post.pk)
+
+        self.assertEqual([order.bid for order in orders], [first, fits])
+        self.assertEqual(rejected, 3)
+        statuses = dict(Bid.objects.values_list("pk", "status"))
+        self.assertEqual(statuses, {first.pk: Bid.ACCEPTED,
+                                    unaffordable.pk: Bid.REJECTED,
+                                    too_big.pk: Bid.REJECTED,
+                                    fits.pk: Bid.ACCEPTED,
+                                    late.pk: Bid.REJECTED})
+        self.dish_post.refresh_from_db()
+        self.assertEqual(self.dish_post.servings_reserved, 5)
+        self.assertEqual(Order.objects.filter(dish_post=self.dish_post).count(), 2)
+        self.assertEqual(Balance.objects.get(user=rich.user).amount, 67)
+        self.assertEqual(Balance.objects.get(user=poor.user).amount, 5)
+        self.assertEqual(Balance.objects.get(user=self.chef.user).amount, 33)
+
+    def test_query_count_does_not_grow_with_bids(self):
+        counts = []
+        for n in (2, 20):
+            dish_post = create_dish_post(self.chef, max_servings=n)
+            for i in range(n):
+                self.bid(create_user("diner{}-{}".format(n, i), amount=10).diner,
+                         1, 5, dish_post=dish_post)
+            with CaptureQueriesContext(connection) as queries:
+                orders, rejected = services.clear_book(dish_post.pk)
+            self.assertEqual(len(orders), n)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_only_the_chef_can_clear_the_book(self):
+        bid = self.bid(create_user("diner", amount=100).diner, 1, 5)
+        url = "/dishes/posts/manage/{}/bids/clear/".format(self.dish_post.pk)
+        self.client.force_login(create_user("other", chef=True))
+        self.assertEqual(self.client.post(url).status_code, 404)
+        self.assertEqual(Bid.objects.get(pk=bid.pk).status, Bid.PENDING)
+
+        self.client.force_login(self.chef.user)
+        response = self.client.post(url)
+        self.assertContains(response, "Accepted 1 bids and rejected 0.")
+        self.assertEqual(Bid.objects.get(pk=bid.pk).status, Bid.ACCEPTED)
+
+    def test_closed_post_is_not_cleared(self):
+        DishPost.objects.filter(pk=self.dish_post.pk).update(status=DishPost.CANCELLED)
+        bid = self.bid(create_user("diner", amount=100).diner, 1, 5)
+        with self.assertRaises(services.BidAcceptanceError):
+            services.clear_book(self.dish_post.pk)
+        self.assertEqual(Bid.objects.get(pk=bid.pk).status, Bid.PENDING)
+
+
+class AcceptOfferTest(TestCase):
+
+    def setUp(self):
+        self.diner = create_user("diner", amount=100).diner
+        self.dish_request = DishRequest.objects.create(
+            diner=self.diner,
+            dish=Dish.objects.create(name="Soup", description="Hot"),
+            portion_size=decimal.Decimal(1),
+            num_servings=2,
+            min_price=decimal.Decimal(5),
+            meal_time=timezone.now() + datetime.timedelta(days=1)
+        )
+        self.offers = [
+            Offer.objects.create(chef=create_user("chef{}".format(i), chef=True).chef,
+                                 dish_request=self.dish_request,
+                                 price=decimal.Decimal(6))
+            for i in range(20)
+        ]
+
+    def test_accept_offer_rejects_the_rest_and_pays_the_chef(self):
+        winner = self.offers[3]
+        # Fixed regardless of the number of offers: no UPDATE per offer.
+        with self.assertNumQueries(13):
+            services.accept_offer(winner.pk, self.diner.user)
+        statuses = dict(Offer.objects.values_list("pk", "status"))
+        self.assertEqual(statuses.pop(winner.pk), Offer.ACCEPTED)
+        self.assertEqual(set(statuses.values()), {Offer.REJECTED})
+        self.dish_request.refresh_from_db()
+        self.assertEqual(self.dish_request.status, DishRequest.ACCEPTED)
+        self.assertEqual(Balance.objects.get(user=self.diner.user).amount, 88)
+        self.assertEqual(Balance.objects.get(user=winner.chef.user).amount, 12)
+
+    def test_offer_is_accepted_once(self):
+        services.accept_offer(self.offers[0].pk, self.diner.user)
+        with self.assertRaises(services.OfferAcceptanceError):
+            services.accept_offer(self.offers[1].pk, self.diner.user)
+        self.assertEqual(Offer.objects.filter(status=Offer.ACCEPTED).count(), 1)
+        self.assertEqual(Balance.objects.get(user=self.diner.user).amount, 88)
+
+    def test_failed_payment_writes_nothing(self):
+        poor = create_user("poor").diner
+        DishRequest.objects.filter(pk=self.dish_request.pk).update(diner=poor)
+        with self.assertRaises(services.OfferAcceptanceError):
+            services.accept_offer(self.offers[0].pk, poor.user)
+        self.assertFalse(Offer.objects.exclude(status=Offer.PENDING).exists())
+        self.dish_request.refresh_from_db()
+        self.assertEqual(self.dish_request.status, DishRequest.OPEN)
+
+    def test_only_the_requesting_diner_can_accept(self):
+        with self.assertRaises(services.OfferAcceptanceError):
+            services.accept_offer(self.offers[0].pk, create_user("other", 100))
+        self.assertFalse(Offer.objects.exclude(status=Offer.PENDING).exists())
+
+
+class AcceptBidConcurrencyTest(TransactionTestCase):
+    """
+    Many chefs' clicks racing for the servings of a single Dish Post.
+    """
+    NTHREADS = 16
+    MAX_SERVINGS = 5
+
+    def test_concurrent_accepts_never_oversell(self):
+        chef = create_user("chef", chef=True).chef
+        dish_post = create_dish_post(chef, max_servings=self.MAX_SERVINGS)
+        bids = []
+        for i in range(self.NTHREADS):
+            diner = create_user("diner{}".format(i), amount=100).diner
+            bids.append(Bid.objects.create(diner=diner,
+                                           dish_post=dish_post,
+                                           num_servings=1,
+                                           price=decimal.Decimal(10)))
+
+        barrier = threading.Barrier(self.NTHREADS)
+        accepted = []
+        rejected = []
+        errors = []
+
+        def accept(bid):
+            try:
+                barrier.wait()
+                services.accept_bid(bid.pk)
+                accepted.append(bid.pk)
+            except services.BidAcceptanceError:
+                rejected.append(bid.pk)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(bid,)) for bid in bids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(accepted), self.MAX_SERVINGS)
+        self.assertEqual(len(rejected), self.NTHREADS - self.MAX_SERVINGS)
+        dish_post.refresh_from_db()
+        self.assertEqual(dish_post.servings_reserved, self.MAX_SERVINGS)
+        self.assertEqual(Order.objects.filter(dish_post=dish_post).count(),
+                         self.MAX_SERVINGS)
+        self.assertEqual(
+            sorted(Bid.objects.filter(status=Bid.ACCEPTED).values_list("pk", flat=True)),
+            sorted(accepted)
+        )
+        # Every transfer happened in full or not at all.
+        self.assertEqual(Balance.objects.get(user=chef.user).amount,
+                         10 * self.MAX_SERVINGS)
+        total = sum(balance.amount for balance in Balance.objects.all())
+        self.assertEqual(total, 100 * self.NTHREADS)
+
+
+class ClassificationQueueTest(TestCase):
+    LABELS = {"Pizza": "/food and drink/cuisines/italian cuisine", "Gruel": ""}
+
+    def setUp(self):
+        classification.cache.clear()
+        self.calls = []
+
+    def stub_classify(self, name):
+        self.calls.append(name)
+        return self.LABELS[name]
+
+    def enqueue(self, name):
+        dish = Dish.objects.create(name=name, description="")
+        classification.enqueue(dish)
+        return dish
+
+    def test_worker_writes_back_labels(self):
+        dish = self.enqueue("Pizza")
+        self.assertEqual(classification.process_batch(self.stub_classify),
+                         (1, 0))
+        dish.refresh_from_db()
+        self.assertEqual(dish.alchemy_label, self.LABELS["Pizza"])
+        self.assertFalse(ClassificationTask.objects.exists())
+
+    def test_failed_task_is_retried_later(self):
+        dish = self.enqueue("Borscht")
+        self.assertEqual(classification.process_batch(self.stub_classify),
+                         (0, 1))
+        task = ClassificationTask.objects.get(dish=dish)
+        self.assertEqual(task.attempts, 1)
+        self.assertIn("KeyError", task.last_error)
+        self.assertGreater(task.next_attempt, timezone.now())
+        # The task is not due again until its backoff has passed.
+        self.assertEqual(classification.process_batch(self.stub_classify),
+                         (0, 0))
+
+    def test_empty_labels_are_not_cached(self):
+        self.enqueue("Gruel")
+        self.assertEqual(classification.process_batch(self.stub_classify),
+                         (1, 0))
+        self.assertFalse(CachedLabel.objects.exists())
+        self.enqueue("Gruel")
+        self.assertTrue(ClassificationTask.objects.exists())
+
+    def test_normalize(self):
+        self.assertEqual(classification.normalize(" Fried  Chickens! "),
+                         "fried chicken")
+        self.assertEqual(classification.normalize("Cherries & Peaches"),
+                         "cherry peach")
+
+    def test_cached_names_are_classified_once(self):
+        self.enqueue("Pizza")
+        self.enqueue("pizza")
+        self.assertEqual(classification.process_batch(self.stub_classify),
+                         (2, 0))
+        self.assertEqual(self.calls, ["Pizza"])
+        # Later dishes of the same name are labelled without being queued.
+        dish = self.enqueue("PIZZAS")
+        self.assertEqual(dish.alchemy_label, self.LABELS["Pizza"])
+        self.assertFalse(ClassificationTask.objects.exists())
+        self.assertEqual(classification.cache.stats()["memory_hits"], 1)
+
+
+class LocalClassifierTest(TestCase):
+    EXAMPLES = [
+        ("Sesame Chicken", "/food and drink/cuisines/chinese cuisine"),
+        ("Chicken Chow Mein", "/food and drink/cuisines/chinese cuisine"),
+        ("Cheeseburgers", "/food and drink/food/fast food"),
+        ("Triple Cheeseburger", "/food and drink/food/fast food"),
+        ("Key Lime pie", "/food and drink/desserts and baking"),
+    ]
+
+    def test_classifies_variants_of_known_names(self):
+        classify = classifiers.LocalClassifier(self.EXAMPLES)
+        self.assertEqual(classify("Double cheese burger"),
+                         "/food and drink/food/fast food")
+        self.assertEqual(classify("Beef Chow Mein"),
+                         "/food and drink/cuisines/chinese cuisine")
+        self.assertEqual(classify("Xyzzy"), "")
+
+    @override_settings(DISH_CLASSIFIER="dishes.classifiers.LocalClassifier")
+    def test_inline_classifier_labels_without_queueing(self):
+        classification.cache.clear()
+        Dish.objects.create(name="Sesame Chicken", description="",
+                            alchemy_label=self.EXAMPLES[0][1])
+        # Build the local model from the Dish above.
+        classification._classifiers.clear()
+        self.addCleanup(classification._classifiers.clear)
+        dish = Dish.objects.create(name="Orange Chicken", description="")
+        classification.enqueue(dish)
+        dish.refresh_from_db()
+        self.assertEqual(dish.alchemy_label, self.EXAMPLES[0][1])
+        self.assertFalse(ClassificationTask.objects.exists())
+        # The local model's guesses are not cached for other classifiers.
+        self.assertFalse(CachedLabel.objects.exists())
+        self.assertIsNone(classification.cache.get("Orange Chicken"))
+
+
+class WatsonClassifierTest(TestCase):
+
+    def test_client_is_built_once_on_first_use(self):
+        clients = []
+
+        class AlchemyLanguageV1(object):
+            def __init__(self, api_key):
+                self.api_key = api_key
+                clients.append(self)
+
+            def taxonomy(self, text):
+                return {"taxonomy": [{"label": "/food/" + text.lower()}]}
+
+        sdk = types.ModuleType("watson_developer_cloud")
+        sdk.AlchemyLanguageV1 = AlchemyLanguageV1
+        classify = classifiers.WatsonClassifier(api_key="key")
+        with mock.patch.dict(sys.modules, {"watson_developer_cloud": sdk}):
+            self.assertEqual(clients, [])
+            self.assertEqual(classify("Pizza"), "/food/pizza")
+            self.assertEqual(classify("Soup"), "/food/soup")
+        self.assertEqual(len(clients), 1)
+        self.assertEqual(clients[0].api_key, "key")
+
+
+class TasteProfileTest(TestCase):
+
+    def setUp(self):
+        self.diner = create_user("diner").diner
+
+    def test_top_labels_are_the_most_frequent(self):
+        for label in ["/a", "/b", "/b", "/c", "/c", "/c", ""]:
+            TasteProfile.record(self.diner.pk, label)
+        self.assertEqual(TasteProfile.top_labels(self.diner, 2), ["/c", "/b"])
+        self.assertEqual(TasteProfile.objects.count(), 3)
+
+    def test_rebuild_taste_profiles(self):
+        chef = create_user("chef", chef=True).chef
+        dish_post = create_dish_post(chef)
+        dish_post.dish.alchemy_label = "/a"
+        dish_post.dish.save()
+        bid = Bid.objects.create(diner=self.diner, dish_post=dish_post,
+                                 num_servings=1, price=decimal.Decimal(5))
+        for status in (Order.COMPLETE, Order.COMPLETE, Order.CANCELLED):
+            Order.objects.create(diner=self.diner, dish_post=dish_post,
+                                 bid=bid, status=status)
+        TasteProfile.record(self.diner.pk, "/stale")
+        call_command("rebuild_taste_profiles", verbosity=0)
+        self.assertEqual(
+            list(TasteProfile.objects.values_list("label", "count")),
+            [("/a", 2)]
+        )
+
+
+class RecommendationTest(TestCase):
+
+    def setUp(self):
+        self.diner = create_user("diner").diner
+        self.chef = create_user("chef", chef=True).chef
+        self.near = create_dish_post(self.chef,
+                                     latitude=decimal.Decimal("0.001"),
+                                     longitude=decimal.Decimal("0.001"))
+        self.far = create_dish_post(self.chef,
+                                    latitude=decimal.Decimal("1"),
+                                    longitude=decimal.Decimal("1"))
+        self.closed = create_dish_post(
+            self.chef,
+            last_call=timezone.now() - datetime.timedelta(hours=1)
+        )
+
+    def rank(self, tastes=None):
+        candidates = recommendations.CandidateSet.build()
+        ids, scores = candidates.rank(self.diner.latitude,
+                                      self.diner.longitude,
+                                      tastes or {}, set(),
+                                      timezone.now().timestamp(), 0, 10)
+        return ids
+
+    def test_nearest_first_and_past_last_call_excluded(self):
+        self.assertEqual(self.rank(), [self.near.pk, self.far.pk])
+
+    def test_taste_outweighs_distance(self):
+        Dish.objects.filter(pk=self.far.dish_id).update(alchemy_label="/a")
+        self.assertEqual(self.rank({"/a": 1.0}), [self.far.pk, self.near.pk])
+
+    def recommended(self):
+        self.client.force_login(self.diner.user)
+        response = self.client.get("/dishes/posts/recommended/")
+        self.assertEqual(response.status_code, 200)
+        return [post["id"] for post in response.json()["posts"]]
+
+    def test_posts_of_deleted_chefs_are_ranked(self):
+        orphan = create_dish_post(create_user("gone", chef=True).chef)
+        Chef.objects.filter(pk=orphan.chef_id).delete()
+        recommendations._candidates = recommendations.CandidateSet.build()
+        self.addCleanup(setattr, recommendations, "_candidates", None)
+        self.assertIn(orphan.pk, self.recommended())
+
+    def test_posts_closed_since_the_build_are_left_out(self):
+        recommendations._candidates = recommendations.CandidateSet.build()
+        self.addCleanup(setattr, recommendations, "_candidates", None)
+        DishPost.objects.filter(pk=self.near.pk).update(status=DishPost.CANCELLED)
+        self.assertEqual(self.recommended(), [self.far.pk])
+
+
+class MarkerFeedTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.kept, self.closed = [create_dish_post(self.chef) for _ in range(2)]
+
+    def feed(self, since=None):
+        response = self.client.get("/dishes/posts/feed/",
+                                   {"since": since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def ids(self, data):
+        return sorted(marker["id"] for marker in data["markers"])
+
+    def test_since_returns_only_rows_changed_after_the_cursor(self):
+        snapshot = self.feed()
+        self.assertEqual(self.ids(snapshot), [self.kept.pk, self.closed.pk])
+        self.assertEqual(self.feed(snapshot["cursor"])["markers"], [])
+
+        self.closed.status = DishPost.CANCELLED
+        self.closed.save()
+        added = create_dish_post(self.chef)
+        changes = self.feed(snapshot["cursor"])
+        self.assertEqual(self.ids(changes), [added.pk])
+        self.assertEqual(changes["removed"], [self.closed.pk])
+        self.assertEqual(self.feed(changes["cursor"])["markers"], [])
+
+    def test_malformed_cursor_falls_back_to_a_snapshot(self):
+        for since in ("garbage", "1-2-3", "{}-1".format(10**30)):
+            with self.subTest(since=since):
+                data = self.feed(since)
+                self.assertEqual(self.ids(data), [self.kept.pk, self.closed.pk])
+                self.assertEqual(data["removed"], [])
+
+
+class GeoTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.inside = [
+            create_dish_post(self.chef, latitude=decimal.Decimal(lat),
+                             longitude=decimal.Decimal(lng))
+            for lat, lng in [("40.7000", "-74.0100"), ("40.7010", "-74.0110"),
+                             ("40.7500", "-73.9500")]
+        ]
+        self.outside = create_dish_post(self.chef,
+                                        latitude=decimal.Decimal("40.8000"),
+                                        longitude=decimal.Decimal("-74.0000"))
+
+    def test_encode(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geo.encode(40.7128, -74.0060), "dr5regw3p")
+        self.assertEqual(geo.encode(40.7128, -74.0060, 4), "dr5r")
+
+    def test_covering_cells(self):
+        # A box inside one cell is covered by that cell alone.
+        cells = geo.covering_cells(40.71, -74.01, 40.7101, -74.0099, max_cells=1)
+        self.assertEqual(len(cells), 1)
+        self.assertTrue(geo.encode(40.71, -74.01).startswith(cells[0]))
+        self.assertTrue(geo.encode(40.7101, -74.0099).startswith(cells[0]))
+        # Cells dr5r and dr5x meet at longitude -73.828125.
+        cells = geo.covering_cells(40.70, -73.83, 40.71, -73.82, max_cells=4)
+        self.assertEqual(cells, ["dr5rx", "dr5x8"])
+        for lat, lng in ((40.705, -73.829), (40.705, -73.827)):
+            self.assertTrue(any(geo.encode(lat, lng).startswith(cell)
+                                for cell in cells))
+        self.assertEqual(geo.covering_cells(-90, -180, 90, 180, max_cells=1),
+                         [""])
+
+    def test_within(self):
+        found = DishPost.objects.within(40.69, -74.02, 40.76, -73.94)
+        self.assertEqual(sorted(found.values_list("pk", flat=True)),
+                         [post.pk for post in self.inside])
+
+    def test_clusters(self):
+        clusters = DishPost.objects.within(40.69, -74.02, 40.76, -73.94).clusters(5)
+        self.assertEqual(sorted(cluster["count"] for cluster in clusters), [1, 2])
+
+    def test_posts_in_bounds(self):
+        bounds = {"south": "40.69", "west": "-74.02",
+                  "north": "40.76", "east": "-73.94"}
+        data = self.client.get("/dishes/posts/bounds/", bounds).json()
+        self.assertEqual(data["count"], 3)
+        self.assertEqual(sorted(marker["id"] for marker in data["markers"]),
+                         [post.pk for post in self.inside])
+        with mock.patch.object(views, "MAP_MARKER_LIMIT", 2):
+            data = self.client.get("/dishes/posts/bounds/", bounds).json()
+        self.assertEqual(data["markers"], [])
+        self.assertEqual(sum(cluster["count"] for cluster in data["clusters"]), 3)
+
+    def test_posts_in_bounds_rejects_bad_bounds(self):
+        for south in ("nan", "inf", "-inf", "x"):
+            with self.subTest(south=south):
+                response = self.client.get("/dishes/posts/bounds/", {
+                    "south": south, "west": "-74", "north": "41", "east": "-73"
+                })
+                self.assertEqual(response.status_code, 400)
+
+
+class NearbyTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.posts = [
+            create_dish_post(self.chef, latitude=decimal.Decimal(lat),
+                             longitude=decimal.Decimal(lng))
+            for lat, lng in [("40.7300", "-73.9900"),
+                             ("40.7000", "-74.0000"),
+                             ("40.7120", "-74.0050"),
+                             ("41.5000", "-74.0000")]
+        ]
+
+    def test_around_filters_by_radius_and_sorts_by_distance(self):
+        found = (DishPost.objects.around(40.7128, -74.0060, 5, 0.25)
+                                 .order_by("distance_bucket", "id"))
+        self.assertEqual([post.pk for post in found],
+                         [self.posts[2].pk, self.posts[1].pk, self.posts[0].pk])
+
+    def test_around_measures_across_the_antimeridian(self):
+        east = create_dish_post(self.chef, latitude=decimal.Decimal("-17"),
+                                longitude=decimal.Decimal("179.99"))
+        west = create_dish_post(self.chef, latitude=decimal.Decimal("-17"),
+                                longitude=decimal.Decimal("-179.98"))
+        found = (DishPost.objects.around(-17, 179.995, 5, 0.25)
+                                 .order_by("distance_bucket", "id"))
+        self.assertEqual([post.pk for post in found], [east.pk, west.pk])
+        found = DishPost.objects.around(-17, -179.995, 5, 0.25)
+        self.assertEqual(set(post.pk for post in found), {east.pk, west.pk})
+
+    def test_posts_lists_nearby_page(self):
+        self.client.force_login(create_user("diner"))
+        response = self.client.get("/dishes/posts/",
+                                   {"lat": "40.7128", "lng": "-74.0060",
+                                    "radius": "5"})
+        self.assertEqual([row.pk for row in response.context["nearby"]],
+                         [self.posts[2].pk, self.posts[1].pk, self.posts[0].pk])
+        for row in response.context["nearby"]:
+            self.assertAlmostEqual(
+                row.distance,
+                geo.distance(40.7128, -74.0060, row.latitude, row.longitude))
+
+    def test_farther_links_keep_the_search_origin(self):
+        self.client.force_login(create_user("diner"))
+        listed = []
+        query = "lat=40.7128&lng=-74.0060&radius=50"
+        with mock.patch.object(views, "NEARBY_PER_PAGE", 1):
+            while query:
+                response = self.client.get("/dishes/posts/?" + query)
+                listed.extend(row.pk for row in response.context["nearby"])
+                query = response.context["farther_query"]
+                if query:
+                    self.assertIn("lat=40.7128", query)
+                    self.assertContains(response, "?" + query.replace("&", "&amp;"))
+        self.assertEqual(listed, [self.posts[2].pk, self.posts[1].pk,
+                                  self.posts[0].pk])
+
+    def test_bad_location_is_ignored(self):
+        self.client.force_login(create_user("diner"))
+        for lat in ("nan", "inf"):
+            response = self.client.get("/dishes/posts/", {"lat": lat,
+                                                          "lng": "-74"})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("nearby", response.context)
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        meal_time = timezone.now() - datetime.timedelta(days=1)
+        # Pairs of posts share a meal time, so pages must break ties by id.
+        self.posts = [
+            create_dish_post(self.chef, status=DishPost.COMPLETE,
+                             meal_time=meal_time - datetime.timedelta(hours=i // 2))
+            for i in range(2 * views.HISTORY_PER_PAGE + 3)
+        ]
+
+    def test_chef_history_pages_continue_without_gaps(self):
+        url = "/dishes/chefs/{}/history/".format(self.chef.pk)
+        seen = []
+        params = {}
+        while True:
+            page = self.client.get(url, params).context["past_dish_posts"]
+            seen.extend(post.pk for post in page)
+            if not page.has_next:
+                break
+            params = {"after": page.next_cursor}
+        expected = sorted(self.posts, key=lambda post: (post.meal_time, post.pk),
+                          reverse=True)
+        self.assertEqual(seen, [post.pk for post in expected])
+
+    def test_malformed_cursor_returns_first_page(self):
+        queryset = DishPost.objects.all()
+        first = pagination.paginate(queryset, ("-id",), None, 5)
+        for cursor in ["junk", "1_2", "99999999999999999999999"]:
+            page = pagination.paginate(queryset, ("-id",), cursor, 5)
+            self.assertEqual([post.pk for post in page],
+                             [post.pk for post in first])
+
+
+class QueryCountTest(TestCase):
+    """
+    Every list page must be rendered with a number of queries that does not
+    depend on how many rows it lists, each searching an index that matches
+    its filters.
+    """
+
+    def setUp(self):
+        user = create_user("cook", chef=True)
+        self.chef = user.chef
+        self.diner = user.diner
+        self.dish_post = create_dish_post(self.chef, max_servings=100)
+        self.dish_request = self.create_request(DishRequest.OPEN)
+        TasteProfile.record(self.diner.pk, "/food")
+        self.client.force_login(user)
+        self.urls = [
+            "/dishes/posts/",
+            "/dishes/posts/feed/",
+            "/dishes/posts/following/",
+            "/dishes/posts/manage/",
+            "/dishes/posts/manage/{}/".format(self.dish_post.pk),
+            "/dishes/requests/",
+            "/dishes/requests/feed/",
+            "/dishes/requests/manage/",
+            "/dishes/requests/{}/offers/".format(self.dish_request.pk),
+            "/dishes/orders-requests/",
+            "/dishes/orders-requests/history/",
+            "/dishes/chefs/{}/".format(self.chef.pk),
+            "/dishes/chefs/{}/history/".format(self.chef.pk),
+            "/dishes/dish_suggestions/",
+        ]
+        self.rows = 0
+
+    def create_request(self, status, diner=None):
+        return DishRequest.objects.create(
+            diner=diner or self.diner,
+            dish=Dish.objects.create(name="Soup", description="Hot"),
+            portion_size=decimal.Decimal(1),
+            min_price=decimal.Decimal(5),
+            meal_time=timezone.now() + datetime.timedelta(days=1),
+            status=status
+        )
+
+    def add_rows(self, n):
+        """
+        Add n rows to every listing, each with its own chef or diner.
+        """
+        for _ in range(n):
+            self.rows += 1
+            other = create_user("other{}".format(self.rows), chef=True)
+            post = create_dish_post(other.chef)
+            Dish.objects.filter(pk=post.dish_id).update(alchemy_label="/food")
+            bid = Bid.objects.create(diner=self.diner, dish_post=post,
+                                     price=decimal.Decimal(5))
+            Order.objects.create(diner=self.diner, dish_post=post, bid=bid,
+                                 status=Order.PENDING_FEEDBACK)
+
+            bid = Bid.objects.create(diner=other.diner, dish_post=self.dish_post,
+                                     price=decimal.Decimal(5))
+            Order.objects.create(diner=other.diner, dish_post=self.dish_post,
+                                 bid=bid)
+            Bid.objects.create(diner=other.diner, dish_post=self.dish_post,
+                               price=decimal.Decimal(5))
+            Offer.objects.create(chef=other.chef, dish_request=self.dish_request,
+                                 price=decimal.Decimal(5))
+
+            # Half the followed chefs are read into the feed, half copied.
+            other.chef.followers.add(self.diner)
+            if self.rows % 2:
+                Chef.objects.filter(pk=other.chef.pk).update(fan_out_on_read=True)
+            else:
+                FeedItem.objects.create(diner=self.diner, dish_post=post)
+
+            create_dish_post(self.chef)
+            create_dish_post(self.chef, status=DishPost.COMPLETE,
+                             meal_time=timezone.now())
+            for status in (DishRequest.OPEN, DishRequest.ACCEPTED,
+                           DishRequest.COMPLETE):
+                self.create_request(status)
+            self.create_request(DishRequest.OPEN, diner=other.diner)
+
+    def count_queries(self):
+        counts = {}
+        for url in self.urls:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            counts[url] = len(queries)
+        return counts
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_rows(2)
+        few = self.count_queries()
+        self.add_rows(10)
+        many = self.count_queries()
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertEqual(many[url], few[url],
+                                 "{} queries for 2 rows, {} for {}"
+                                 .format(few[url], many[url], self.rows))
+
+    def test_queries_search_indexes_matching_their_filters(self):
+        self.add_rows(5)
+        call_command("explain_views", username="cook", verbosity=0)
+
+    def test_plans_do_not_depend_on_the_database_statistics(self):
+        self.add_rows(5)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        call_command("explain_views", username="cook", verbosity=0)
+
+
+class LifecycleTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.diner = create_user("diner", amount=100).diner
+        self.now = timezone.now()
+        self.past = self.now - datetime.timedelta(hours=1)
+
+    def bid(self, dish_post):
+        return Bid.objects.create(diner=self.diner, dish_post=dish_post,
+                                  price=decimal.Decimal(5))
+
+    def test_posts_close_at_last_call(self):
+        ordered = create_dish_post(self.chef, max_servings=2, last_call=self.past)
+        services.accept_bid(self.bid(ordered).pk)
+        unordered = create_dish_post(self.chef, last_call=self.past)
+        pending = self.bid(unordered)
+        upcoming = create_dish_post(self.chef)
+
+        moved = lifecycle.tick(self.now)
+
+        self.assertEqual((moved["posts"], moved["bids"]), (2, 1))
+        statuses = dict(DishPost.objects.values_list("pk", "status"))
+        self.assertEqual(statuses[ordered.pk], DishPost.PENDING_FEEDBACK)
+        self.assertEqual(statuses[unordered.pk], DishPost.CANCELLED)
+        self.assertEqual(statuses[upcoming.pk], DishPost.OPEN)
+        self.assertEqual(Bid.objects.get(pk=pending.pk).status, Bid.REJECTED)
+        # The marker feed must see the closed posts as changed.
+        self.assertEqual(DishPost.objects.get(pk=unordered.pk).modified, self.now)
+
+    def test_orders_wait_for_feedback_after_meal_time(self):
+        dish_post = create_dish_post(self.chef, max_servings=2)
+        order = services.accept_bid(self.bid(dish_post).pk)
+        self.assertEqual(lifecycle.tick(self.now)["orders"], 0)
+
+        later = dish_post.meal_time + datetime.timedelta(minutes=1)
+        self.assertEqual(lifecycle.tick(later)["orders"], 1)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PENDING_FEEDBACK)
+
+    def test_requests_are_cancelled_at_meal_time(self):
+        dish_request = DishRequest.objects.create(
+            diner=self.diner,
+            dish=Dish.objects.create(name="Soup", description="Hot"),
+            portion_size=decimal.Decimal(1),
+            min_price=decimal.Decimal(5),
+            meal_time=self.past
+        )
+        offer = Offer.objects.create(chef=self.chef, dish_request=dish_request,
+                                     price=decimal.Decimal(5))
+
+        moved = lifecycle.tick(self.now)
+
+        self.assertEqual((moved["requests"], moved["offers"]), (1, 1))
+        dish_request.refresh_from_db()
+        offer.refresh_from_db()
+        self.assertEqual(dish_request.status, DishRequest.CANCELLED)
+        self.assertEqual(offer.status, Offer.REJECTED)
+
+    def test_tick_drains_every_batch(self):
+        for _ in range(5):
+            create_dish_post(self.chef, last_call=self.past)
+        self.assertEqual(lifecycle.tick(self.now, batch_size=2)["posts"], 5)
+        self.assertFalse(DishPost.objects.filter(status=DishPost.OPEN).exists())
+
+
+class RatingSummaryTest(TestCase):
+
+    def setUp(self):
+        self.rater = create_user("rater")
+        self.ratee = create_user("ratee")
+
+    def summary(self):
+        summary = RatingSummary.of(self.ratee.pk)
+        return (summary.count, summary.total, summary.low, summary.struck,
+                summary.struck_total)
+
+    def test_ratings_and_strikes_update_the_summary(self):
+        ratings = [Rating.rate(self.rater, self.ratee, score)
+                   for score in (1, 2, 5)]
+        self.assertEqual(self.summary(), (3, 8, 2, 0, 0))
+        self.assertEqual(Rating.strike(ratings[:2]), 2)
+        # Striking a Rating twice changes nothing.
+        self.assertEqual(Rating.strike(ratings[:1]), 0)
+        self.assertEqual(self.summary(), (3, 8, 0, 2, 3))
+        self.assertEqual(RatingSummary.of(self.ratee.pk).unstruck_average(), 5)
+
+    def test_three_low_ratings_suspend_the_ratee(self):
+        for score in (1, 2, 2):
+            Rating.rate(self.rater, self.ratee, score)
+            views.check_suspend_ratee(self.ratee)
+        self.assertTrue(SuspensionInfo.objects.get(user=self.ratee).suspended)
+        self.assertEqual(self.summary(), (3, 5, 0, 3, 5))
+        self.assertFalse(self.ratee.ratings_received.filter(struck=False).exists())
+
+    def test_extreme_average_suspends_the_ratee(self):
+        for score in (5, 5, 4):
+            Rating.rate(self.rater, self.ratee, score)
+        views.check_suspend_ratee(self.ratee)
+        self.assertTrue(SuspensionInfo.objects.get(user=self.ratee).suspended)
+
+    def test_reconcile_rating_summaries(self):
+        Rating.rate(self.rater, self.ratee, 1)
+        Rating.objects.create(rater=self.rater, ratee=self.ratee, rating=4,
+                              struck=True)
+        Rating.objects.create(rater=self.ratee, ratee=self.rater, rating=2)
+        with self.assertRaises(CommandError):
+            call_command("reconcile_rating_summaries", verbosity=0)
+        call_command("reconcile_rating_summaries", fix=True, verbosity=0)
+        call_command("reconcile_rating_summaries", verbosity=0)
+        self.assertEqual(self.summary(), (2, 5, 1, 1, 4))
+        self.assertEqual(RatingSummary.of(self.rater.pk).low, 1)
+
+
+class RedFlagTest(TestCase):
+
+    def setUp(self):
+        self.rater = create_user("rater")
+        self.ratee = create_user("ratee", chef=True)
+
+    def rate(self, score):
+        rating = Rating.rate(self.rater, self.ratee, score)
+        return redflags.record_rating(rating)
+
+    def complain(self):
+        dish_post = create_dish_post(self.ratee.chef)
+        bid = Bid.objects.create(diner=self.rater.diner, dish_post=dish_post,
+                                 price=decimal.Decimal(5))
+        order = Order.objects.create(diner=self.rater.diner,
+                                     dish_post=dish_post, bid=bid)
+        complaint = Complaint.objects.create(complainant=self.rater,
+                                             complainee=self.ratee,
+                                             order=order, description="Cold")
+        return redflags.record_complaint(complaint)
+
+    def test_five_highest_ratings_flag_a_generous_rater(self):
+        self.rate(1)
+        reasons = [self.rate(5) for _ in range(5)]
+        self.assertEqual(reasons, [None] * 4 + [RedFlag.GENEROUS])
+        self.assertEqual(self.rater.ratings_made.filter(struck=True).count(), 5)
+        self.assertEqual(RatingSummary.of(self.ratee.pk).struck, 5)
+        # The struck Ratings no longer count towards the next flag.
+        self.assertIsNone(self.rate(5))
+        self.assertEqual(RedFlag.objects.filter(user=self.rater).count(), 1)
+
+    def test_lowest_ratings_and_complaints_flag_a_critical_rater(self):
+        other = create_user("other")
+        for _ in range(3):
+            Rating.rate(self.rater, other, 1)
+        self.assertIsNone(self.complain())
+        self.assertIsNone(self.complain())
+        self.assertEqual(self.complain(), RedFlag.CRITICAL)
+        self.assertFalse(Complaint.objects.filter(struck=False).exists())
+        self.assertFalse(Rating.objects.filter(struck=False).exists())
+        window = self.rater.raterwindow
+        self.assertEqual((window.lowest, window.complaints), (0, 0))
+
+    def test_ratings_struck_by_suspensions_are_not_counted(self):
+        for _ in range(3):
+            self.rate(1)
+            views.check_suspend_ratee(self.ratee)
+        self.assertTrue(SuspensionInfo.objects.get(user=self.ratee).suspended)
+        for _ in range(3):
+            self.assertIsNone(self.complain())
+        self.assertEqual(self.rater.raterwindow.lowest, 0)
+
+    def test_replay(self):
+        now = timezone.now()
+        ratings = [(now + datetime.timedelta(minutes=i), 1, i, 5)
+                   for i in range(10)]
+        ratings = sorted(ratings + [(now, 2, 10 + i, 1) for i in range(3)])
+        complaints = [(now + datetime.timedelta(minutes=i), 2)
+                      for i in range(3)]
+        flags = list(redflags.replay(ratings, complaints))
+        self.assertEqual(
+            [(flag.user_id, flag.reason, flag.date) for flag in flags],
+            [(2, RedFlag.CRITICAL, complaints[2][0]),
+             (1, RedFlag.GENEROUS, now + datetime.timedelta(minutes=4)),
+             (1, RedFlag.GENEROUS, now + datetime.timedelta(minutes=9))]
+        )
+        stricter = redflags.Detector(window=10)
+        self.assertEqual(len(list(redflags.replay(ratings, [], stricter))), 1)
+        call_command("replay_redflags", verbosity=0)
+
+
+class BacktestTest(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def at(self, minutes):
+        return self.now + datetime.timedelta(minutes=minutes)
+
+    def test_suspension_strikes_count_against_critical_flags(self):
+        ratings = [(self.at(i), 1, 2, i, 1) for i in range(3)]
+        complaints = [(self.at(10 + i), 1) for i in range(3)]
+        outcomes = list(policies.Simulator().replay(ratings, complaints, []))
+        self.assertEqual(outcomes, [
+            policies.Outcome(self.at(2), 2, policies.SUSPENDED)
+        ])
+
+    def test_unsuspended_users_can_be_suspended_and_forced_out(self):
+        simulator = policies.Simulator(force_quit_suspensions=2)
+        ratings = [(self.at(i), 1, 2, i, 5) for i in range(4)]
+        outcomes = list(simulator.replay(ratings, [], [(self.at(2), 2)]))
+        self.assertEqual([(outcome.date, outcome.kind) for outcome in outcomes], [
+            (self.at(2), policies.SUSPENDED),
+            (self.at(3), policies.SUSPENDED),
+            (self.at(3), policies.FORCED_OUT),
+        ])
+        self.assertEqual(simulator.users[2].suspensions, 2)
+
+    def test_backtest_policies(self):
+        rater = create_user("rater")
+        ratee = create_user("ratee")
+        for _ in range(3):
+            Rating.rate(rater, ratee, 1)
+        out = io.StringIO()
+        call_command("backtest_policies", chunk_size=2, stdout=out)
+        self.assertIn("User {}: suspended 1 times".format(ratee.pk),
+                      out.getvalue())
+        call_command("backtest_policies", suspension_low_ratings=4,
+                     suspension_min_ratings=4, stdout=out)
+        self.assertIn("Replayed 3 Ratings and 0 Complaints",
+                      out.getvalue().splitlines()[-1])
+        self.assertIn("0 suspensions", out.getvalue().splitlines()[-1])
+
+    def test_backtest_reads_live_suspensions_in_batches(self):
+        rater = create_user("rater")
+        ratees = [create_user("ratee{}".format(i)) for i in range(3)]
+        for ratee in ratees:
+            SuspensionInfo.objects.filter(user=ratee).update(count=2)
+            for _ in range(3):
+                Rating.rate(rater, ratee, 1)
+        out = io.StringIO()
+        with mock.patch("dishes.management.commands.backtest_policies."
+                        "BATCH_SIZE", 2):
+            call_command("backtest_policies", stdout=out)
+        for ratee in ratees:
+            self.assertIn("User {}: suspended 1 times, first on".format(ratee.pk),
+                          out.getvalue())
+        self.assertEqual(out.getvalue().count("suspended 2 times live"), 3)
+
+    def test_iterate_reads_every_row_once(self):
+        rater = create_user("rater")
+        ratings = [Rating.rate(rater, rater, 3) for _ in range(7)]
+        Rating.objects.filter(pk__in=[r.pk for r in ratings[2:5]]).update(
+            date=self.now
+        )
+        rows = list(pagination.iterate(Rating.objects.all(), ("date", "pk"),
+                                       ("rating", "pk"), 2))
+        self.assertEqual(sorted(pk for _, pk in rows),
+                         [rating.pk for rating in ratings])
+
+
+class ChefStatsTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.diners = [create_user("diner{}".format(i)).diner for i in range(3)]
+
+    def stats(self):
+        chef = Chef.objects.get(pk=self.chef.pk)
+        return dict((name, getattr(chef, name)) for name in Chef.COUNTERS)
+
+    def test_follower_count_follows_both_sides(self):
+        self.chef.followers.add(*self.diners[:2])
+        self.chef.followers.add(self.diners[0])
+        self.diners[2].followees.add(self.chef)
+        self.assertEqual(self.stats()["follower_count"], 3)
+        self.chef.followers.remove(self.diners[0], self.diners[0])
+        self.diners[1].followees.clear()
+        self.assertEqual(self.stats()["follower_count"], 1)
+        self.chef.followers.clear()
+        self.assertEqual(self.stats()["follower_count"], 0)
+
+    def test_saving_a_stale_chef_keeps_the_counters(self):
+        self.chef.followers.add(self.diners[0])
+        self.chef.name = "Renamed"
+        self.chef.save()
+        chef = Chef.objects.get(pk=self.chef.pk)
+        self.assertEqual((chef.name, chef.follower_count), ("Renamed", 1))
+
+    def test_post_counts_follow_status_changes(self):
+        now = timezone.now()
+        posts = [create_dish_post(self.chef) for _ in range(3)]
+        create_dish_post(self.chef, last_call=now - datetime.timedelta(hours=1))
+        self.assertEqual(self.stats()["open_posts"], 4)
+        posts[0].status = DishPost.CANCELLED
+        posts[0].save()
+        posts[1].status = DishPost.COMPLETE
+        posts[1].save()
+        posts[1].save()
+        lifecycle.tick(now)
+        posts[2].delete()
+        stats = self.stats()
+        self.assertEqual((stats["open_posts"], stats["completed_posts"]), (0, 1))
+
+    def test_average_rating(self):
+        self.assertIsNone(self.chef.average_rating())
+        for score in (3, 4):
+            Rating.rate(self.diners[0].user, self.chef.user, score)
+        self.assertEqual(Chef.objects.get(pk=self.chef.pk).average_rating(), 3.5)
+
+    def test_check_chef_stats(self):
+        self.chef.followers.add(self.diners[0])
+        create_dish_post(self.chef)
+        call_command("check_chef_stats", verbosity=0)
+        Chef.objects.filter(pk=self.chef.pk).update(follower_count=5,
+                                                     open_posts=0)
+        with self.assertRaises(CommandError):
+            call_command("check_chef_stats", verbosity=0)
+        call_command("check_chef_stats", fix=True, verbosity=0)
+        call_command("check_chef_stats", verbosity=0)
+        self.assertEqual(self.stats()["follower_count"], 1)
+
+    def test_chef_page_reads_one_chef_row_and_the_open_posts(self):
+        self.chef.followers.add(*self.diners)
+        for status in (DishPost.OPEN, DishPost.COMPLETE):
+            create_dish_post(self.chef, status=status)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/dishes/chefs/{}/".format(self.chef.pk))
+        self.assertContains(response, "History")
+        tables = [query["sql"].split(" FROM ")[1].split()[0]
+                  for query in queries]
+        self.assertEqual(tables, ['"dishes_chef"', '"dishes_dishpost"'])
+
+
+class FeedTest(TestCase):
+
+    def setUp(self):
+        self.chef = create_user("chef", chef=True).chef
+        self.diners = [create_user("diner{}".format(i)).diner for i in range(5)]
+        self.chef.followers.add(*self.diners[:4])
+        self.chef.refresh_from_db()
+
+    def feed(self, diner, cursor=None, per_page=20):
+        return [post.pk for post in feeds.page(diner, cursor, per_page)]
+
+    def test_posts_are_fanned_out_in_chunks(self):
+        post = create_dish_post(self.chef)
+        feeds.enqueue(post)
+        # A worker that dies after the first chunk is resumed where it stopped.
+        task = feeds.claim(1)[0]
+        FeedItem.objects.bulk_create([FeedItem(diner=diner, dish_post=post)
+                                      for diner in self.diners[:3]])
+        FanOutTask.objects.filter(pk=task.pk).update(
+            next_follower=self.diners[2].pk, next_attempt=timezone.now()
+        )
+        self.assertEqual(feeds.process_batch(chunk_size=1), (1, 1))
+        self.assertFalse(FanOutTask.objects.exists())
+        for diner in self.diners[:4]:
+            self.assertEqual(self.feed(diner), [post.pk])
+        self.assertEqual(self.feed(self.diners[4]), [])
+
+    def test_worker_past_its_lease_stops_when_the_task_is_reclaimed(self):
+        post = create_dish_post(self.chef)
+        feeds.enqueue(post)
+        stale = feeds.claim(1)[0]
+        # The first worker outlives its lease and another claims the task.
+        FanOutTask.objects.filter(pk=stale.pk).update(
+            next_attempt=timezone.now()
+        )
+        task = feeds.claim(1)[0]
+        self.assertEqual(feeds.fan_out(stale, chunk_size=1), 0)
+        self.assertEqual(feeds.fan_out(task, chunk_size=1), 4)
+        self.assertFalse(FanOutTask.objects.exists())
+        self.assertEqual(FeedItem.objects.filter(dish_post=post).count(), 4)
+
+    def test_chefs_over_the_cutoff_are_read_into_feeds(self):
+        pushed = create_dish_post(self.chef)
+        feeds.enqueue(pushed)
+        call_command("fanout_feeds", once=True, verbosity=0)
+        pulled = create_dish_post(self.chef)
+        feeds.enqueue(pulled, cutoff=3)
+        self.assertFalse(FanOutTask.objects.exists())
+        self.assertTrue(Chef.objects.get(pk=self.chef.pk).fan_out_on_read)
+        # The Chef stays fan-out-on-read after losing followers.
+        self.chef.followers.remove(self.diners[3])
+        self.chef.refresh_from_db()
+        latest = create_dish_post(self.chef)
+        feeds.enqueue(latest, cutoff=3)
+        self.assertFalse(FanOutTask.objects.exists())
+
+        other = create_user("other", chef=True).chef
+        other.followers.add(self.diners[0])
+        other.refresh_from_db()
+        others = create_dish_post(other)
+        feeds.enqueue(others)
+        feeds.process_batch()
+
+        first = feeds.page(self.diners[0], None, 2)
+        self.assertEqual([post.pk for post in first], [others.pk, latest.pk])
+        self.assertEqual(self.feed(self.diners[0], first.next_cursor, 2),
+                         [pulled.pk, pushed.pk])
+        self.assertEqual(self.feed(self.diners[1]),
+                         [latest.pk, pulled.pk, pushed.pk])
+
+    def test_create_post_enqueues_fan_out(self):
+        self.client.force_login(self.chef.user)
+        self.client.post("/dishes/posts/create/", {
+            "dish-name": "Pizza",
+            "dish-description": "Cheese",
+            "dish_post-max_servings": 2,
+            "dish_post-min_price": 5,
+            "dish_post-serving_size": 1,
+            "dish_post-last_call": "2099-01-01 12:00",
+            "dish_post-meal_time": "2099-01-02 12:00",
+            "dish_post-latitude": "40.7",
+            "dish_post-longitude": "-74.0",
+        })
+        post = DishPost.objects.get(chef=self.chef)
+        self.assertTrue(FanOutTask.objects.filter(dish_post=post).exists())
+        feeds.process_batch()
+        self.client.force_login(self.diners[0].user)
+        response = self.client.get("/dishes/posts/following/")
+        self.assertContains(response, "/dishes/posts/{}/".format(post.pk))
@@ -18,6 +18,14 @@ urlpatterns = [
     url(r"^orders/(?P<order_id>[0-9]+)/feedback/follow/$",
         views.order_follow),
     url(r"^posts/$", views.posts),
+    url(r"^posts/bounds/$", views.posts_in_bounds, name="posts_in_bounds"),
+    url(r"^posts/feed/$", views.posts_feed, name="posts_feed"),
+    url(r"^posts/following/$",
+        views.following_posts,
+        name="following_posts"),
+    url(r"^posts/recommended/$",
+        views.recommended_posts,
+        name="recommended_posts"),
     url(r"^posts/manage/$", views.manage_posts, name="manage_posts"),
     url(r"^posts/manage/(?P<dish_post_id>[0-9]+)/$",
         views.manage_post_detail,
@@ -26,6 +34,9 @@ urlpatterns = [
         views.reject_bid),
     url(r"^posts/manage/(?P<dish_post_id>[0-9]+)/bids/(?P<bid_id>[0-9]+)/accept/$",
         views.accept_bid),
+    url(r"^posts/manage/(?P<dish_post_id>[0-9]+)/bids/clear/$",
+        views.clear_book,
+        name="clear_book"),
     url(r"^posts/manage/orders/(?P<order_id>[0-9]+)/rate/$",
         views.rate_diner),
     url(r"^posts/create/$", views.create_post),
@@ -35,6 +46,7 @@ urlpatterns = [
     url(r"^posts/(?P<dish_post_id>[0-9]+)/cancel/$", views.cancel_post),
     url(r"^posts/(?P<dish_post_id>[0-9]+)/edit/$", views.edit_post),
     url(r"^requests/$", views.requests, name="list-requests"),
+    url(r"^requests/feed/$", views.requests_feed, name="requests_feed"),
     url(r"^requests/create/$", views.create_request),
     url(r"^requests/manage/$", views.manage_open_requests, name="manage_requests"),
     url(r"^requests/(?P<dish_request_id>[0-9]+)/$",
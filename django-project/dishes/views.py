@@ -1,15 +1,17 @@
-import decimal
+import datetime
+import math
 
-from django.db.models import Avg
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
-from django.conf import settings
-from watson_developer_cloud import AlchemyLanguageV1
-from collections import Counter
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
 
 from dishes.models import (
     DishPost, Diner, Order, DishRequest, Chef, Bid,
-    OrderFeedback, RateChef, RateDiner, Dish, Rating,
-    Offer
+    OrderFeedback, RateChef, RateDiner, Dish, Rating, RatingSummary,
+    Offer, TasteProfile
 )
 from dishes.forms import (
     DishForm, DishRequestForm, DishPostForm,
@@ -17,23 +19,188 @@ from dishes.forms import (
     RateDinerForm, RatingForm, BidForm, OfferForm
 )
 
-from accounts.models import RedFlag, Complaint
+from accounts import ledger
+from accounts.models import Balance, Complaint
 from accounts.forms import ComplaintForm
 
+from dishes import (
+    classification, feeds, geo, pagination, policies, recommendations,
+    redflags, services
+)
+
+
+# The number of the diner's favourite labels suggest_dishes suggests dishes of.
+SUGGESTED_LABELS = 2
+
+# The number of rows on a page of the history and management listings.
+HISTORY_PER_PAGE = 20
+
+# The relations the order listings render for every Order: the dish and chef
+# of its Dish Post, and the Bid its total comes from.
+ORDER_RELATED = ("dish_post__dish", "dish_post__chef__user", "bid")
 
+# The default and largest radius in kilometres of the nearby listings of Dish
+# Posts and Dish Requests, and the number of rows on a page of them.
+NEARBY_RADIUS = 5.0
+MAX_NEARBY_RADIUS = 50.0
+NEARBY_PER_PAGE = 20
 
-# Getting APIKEY variable from settings.py
-APIKEY = getattr(settings, "APIKEY", None)
+# The unit in kilometres of the distance buckets the nearby listings are
+# ordered by. Rows within a bucket are listed in id order.
+NEARBY_BUCKET = 0.25
+NEARBY_ORDERING = ("distance_bucket", "id")
 
-# Watson authentication
-alchemy_language = AlchemyLanguageV1(api_key=APIKEY)
+# The number of Dish Posts on a page of recommended_posts.
+RECOMMENDATIONS_PER_PAGE = 20
+
+# The most markers the map will draw individually. Viewports holding more open
+# Dish Posts than this are drawn as clusters instead.
+MAP_MARKER_LIMIT = 200
+
+def nearby(request, queryset):
+    """
+    Return the context for the nearest-first listing of a queryset of Dish
+    Posts or Dish Requests.
+
+    The listing is centred on the lat and lng query parameters or else on
+    the diner's default location, and holds the rows within the radius
+    query parameter in kilometres. It is ordered and paginated in SQL by
+    the after query parameter, a cursor on (distance bucket, id), so a page
+    costs one query however many rows are in range. Each row on the page is
+    given a distance attribute. The links to the nearest and next pages keep
+    the other query parameters, such as the lat and lng of the search.
+    """
+    diner = getattr(request.user, "diner", None)
+    try:
+        latitude = float(request.GET.get("lat", diner.latitude if diner else ""))
+        longitude = float(request.GET.get("lng", diner.longitude if diner else ""))
+    except ValueError:
+        return {}
+    if not (math.isfinite(latitude) and math.isfinite(longitude)):
+        return {}
+    try:
+        radius = float(request.GET.get("radius", NEARBY_RADIUS))
+    except ValueError:
+        radius = NEARBY_RADIUS
+    if not math.isfinite(radius):
+        radius = NEARBY_RADIUS
+    radius = min(max(radius, 0.0), MAX_NEARBY_RADIUS)
+
+    rows = (queryset.around(latitude, longitude, radius, NEARBY_BUCKET)
+                    .select_related("dish")
+                    .order_by(*NEARBY_ORDERING))
+    query = request.GET.copy()
+    query.pop("after", None)
+    query["radius"] = radius
+    nearest_query = query.urlencode()
+    if request.GET.get("after"):
+        try:
+            position = pagination.decode_cursor(request.GET["after"], [int, int])
+        except ValueError:
+            position = None
+        # Larger values cannot be bound as query parameters.
+        if position is not None and all(0 <= v < 2**63 for v in position):
+            rows = rows.filter(pagination.after(NEARBY_ORDERING, position))
+    nearby_rows = list(rows[:NEARBY_PER_PAGE + 1])
+    next_cursor = None
+    farther_query = None
+    if len(nearby_rows) > NEARBY_PER_PAGE:
+        nearby_rows = nearby_rows[:NEARBY_PER_PAGE]
+        last = nearby_rows[-1]
+        next_cursor = pagination.encode_cursor([last.distance_bucket, last.pk])
+        query["after"] = next_cursor
+        farther_query = query.urlencode()
+    for row in nearby_rows:
+        row.distance = geo.distance(latitude, longitude, row.latitude,
+                                    row.longitude)
+    return {
+        "has_location": True,
+        "nearby": pagination.KeysetPage(nearby_rows, next_cursor),
+        "radius": radius,
+        "nearest_query": nearest_query,
+        "farther_query": farther_query
+    }
 
 def posts(request):
-    dish_posts = DishPost.objects.filter(status=DishPost.OPEN)
+    open_posts = DishPost.objects.filter(status=DishPost.OPEN)
+    has_dish_posts = open_posts.exists()
     is_chef = hasattr(request.user, "chef")
-    context = {"dish_posts": dish_posts, "is_chef": is_chef}
+    context = {"has_dish_posts": has_dish_posts, "is_chef": is_chef}
+    context.update(nearby(request, open_posts))
     return render(request, "dishes/posts.html", context)
 
+def posts_in_bounds(request):
+    """
+    Return the open Dish Posts inside the map viewport as JSON.
+
+    The viewport is given by the south, west, north and east query
+    parameters. If the viewport holds more than MAP_MARKER_LIMIT posts they are
+    returned as clusters of nearby posts rather than individual markers.
+    """
+    try:
+        bounds = [float(request.GET[k]) for k in ("south", "west", "north", "east")]
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("south, west, north and east are required.")
+    if not all(math.isfinite(bound) for bound in bounds):
+        return HttpResponseBadRequest("south, west, north and east must be finite.")
+    dish_posts = DishPost.objects.filter(status=DishPost.OPEN).within(*bounds)
+    count = dish_posts.count()
+    markers = []
+    clusters = []
+    if count <= MAP_MARKER_LIMIT:
+        rows = dish_posts.values_list("id", "latitude", "longitude",
+                                      "dish__name", "dish__description",
+                                      "chef__user__username",
+                                      "max_servings", "min_price")
+        for pk, lat, lng, name, description, chef, servings, price in rows:
+            markers.append({
+                "id": pk,
+                "lat": float(lat),
+                "lng": float(lng),
+                "name": name,
+                "description": description,
+                "chef": chef,
+                "servings": servings,
+                "price": str(price)
+            })
+    else:
+        precision = geo.cluster_precision(*bounds)
+        for cluster in dish_posts.clusters(precision):
+            clusters.append({
+                "lat": float(cluster["lat"]),
+                "lng": float(cluster["lng"]),
+                "count": cluster["count"]
+            })
+    return JsonResponse({"count": count, "markers": markers, "clusters": clusters})
+
+def recommended_posts(request):
+    """
+    Return a page of the open Dish Posts ranked for the diner as JSON.
+
+    The page is given by the page query parameter, counting from 1.
+    """
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        return HttpResponseBadRequest("page must be a number.")
+    offset = (page - 1) * RECOMMENDATIONS_PER_PAGE
+    ranked = recommendations.recommend(request.user.diner,
+                                       offset=offset,
+                                       limit=RECOMMENDATIONS_PER_PAGE)
+    posts = []
+    for dish_post, score in ranked:
+        posts.append({
+            "id": dish_post.pk,
+            "name": dish_post.dish.name,
+            "chef": dish_post.chef.name if dish_post.chef else None,
+            "lat": float(dish_post.latitude),
+            "lng": float(dish_post.longitude),
+            "price": str(dish_post.min_price),
+            "last_call": dish_post.last_call.isoformat(),
+            "score": round(score, 4)
+        })
+    return JsonResponse({"page": page, "posts": posts})
+
 def post_detail(request, dish_post_id):
     context = {}
     diner = request.user.diner
@@ -89,12 +256,12 @@ def orders_and_accepted_requests(request):
         return redirect("dishes")
     else:
         diner = request.user.diner
-        orders = diner.order_set
+        orders = diner.order_set.select_related(*ORDER_RELATED)
 
         pending_orders = orders.filter(status__lt=Order.CANCELLED)
         closed_orders = orders.filter(status__gte=Order.CANCELLED)
 
-        diner_requests = diner.dishrequest_set
+        diner_requests = diner.dishrequest_set.select_related("dish")
         pending_requests = diner_requests.filter(status=DishRequest.ACCEPTED)
         closed_requests = diner_requests.filter(status__gt=DishRequest.ACCEPTED)
 
@@ -115,8 +282,20 @@ def orders_and_requests_history(request):
     else:
         diner = request.user.diner
 
-        orders = diner.order_set.filter(status__gt=Order.OPEN)
-        requests = diner.dishrequest_set.filter(status__gt=DishRequest.OPEN)
+        orders = pagination.paginate(
+            diner.order_set.filter(status__gt=Order.OPEN)
+                           .select_related(*ORDER_RELATED),
+            ("-id",),
+            request.GET.get("orders_after"),
+            HISTORY_PER_PAGE
+        )
+        requests = pagination.paginate(
+            diner.dishrequest_set.filter(status__gt=DishRequest.OPEN)
+                                 .select_related("dish"),
+            ("-meal_time", "-id"),
+            request.GET.get("requests_after"),
+            HISTORY_PER_PAGE
+        )
 
         context = {
             "orders": orders,
@@ -126,13 +305,132 @@ def orders_and_requests_history(request):
         return render(request, "dishes/orders-requests-history.html", context)
 
 def requests(request):
-    dish_requests = DishRequest.objects.filter(status=DishRequest.OPEN)
-    context = {"dish_requests": dish_requests}
+    open_requests = DishRequest.objects.filter(status=DishRequest.OPEN)
+    has_dish_requests = open_requests.exists()
+    context = {"has_dish_requests": has_dish_requests}
+    context.update(nearby(request, open_requests))
     return render(request, "dishes/requests.html", context)
 
+# The most rows a single response of the marker feed returns. Clients keep
+# polling with the returned cursor until "more" is false.
+MARKER_FEED_LIMIT = 500
+
+# Seconds a shared cache may serve a marker feed response.
+MARKER_FEED_MAX_AGE = 10
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_feed_cursor(modified, pk):
+    """
+    Encode the position of a row in the marker feed as a cursor string.
+    """
+    delta = modified - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return "{}-{}".format(micros, pk)
+
+def decode_feed_cursor(cursor):
+    """
+    Decode a cursor string into a (modified, pk) pair.
+
+    Raises ValueError if the cursor is malformed, or OverflowError if its
+    time is out of range.
+    """
+    micros, pk = cursor.split("-")
+    modified = EPOCH + datetime.timedelta(microseconds=int(micros))
+    return modified, int(pk)
+
+def marker_feed(request, queryset, open_status, fields, marker):
+    """
+    Build the marker feed response for a queryset of Dish Posts or Dish
+    Requests.
+
+    Without a "since" cursor the feed is a snapshot of the open rows. With a
+    cursor it holds only the rows changed after the cursor: rows that are
+    still open are returned as markers and the rest are returned as the ids
+    to remove. Rows are ordered by (modified, id) so a cursor never skips
+    rows that share a timestamp. A malformed cursor is ignored, so the client
+    gets a fresh snapshot.
+    """
+    since = request.GET.get("since")
+    if since:
+        try:
+            modified, pk = decode_feed_cursor(since)
+        except (ValueError, OverflowError):
+            since = None
+    if since:
+        queryset = queryset.filter(Q(modified__gt=modified) |
+                                   Q(modified=modified, pk__gt=pk))
+    else:
+        queryset = queryset.filter(status=open_status)
+    rows = list(queryset.order_by("modified", "pk")
+                        .values_list("pk", "modified", "status", *fields)
+                        [:MARKER_FEED_LIMIT + 1])
+    more = len(rows) > MARKER_FEED_LIMIT
+    rows = rows[:MARKER_FEED_LIMIT]
+    markers = []
+    removed = []
+    for row in rows:
+        if row[2] == open_status:
+            markers.append(marker(row[0], *row[3:]))
+        else:
+            removed.append(row[0])
+    if rows:
+        cursor = encode_feed_cursor(rows[-1][1], rows[-1][0])
+    else:
+        cursor = since or encode_feed_cursor(EPOCH, 0)
+    response = JsonResponse({
+        "cursor": cursor,
+        "more": more,
+        "markers": markers,
+        "removed": removed
+    })
+    patch_cache_control(response, public=True, max_age=MARKER_FEED_MAX_AGE)
+    return response
+
+def posts_feed(request):
+    """
+    Marker feed of open Dish Posts. See marker_feed.
+    """
+    def marker(pk, lat, lng, name, description, chef, servings, price):
+        return {
+            "id": pk,
+            "lat": float(lat),
+            "lng": float(lng),
+            "name": name,
+            "description": description,
+            "chef": chef,
+            "servings": servings,
+            "price": str(price)
+        }
+    fields = ["latitude", "longitude", "dish__name", "dish__description",
+              "chef__user__username", "max_servings", "min_price"]
+    return marker_feed(request, DishPost.objects.all(), DishPost.OPEN,
+                       fields, marker)
+
+def requests_feed(request):
+    """
+    Marker feed of open Dish Requests. See marker_feed.
+    """
+    def marker(pk, lat, lng, name, description, diner, servings, price):
+        return {
+            "id": pk,
+            "lat": float(lat),
+            "lng": float(lng),
+            "name": name,
+            "description": description,
+            "diner": diner,
+            "servings": servings,
+            "price": str(price)
+        }
+    fields = ["latitude", "longitude", "dish__name", "dish__description",
+              "diner__user__username", "num_servings", "min_price"]
+    return marker_feed(request, DishRequest.objects.all(), DishRequest.OPEN,
+                       fields, marker)
+
 def request_offers(request, dish_request_id):
     dish_request = get_object_or_404(DishRequest, pk=dish_request_id)
-    offers = dish_request.offer_set.filter(status=Offer.PENDING)
+    offers = (dish_request.offer_set.filter(status=Offer.PENDING)
+                                    .select_related("chef__user"))
     context = {
         "dish_request": dish_request,
         "offers": offers
@@ -148,35 +446,19 @@ def reject_offer(request, dish_request_id, offer_id):
 
 def accept_offer(request, dish_request_id, offer_id):
     if request.method == "POST":
-        dish_request = get_object_or_404(DishRequest, pk=dish_request_id)
         offer = get_object_or_404(Offer, pk=offer_id)
-        # Verify the diner has the money.
-        diner_balance = request.user.balance
-        chef_balance = offer.chef.user.balance
-        if diner_balance.is_vip:
-            total = decimal.Decimal(0.90) * offer.total()
-        else:
-            total = offer.total()
-        if diner_balance.amount < total:
-            offers = dish_request.offer_set.filter(status=Offer.PENDING)
+        try:
+            services.accept_offer(offer.pk, request.user)
+        except services.OfferAcceptanceError as error:
+            dish_request = get_object_or_404(DishRequest, pk=dish_request_id)
+            offers = (dish_request.offer_set.filter(status=Offer.PENDING)
+                                            .select_related("chef__user"))
             context = {
                 "dish_request": dish_request,
                 "offers": offers,
-                "message": "You must have sufficient funds to accept an offer."
+                "message": str(error)
             }
-            return render(request, "dishes/requests_offers.html", context)
-        # Update the offer status
-        offer.status = Offer.ACCEPTED
-        for offr in offer.dish_request.offer_set.all():
-            if offr != offer:
-                offr.status = Offer.REJECTED
-                offr.save()
-        offer.save()
-        dish_request.status = DishRequest.ACCEPTED
-        dish_request.save()
-        # Transfer the money.
-        diner_balance.debit(total)
-        chef_balance.credit(offer.total())
+            return render(request, "dishes/request_offers.html", context)
     return redirect("orders_and_requests")
 
 def request_detail(request, dish_request_id):
@@ -207,25 +489,40 @@ def request_detail(request, dish_request_id):
     return render(request, "dishes/request_detail.html", context)
 
 def chef_detail(request, chef_id):
-    chef = get_object_or_404(Chef, pk=chef_id)
-    open_dish_posts = chef.dishpost_set.filter(status=DishPost.OPEN)
-    has_history = open_dish_posts.count() < chef.dishpost_set.count()
+    chef = get_object_or_404(Chef.objects.select_related("user"), pk=chef_id)
+    open_dish_posts = (chef.dishpost_set.filter(status=DishPost.OPEN)
+                                        .select_related("dish"))
     context = {
         "chef": chef,
         "open_dish_posts": open_dish_posts,
-        "has_history": has_history,
+        "has_history": chef.completed_posts > 0,
     }
     return render(request, "dishes/chef_detail.html", context)
 
 def chef_history(request, chef_id):
     chef = get_object_or_404(Chef, pk=chef_id)
-    past_dish_posts = chef.dishpost_set.filter(status=DishPost.COMPLETE)
+    past_dish_posts = pagination.paginate(
+        chef.dishpost_set.filter(status=DishPost.COMPLETE)
+                         .select_related("dish"),
+        ("-meal_time", "-id"),
+        request.GET.get("after"),
+        HISTORY_PER_PAGE
+    )
     context = {
         "chef": chef,
         "past_dish_posts": past_dish_posts,
     }
     return render(request, "dishes/chef_history.html", context)
 
+def following_posts(request):
+    """
+    List the Dish Posts of the Chefs the diner follows, newest first.
+    """
+    dish_posts = feeds.page(request.user.diner, request.GET.get("after"),
+                            HISTORY_PER_PAGE)
+    return render(request, "dishes/following_posts.html",
+                  {"dish_posts": dish_posts})
+
 def order_follow(request, order_id):
     order = get_object_or_404(Order, pk=order_id)
     diner = order.diner
@@ -259,29 +556,38 @@ def order_feedback(request, order_id):
             # Create the OrderFeedback
             feedback_data = {"order": order}
             feedback_data.update(feedback_form.cleaned_data)
-            order_feedback = OrderFeedback.objects.create(**feedback_data)
-            # Transfer the tip.
-            tip_amt = order_feedback.tip
-            if rater.balance.has_funds(tip_amt):
-                rater.balance.debit(tip_amt)
-                ratee.balance.credit(tip_amt)
-            # Create the Rating
-            rating_data = {
-                "rater": rater,
-                "ratee": ratee
-            }
-            rating_data.update(rating_form.cleaned_data)
-            Rating.objects.create(**rating_data)
-            # Update the order status
-            order.diner_rated = True
-            order.status = Order.COMPLETE
-            order.save()
-            if not ratee.suspensioninfo.suspended:
-                check_suspend_ratee(ratee)
-
-            check_redflag_rater(rater)
-            context["feedback_submitted"] = True
-            return render(request, "dishes/order_feedback.html", context)
+            # The feedback and its tip are saved together, so a tip the
+            # diner cannot pay saves nothing and is reported on the form.
+            try:
+                with transaction.atomic():
+                    order_feedback = OrderFeedback.objects.create(**feedback_data)
+                    tip_amt = order_feedback.tip
+                    if tip_amt > 0:
+                        tip = ledger.transfer(rater, ratee, tip_amt,
+                                              key="tip:{}".format(order.pk))
+                        ledger.post([tip])
+            except ledger.InsufficientFunds:
+                feedback_form.add_error("tip", "Your balance does not cover "
+                                               "this tip.")
+            else:
+                # Create the Rating
+                rating = Rating.rate(rater, ratee, rating_form.cleaned_data["rating"])
+                # Update the order status, counting the completed transaction
+                # towards the diner's VIP status only once.
+                completed = (Order.objects.filter(pk=order.pk)
+                                          .exclude(status=Order.COMPLETE)
+                                          .update(diner_rated=True,
+                                                  status=Order.COMPLETE))
+                if completed and order.diner is not None:
+                    Balance.record_completed_transactions([order.diner.user_id])
+                    TasteProfile.record(order.diner_id,
+                                        order.dish_post.dish.alchemy_label)
+                if not ratee.suspensioninfo.suspended:
+                    check_suspend_ratee(ratee)
+
+                redflags.record_rating(rating)
+                context["feedback_submitted"] = True
+                return render(request, "dishes/order_feedback.html", context)
     else:
         feedback_form = FeedbackForm()
         rating_form = RatingForm()
@@ -312,8 +618,8 @@ def order_complain(request, order_id):
                 "order": order
             }
             complaint_data.update(complaint_form.cleaned_data)
-            Complaint.objects.create(**complaint_data)
-            check_redflag_complainant(complainant)
+            complaint = Complaint.objects.create(**complaint_data)
+            redflags.record_complaint(complaint)
             return redirect("orders_and_requests")
     else:
         complaint_form = ComplaintForm()
@@ -325,8 +631,14 @@ def cancel_order(request, order_id):
     order = get_object_or_404(Order, pk=order_id)
     if request.method == "POST":
         if request.user == order.diner.user:
-            order.status = Order.CANCELLED
-            order.save()
+            with transaction.atomic():
+                # Only the request that actually cancels the order releases
+                # its servings.
+                cancelled = (Order.objects.filter(pk=order.pk)
+                                          .exclude(status=Order.CANCELLED)
+                                          .update(status=Order.CANCELLED))
+                if cancelled:
+                    order.dish_post.release_servings(order.num_servings)
         return redirect("orders_and_requests")
     context = {"order": order}
     return render(request, "dishes/cancel_order.html", context)
@@ -354,10 +666,8 @@ def create_request(request):
             }
             dish_data.update(dish_form.cleaned_data)
             dish = Dish.objects.create(**dish_data)
-            classification = alchemy_language.taxonomy(text=dish.name)
-            if classification["taxonomy"]:
-                setattr(dish, "alchemy_label", classification['taxonomy'][0]['label'])
-            dish.save()
+            # The taxonomy label is filled in by the classify_dishes worker.
+            classification.enqueue(dish)
 
             # Create the DishRequest
             # Similarly, collate data not contained
@@ -381,7 +691,13 @@ def create_request(request):
 
 def manage_open_requests(request):
     diner = request.user.diner
-    open_requests = diner.dishrequest_set.filter(status=DishRequest.OPEN)
+    open_requests = pagination.paginate(
+        diner.dishrequest_set.filter(status=DishRequest.OPEN)
+                             .select_related("dish"),
+        ("meal_time", "id"),
+        request.GET.get("after"),
+        HISTORY_PER_PAGE
+    )
     context = {"dish_requests": open_requests}
     return render(request, "dishes/manage_requests.html", context)
 
@@ -437,10 +753,8 @@ def create_post(request):
             }
             dish_data.update(dish_form.cleaned_data)
             dish = Dish.objects.create(**dish_data)
-            classification = alchemy_language.taxonomy(text=dish.name)
-            if classification["taxonomy"]:
-                setattr(dish, "alchemy_label", classification['taxonomy'][0]['label'])
-            dish.save()
+            # The taxonomy label is filled in by the classify_dishes worker.
+            classification.enqueue(dish)
 
             # Create the DishPost
             # Similarly, collate data not contained
@@ -453,6 +767,8 @@ def create_post(request):
             }
             dish_post_data.update(**dish_post_form_data)
             dish_post = DishPost.objects.create(**dish_post_data)
+            # Copied into the followers' feeds by the fanout_feeds worker.
+            feeds.enqueue(dish_post)
 
             return redirect("orders_and_requests")
     else:
@@ -465,7 +781,7 @@ def create_post(request):
 
 def manage_posts(request):
     chef = request.user.chef
-    dish_posts = chef.dishpost_set
+    dish_posts = chef.dishpost_set.select_related("dish")
     open_dish_posts = dish_posts.filter(status=DishPost.OPEN)
     pending_dish_posts = dish_posts.filter(status=DishPost.PENDING_FEEDBACK)
     context = {
@@ -474,15 +790,16 @@ def manage_posts(request):
     }
     return render(request, "dishes/manage_posts.html", context)
 
-def manage_post_detail(request, dish_post_id):
+def manage_post_detail(request, dish_post_id, message=None):
     dish_post = get_object_or_404(DishPost, pk=dish_post_id)
-    orders = dish_post.order_set.all()
-    bids = dish_post.bid_set.filter(status=Bid.PENDING)
+    orders = dish_post.order_set.select_related("diner__user")
+    bids = dish_post.bid_set.filter(status=Bid.PENDING).select_related("diner")
     context = {
         "dish_post": dish_post,
         "orders": orders,
         "Order": Order,
-        "bids": bids
+        "bids": bids,
+        "message": message
     }
     return render(request, "dishes/manage_post_detail.html", context)
 
@@ -532,19 +849,14 @@ def rate_diner(request, order_id):
             rater = request.user
             ratee = diner.user
             # Create the Rating
-            rating_data = {
-                "rater": rater,
-                "ratee": ratee
-            }
-            rating_data.update(form.cleaned_data)
-            Rating.objects.create(**rating_data)
+            rating = Rating.rate(rater, ratee, form.cleaned_data["rating"])
             order.chef_rated = True
             order.save()
             # Execute suspension and flagging checks
             # on the rater and ratee.
             if not ratee.suspensioninfo.suspended:
                 check_suspend_ratee(ratee)
-            check_redflag_rater(rater)
+            redflags.record_rating(rating)
             return redirect("manage_posts")
     else:
         form = RatingForm()
@@ -574,24 +886,22 @@ def reject_bid(request, dish_post_id, bid_id):
 def accept_bid(request, dish_post_id, bid_id):
     if request.method == "POST":
         bid = get_object_or_404(Bid, pk=bid_id)
-        bid.status = Bid.ACCEPTED
-        order = Order.objects.create(
-            diner=bid.diner,
-            dish_post=bid.dish_post,
-            bid=bid,
-            num_servings=bid.num_servings
-        )
-        bid.save()
-        # Deduct the total price from the Diner's balance.
-        diner_balance = bid.diner.user.balance
-        if diner_balance.is_vip:
-            total = decimal.Decimal(0.90) * bid.total()
-        else:
-            total = bid.total()
-        diner_balance.debit(total)
-        # Add the total price to the Chef's balance.
-        chef_balance = bid.dish_post.chef.user.balance
-        chef_balance.credit(bid.total())
+        try:
+            services.accept_bid(bid.pk)
+        except services.BidAcceptanceError as error:
+            return manage_post_detail(request, dish_post_id, message=str(error))
+    return redirect("manage_post_detal", dish_post_id)
+
+def clear_book(request, dish_post_id):
+    if request.method == "POST":
+        dish_post = get_object_or_404(DishPost, pk=dish_post_id,
+                                      chef__user=request.user)
+        try:
+            orders, rejected = services.clear_book(dish_post.pk)
+        except services.BidAcceptanceError as error:
+            return manage_post_detail(request, dish_post_id, message=str(error))
+        message = "Accepted {} bids and rejected {}.".format(len(orders), rejected)
+        return manage_post_detail(request, dish_post_id, message=message)
     return redirect("manage_post_detal", dish_post_id)
 
 def check_suspend_ratee(ratee):
@@ -600,20 +910,21 @@ def check_suspend_ratee(ratee):
     """
     # Check if the ratee has 3 ratings less than 2 for
     # which the ratee has not yet been suspended.
-    ratings = ratee.ratings_received
-    bad_ratings = ratings.filter(rating__lte=2, struck=False)
-    if bad_ratings.count() >= 3:
+    summary = RatingSummary.of(ratee.pk)
+    if summary.low >= policies.SUSPENSION_LOW_RATINGS:
         # Fetch 3 of the bad ratings
         # Mark them as struck
-        for bad_rating in bad_ratings.all()[:3]:
-            bad_rating.struck = True
-            bad_rating.save()
+        bad_ratings = ratee.ratings_received.filter(
+            rating__lte=RatingSummary.LOW_RATING,
+            struck=False
+        ).order_by("pk")
+        Rating.strike(bad_ratings[:policies.SUSPENSION_LOW_RATINGS])
         # Suspend the ratee's account
         ratee.suspensioninfo.suspend()
     # Check if the ratee's average rating is out of bounds.
-    elif ratings.count() >= 3:
-        avg = ratings.all().aggregate(Avg("rating"))["rating__avg"]
-        if avg < 2.0 or avg > 4.0:
+    elif summary.count >= policies.SUSPENSION_MIN_RATINGS:
+        avg = summary.average()
+        if avg < policies.MIN_AVERAGE or avg > policies.MAX_AVERAGE:
             # Suspend the ratee's account
             ratee.suspensioninfo.suspend()
 
@@ -624,65 +935,26 @@ def check_force_quit(user):
     Check if a user should be forced out of the system based on their
     suspensions.
     """
-    if user.suspensioninfo.count == 3:
+    if user.suspensioninfo.count == policies.FORCE_QUIT_SUSPENSIONS:
         user.is_active = False
         user.save()
 
-def check_redflag_rater(rater):
-    """
-    Check if a user should be flagged based on the ratings they give.
-    """
-    if check_redflag_complainant(rater):
-        return
-    latest_ratings = rater.ratings_made.order_by("-date")[:5]
-    if not any(map(lambda r: r.struck or r.rating < 5, latest_ratings)):
-        for rating in latest_ratings:
-            rating.struck = True
-            rating.save()
-        RedFlag.objects.create(user=rater, reason=RedFlag.GENEROUS)
-
-def check_redflag_complainant(complainant):
-    """
-    Check if a user should be flagged based on the complaints they have
-    alleged.
-    """
-    lowest_ratings = complainant.ratings_made.filter(rating=1, struck=False)
-    complaints = complainant.complaint_allegations.filter(struck=False)
-
-    if lowest_ratings.count() >= 3 and complaints.count() >= 3:
-        # Fetch three of the lowest ratings
-        # Mark them as struck
-        for low_rating in lowest_ratings.all()[:3]:
-            low_rating.struck = True
-            low_rating.save()
-
-        # Fetch three of the complaints
-        # Mark them as struck
-        for complaint in complaints.all()[:3]:
-            complaint.struck = True
-            complaint.save()
-
-        # Flag the user
-        RedFlag.objects.create(user=complainant, reason=RedFlag.CRITICAL)
-        return True
-    else:
-        return False
-
 def suggest_dishes(request):
     context = {}
-    diner_labels = []
-    dish_suggestions2 = ''
-    for o in Order.objects.filter(diner__user=request.user):
-        diner_labels.append(o.dish_post.dish.alchemy_label)
-    counted_labels = dict(Counter(diner_labels))
-    suggestions = [key for key in counted_labels]
-    if suggestions:
-        dish_suggestions = DishPost.objects.filter(dish__alchemy_label=suggestions[0], status=DishPost.OPEN)
-        if len(suggestions) > 1:
-            dish_suggestions2 = DishPost.objects.filter(dish__alchemy_label=suggestions[1], status=DishPost.OPEN)
+    diner = request.user.diner
+    labels = TasteProfile.top_labels(diner, SUGGESTED_LABELS)
+    open_posts = (DishPost.objects.filter(status=DishPost.OPEN)
+                                  .select_related("dish", "chef__user"))
+    if labels:
+        # One query for the open posts of all the labels, split up by label
+        # in the order of the diner's preference.
+        by_label = dict((label, []) for label in labels)
+        for dish_post in open_posts.filter(dish__alchemy_label__in=labels):
+            by_label[dish_post.dish.alchemy_label].append(dish_post)
+        suggestions = [by_label[label] for label in labels]
     else:
-        dish_suggestions = DishPost.objects.filter(status=DishPost.OPEN)
-    context["dish_suggestions"] = dish_suggestions
-    context["dish_suggestions2"] = dish_suggestions2
+        suggestions = [open_posts]
+    context["dish_suggestions"] = suggestions[0]
+    context["dish_suggestions2"] = suggestions[1] if len(suggestions) > 1 else ""
     return render(request, "dishes/dish_suggestions.html", context)
 
@@ -12,7 +12,12 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 
 import os
 
-from config import key
+# config.py holds the Watson API key. It is optional: without it NGS runs,
+# but the Watson classifier cannot authenticate.
+try:
+    from config import key
+except ImportError:
+    key = None
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -47,6 +52,10 @@ INSTALLED_APPS = [
 
 APIKEY = key
 
+# The backend that labels Dishes with the Watson taxonomy. The local backend,
+# "dishes.classifiers.LocalClassifier", works offline (see dishes.classifiers).
+DISH_CLASSIFIER = "dishes.classifiers.WatsonClassifier"
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -90,6 +99,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/ref/settings/#caches
+#
+# Suspension state is cached per user (see accounts.models.SuspensionInfo).
+# The local memory cache is private to each process, so when running more
+# than one worker process point this at a shared backend such as memcached.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
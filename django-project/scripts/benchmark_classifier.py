@@ -0,0 +1,68 @@
+"""
+Script that benchmarks the accuracy and throughput of the local dish
+classifier.
+
+The labelled examples are the dishes of the dummy data together with every
+labelled Dish and cached label in the database. Accuracy is measured by
+leave-one-out cross validation: each example is classified by a model
+trained on all the others. Throughput is measured by classifying every
+example name repeatedly with a model trained on all of them.
+
+Usage: python scripts/benchmark_classifier.py [--rounds N]
+"""
+import argparse
+import time
+
+import manage_dummy_data
+from dishes.classifiers import LocalClassifier, training_examples
+
+
+def examples():
+    seen = set()
+    result = []
+    dummy = [(dish["name"], dish["alchemy_label"])
+             for dish in manage_dummy_data.dishes.values()]
+    for name, label in dummy + training_examples():
+        if (name, label) not in seen:
+            seen.add((name, label))
+            result.append((name, label))
+    return result
+
+
+def accuracy(data):
+    correct = 0
+    for i, (name, label) in enumerate(data):
+        model = LocalClassifier(data[:i] + data[i + 1:])
+        correct += model(name) == label
+    return correct / len(data)
+
+
+def throughput(data, rounds):
+    model = LocalClassifier(data)
+    names = [name for name, label in data]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for name in names:
+            model(name)
+    elapsed = time.perf_counter() - start
+    return rounds * len(names) / elapsed
+
+
+def main(rounds):
+    data = examples()
+    labels = set(label for name, label in data)
+    print("Examples: {} names, {} labels".format(len(data), len(labels)))
+    print("Leave-one-out accuracy: {:.1%}".format(accuracy(data)))
+    rate = throughput(data, rounds)
+    print("Throughput: {:,.0f} names/s ({:.1f} us per name)"
+          .format(rate, 1e6 / rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds",
+                        type=int,
+                        default=1000,
+                        help="How often every name is classified.")
+    args = parser.parse_args()
+    main(args.rounds)
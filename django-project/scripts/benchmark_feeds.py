@@ -0,0 +1,148 @@
+"""
+Script that benchmarks posting to and reading the feeds of followers.
+
+A throwaway test database is filled with --followers diners, all following
+a large chef, the first FANOUT_CUTOFF of them also following a chef just
+small enough to be fanned out on write. Both chefs then create --posts Dish
+Posts each, which are fanned out by the worker, and the first two pages of
+the feeds of --readers random followers are read. The time to post, the
+fan-out throughput and the time per feed page are reported. The script
+exits with an error when the 95th percentile of posting or of reading a
+page exceeds --budget milliseconds.
+
+Usage: python scripts/benchmark_feeds.py [--followers N] [--posts N]
+"""
+import os
+import sys
+import time
+import argparse
+import decimal
+import datetime
+
+import django
+import numpy
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ngs.settings"
+ngs_dir, gbg = os.path.split(os.path.abspath(__file__))
+ngs_dir, gbg = os.path.split(ngs_dir)
+sys.path.append(ngs_dir)
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from dishes import feeds
+from dishes.models import Chef, Diner, Dish, DishPost, recount_followers
+
+PER_PAGE = 20
+
+def create_chef(username):
+    return Chef.objects.create(user=User.objects.create(username=username))
+
+def create_followers(nfollowers, large, small):
+    User.objects.bulk_create(User(username="follower{}".format(i))
+                             for i in range(nfollowers))
+    users = User.objects.filter(username__startswith="follower").order_by("pk")
+    Diner.objects.bulk_create(Diner(user_id=pk)
+                              for pk in users.values_list("pk", flat=True))
+    diner_ids = list(Diner.objects.order_by("pk").values_list("pk", flat=True))
+    Follow = Chef.followers.through
+    Follow.objects.bulk_create(
+        [Follow(chef_id=large.pk, diner_id=pk) for pk in diner_ids] +
+        [Follow(chef_id=small.pk, diner_id=pk)
+         for pk in diner_ids[:feeds.FANOUT_CUTOFF]],
+        batch_size=feeds.INSERT_SIZE
+    )
+    recount_followers([large.pk, small.pk])
+    return diner_ids
+
+def post(chef):
+    """
+    Create a Dish Post as the create_post view does and return the time it
+    took in milliseconds.
+    """
+    now = timezone.now()
+    start = time.perf_counter()
+    dish = Dish.objects.create(name="Pizza", description="Cheese")
+    dish_post = DishPost.objects.create(
+        chef=Chef.objects.get(pk=chef.pk),
+        dish=dish,
+        max_servings=4,
+        min_price=decimal.Decimal(5),
+        serving_size=decimal.Decimal(1),
+        last_call=now + datetime.timedelta(days=1),
+        meal_time=now + datetime.timedelta(days=2),
+        latitude=decimal.Decimal("40.7"),
+        longitude=decimal.Decimal("-74.0")
+    )
+    feeds.enqueue(dish_post)
+    return (time.perf_counter() - start) * 1000
+
+def report(name, timings):
+    timings = numpy.array(timings)
+    p95 = numpy.percentile(timings, 95)
+    print("{}: median {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms"
+          .format(name, numpy.median(timings), p95, timings.max()))
+    return p95
+
+def main(nfollowers, nposts, nreaders, budget):
+    rng = numpy.random.RandomState(0)
+    large = create_chef("large")
+    small = create_chef("small")
+    diner_ids = create_followers(nfollowers, large, small)
+    print("{:,} followers of the large chef, {:,} of the small one"
+          .format(nfollowers, min(nfollowers, feeds.FANOUT_CUTOFF)))
+
+    posting = {large: [], small: []}
+    for _ in range(nposts):
+        for chef in (large, small):
+            posting[chef].append(post(chef))
+
+    start = time.perf_counter()
+    fanned_out = inserted = 0
+    while True:
+        tasks, rows = feeds.process_batch()
+        if not tasks:
+            break
+        fanned_out += tasks
+        inserted += rows
+    elapsed = time.perf_counter() - start
+    print("Fanned out {} posts into {:,} feeds in {:.2f} s ({:,.0f} rows/s)"
+          .format(fanned_out, inserted, elapsed, inserted / elapsed))
+
+    reading = []
+    for pk in rng.choice(diner_ids[:feeds.FANOUT_CUTOFF], nreaders):
+        diner = Diner.objects.get(pk=pk)
+        cursor = None
+        for _ in range(2):
+            start = time.perf_counter()
+            page = feeds.page(diner, cursor, PER_PAGE)
+            reading.append((time.perf_counter() - start) * 1000)
+            assert len(page) == PER_PAGE
+            cursor = page.next_cursor
+
+    worst = max(report("Posting, large chef (fan-out on read)", posting[large]),
+                report("Posting, small chef (fan-out on write)", posting[small]),
+                report("Reading a feed page", reading))
+    if worst > budget:
+        sys.exit("p95 of {:.2f} ms exceeds the budget of {:.0f} ms."
+                 .format(worst, budget))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--followers", type=int, default=20000,
+                        help="The number of followers of the large chef.")
+    parser.add_argument("--posts", type=int, default=30,
+                        help="The number of Dish Posts each chef creates.")
+    parser.add_argument("--readers", type=int, default=200,
+                        help="The number of followers to read the feed of.")
+    parser.add_argument("--budget", type=float, default=20.0,
+                        help="The p95 time per post and per page allowed, "
+                             "in milliseconds.")
+    args = parser.parse_args()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        main(args.followers, args.posts, args.readers, args.budget)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,144 @@
+"""
+Script that benchmarks ranking open Dish Posts for a diner.
+
+A synthetic CandidateSet of --posts open Dish Posts is generated around New
+York City: random locations, taxonomy labels, chefs, chef ratings and last
+calls. A page of recommendations is then ranked for --diners random diners,
+each with a random taste profile and followed chefs, and the time per page
+is reported. The script exits with an error when the 95th percentile exceeds
+--budget milliseconds.
+
+With --build, the same number of open Dish Posts is also written to a
+throwaway test database and the time to load them into a CandidateSet, as
+the background rebuild does, is reported.
+
+Usage: python scripts/benchmark_recommendations.py [--posts N] [--diners N]
+                                                   [--build]
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+import decimal
+
+import django
+import numpy
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "ngs.settings"
+ngs_dir, gbg = os.path.split(os.path.abspath(__file__))
+ngs_dir, gbg = os.path.split(ngs_dir)
+sys.path.append(ngs_dir)
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from dishes.models import Chef, Dish, DishPost
+from dishes.recommendations import CandidateSet
+
+NLABELS = 40
+NCHEFS = 5000
+
+def synthetic_candidates(nposts, rng, now):
+    labels = ["/food and drink/label {}".format(i) for i in range(NLABELS)]
+    chef_ratings = rng.uniform(0, 1, NCHEFS)
+    chef_ids = rng.randint(0, NCHEFS, nposts)
+    return CandidateSet(
+        ids=numpy.arange(1, nposts + 1, dtype=numpy.int64),
+        latitudes=numpy.radians(rng.uniform(40.55, 40.90, nposts)),
+        longitudes=numpy.radians(rng.uniform(-74.05, -73.75, nposts)),
+        label_codes=rng.randint(0, NLABELS, nposts).astype(numpy.int32),
+        labels=labels,
+        chef_ids=chef_ids.astype(numpy.int64),
+        ratings=chef_ratings[chef_ids],
+        last_calls=now + rng.uniform(-3600, 48 * 3600, nposts),
+    )
+
+def time_build(nposts, rng, rounds=3):
+    """
+    Write nposts open Dish Posts to the database and return the median time
+    in seconds to build a CandidateSet from them.
+    """
+    chefs = [Chef.objects.create(
+                 user=User.objects.create(username="chef{}".format(i))
+             ) for i in range(NCHEFS // 100)]
+    dishes = [Dish.objects.create(
+                  name="Dish {}".format(i), description="",
+                  alchemy_label="/food and drink/label {}".format(i)
+              ) for i in range(NLABELS)]
+    now = timezone.now()
+    DishPost.objects.bulk_create(
+        (DishPost(chef=chefs[rng.randint(len(chefs))],
+                  dish=dishes[rng.randint(len(dishes))],
+                  min_price=decimal.Decimal(5),
+                  serving_size=decimal.Decimal(1),
+                  latitude=decimal.Decimal(
+                      "{:.6f}".format(rng.uniform(40.55, 40.90))),
+                  longitude=decimal.Decimal(
+                      "{:.6f}".format(rng.uniform(-74.05, -73.75))),
+                  last_call=now + datetime.timedelta(hours=rng.uniform(1, 48)),
+                  meal_time=now + datetime.timedelta(days=2))
+         for _ in range(nposts)),
+        # Keeps each INSERT under SQLite's parameter limit.
+        batch_size=50
+    )
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        candidates = CandidateSet.build()
+        timings.append(time.perf_counter() - start)
+        assert len(candidates) == nposts
+    return numpy.median(timings)
+
+def main(nposts, ndiners, page, budget, build):
+    rng = numpy.random.RandomState(0)
+    now = time.time()
+    candidates = synthetic_candidates(nposts, rng, now)
+    timings = []
+    for _ in range(ndiners):
+        labels = rng.choice(candidates.labels, 5, replace=False)
+        shares = rng.dirichlet(numpy.ones(5))
+        tastes = dict(zip(labels, shares))
+        followed = set(rng.randint(0, NCHEFS, 10).tolist())
+        latitude = rng.uniform(40.55, 40.90)
+        longitude = rng.uniform(-74.05, -73.75)
+        start = time.perf_counter()
+        ids, scores = candidates.rank(latitude, longitude, tastes, followed,
+                                      now, (page - 1) * 20, 20)
+        timings.append(time.perf_counter() - start)
+        assert len(ids) == 20
+
+    timings = numpy.array(timings) * 1000
+    p95 = numpy.percentile(timings, 95)
+    print("Ranked page {} of {:,} open posts for {} diners".format(page, nposts, ndiners))
+    print("median {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms"
+          .format(numpy.median(timings), p95, timings.max()))
+    if build:
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            elapsed = time_build(nposts, rng)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        print("Built the CandidateSet of {:,} open posts in {:.2f} s"
+              .format(nposts, elapsed))
+    if p95 > budget:
+        sys.exit("p95 of {:.2f} ms exceeds the budget of {:.0f} ms."
+                 .format(p95, budget))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="The number of open Dish Posts.")
+    parser.add_argument("--diners", type=int, default=200,
+                        help="The number of diners to rank a page for.")
+    parser.add_argument("--page", type=int, default=1,
+                        help="The page to rank.")
+    parser.add_argument("--budget", type=float, default=20.0,
+                        help="The p95 time per page allowed, in milliseconds.")
+    parser.add_argument("--build", action="store_true",
+                        help="Also time building the CandidateSet from the "
+                             "database.")
+    args = parser.parse_args()
+    main(args.posts, args.diners, args.page, args.budget, args.build)
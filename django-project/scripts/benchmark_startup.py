@@ -0,0 +1,101 @@
+"""
+Script that benchmarks the cold-start cost of an NGS worker.
+
+A fresh interpreter is started for every run, which sets up Django and
+imports the URLconf (and with it every view module) the way a worker does
+before serving its first request. The wall time of each run is reported,
+and the output of python -X importtime is used to list the packages that
+take longest to import. -X importtime needs Python 3.7 or greater; on older
+interpreters only the wall time is reported.
+
+With --budget the script exits with an error when the median run takes
+longer than the budget, so it can guard worker spin-up time in CI.
+
+Usage: python scripts/benchmark_startup.py [--runs N] [--top N] [--budget S]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import collections
+
+STARTUP = "; ".join([
+    "import os",
+    "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ngs.settings')",
+    "import django",
+    "django.setup()",
+    "import ngs.urls",
+])
+
+def run(python, project_dir):
+    """
+    Start a worker once and return its wall time in seconds and the
+    cumulative import time in microseconds of each top-level package.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([python, "-X", "importtime", "-c", STARTUP],
+                            cwd=project_dir,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    lines = result.stderr.splitlines()
+    if result.returncode:
+        sys.exit("\n".join(line for line in lines
+                           if not line.startswith("import time:")))
+
+    packages = {}
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # The header line.
+            continue
+        name = fields[2].rstrip()
+        # Top-level imports are the ones not indented under another.
+        if name.startswith(" ") and not name.startswith("  "):
+            packages[name.strip()] = cumulative
+    return elapsed, packages
+
+def main(runs, top, budget):
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    packages = collections.defaultdict(list)
+    for _ in range(runs):
+        elapsed, cumulative = run(sys.executable, project_dir)
+        times.append(elapsed)
+        for name, us in cumulative.items():
+            packages[name].append(us)
+
+    median = statistics.median(times)
+    print("Worker start-up over {} runs: median {:.0f} ms, min {:.0f} ms"
+          .format(runs, median * 1000, min(times) * 1000))
+    if packages:
+        slowest = sorted(packages.items(),
+                         key=lambda item: statistics.median(item[1]),
+                         reverse=True)
+        print("Slowest top-level imports (median cumulative):")
+        for name, us in slowest[:top]:
+            print("  {:>8.1f} ms  {}".format(statistics.median(us) / 1000, name))
+    else:
+        print("Import breakdown unavailable: -X importtime needs Python 3.7+.")
+
+    if budget is not None and median > budget:
+        sys.exit("Median start-up {:.0f} ms exceeds the budget of {:.0f} ms."
+                 .format(median * 1000, budget * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5,
+                        help="How many workers to start.")
+    parser.add_argument("--top", type=int, default=15,
+                        help="How many of the slowest imports to list.")
+    parser.add_argument("--budget", type=float,
+                        help="Fail if the median start-up exceeds this many seconds.")
+    args = parser.parse_args()
+    main(args.runs, args.top, args.budget)
@@ -5,6 +5,7 @@ import datetime
 import argparse
 
 import django
+from django.core.management import call_command
 from django.utils import timezone
 
 os.environ["DJANGO_SETTINGS_MODULE"] = "ngs.settings"
@@ -17,6 +18,7 @@ from django.contrib.auth.models import User
 
 from dishes.models import *
 from accounts.models import *
+from accounts import ledger
 
 users = {
     0: {
@@ -918,6 +920,8 @@ def load():
         order = Order.objects.create(**orders[key])
         orders[key] = order
 
+    call_command("rebuild_servings_reserved", verbosity=0)
+
     for key in dish_requests:
         dish_requests[key]["diner"] = diners[dish_requests[key]["diner"]]
         dish_requests[key]["dish"] = dishes[dish_requests[key]["dish"]]
@@ -948,10 +952,19 @@ def load():
         suspension_info[key] = suspension_count
 
     for key in balances:
-        balances[key]["user"] = users[balances[key]["user"]]
-        balance = Balance.objects.create(**balances[key])
+        user = users[balances[key]["user"]]
+        amount = balances[key].get("amount")
+        balance = Balance.objects.create(user=user)
+        # Opening balances are deposited through the ledger so that the
+        # balances reconcile with it.
+        if amount:
+            ledger.post([ledger.transfer(None, user, amount,
+                                         key="opening:{}".format(user.pk))])
         balances[key] = balance
 
+    call_command("backfill_vip_counters", verbosity=0)
+    call_command("rebuild_taste_profiles", verbosity=0)
+
     User.objects.create_superuser("admin",
                                   "admin@example.com",
                                   "uncommonpassword")
@@ -964,6 +977,7 @@ def delete():
         Chef,
         CuisineTag,
         Bid,
+        TasteProfile,
         Order,
         DishPost,
         DishRequest,
@@ -972,6 +986,7 @@ def delete():
         Complaint,
         CreateAccountRequest,
         SuspensionInfo,
+        Transfer,
         Balance,
         OrderFeedback
     ]